@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Benchmark the whole pipeline on the test PDFs for each table detection mode.
+
+Each document is converted in its own process, so that its peak resident set size
+(RSS) is measured alone, and the fastest of a few repeats is kept. The throughput
+(pages/sec), the time spent in each stage of the pipeline and the peak RSS are
+written as JSON. Given the results of another commit as a baseline, the run fails
+when a document gets slower or bigger by more than a threshold.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests/input")
+
+# Table detection modes and the models they need, if any
+MODES = {
+    "heuristic": None,
+    "ml": os.path.join(TESTDATA, "paleo_model.pkl"),
+    "vision": os.path.join(TESTDATA, "paleo_visual_model.h5"),
+}
+
+
+def run_one(pdf_file: str, mode: str) -> Dict[str, Any]:
+    """Convert a document in this process and measure it."""
+    import pdftotree
+    from pdftotree.core import load_model
+
+    model_type = None if mode == "heuristic" else mode
+    # The model is loaded only once per corpus in practice, so do not time it.
+    model = None if model_type is None else load_model(model_type, MODES[mode])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        profile_path = os.path.join(tmpdir, "profile.json")
+        start = time.perf_counter()
+        pdftotree.parse(
+            pdf_file, model_type=model_type, model=model, profile_path=profile_path
+        )
+        seconds = time.perf_counter() - start
+        with open(profile_path) as f:
+            profile = json.load(f)
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    unit = 1 if platform.system() == "Darwin" else 1024
+    return {
+        "pages": len(profile["pages"]),
+        "seconds": seconds,
+        "stages": profile["total"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * unit
+        / 2**20,
+        # tabula-java runs in subprocesses
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        * unit
+        / 2**20,
+    }
+
+
+def run_benchmarks(
+    pdf_files: List[str], modes: List[str], repeat: int
+) -> List[Dict[str, Any]]:
+    """Run each document in each mode in a subprocess and keep the fastest run."""
+    results = []
+    for mode in modes:
+        if MODES[mode] is not None and not os.path.exists(MODES[mode]):
+            print(f"Skipping {mode} as {MODES[mode]} is not found.", file=sys.stderr)
+            continue
+        for pdf_file in pdf_files:
+            runs = []
+            for _ in range(repeat):
+                proc = subprocess.run(
+                    [sys.executable, __file__, "--run_one", pdf_file, mode],
+                    stdout=subprocess.PIPE,
+                    check=True,
+                )
+                runs.append(json.loads(proc.stdout.decode("utf-8").splitlines()[-1]))
+            best = min(runs, key=lambda run: run["seconds"])
+            result = {
+                "pdf_file": os.path.basename(pdf_file),
+                "mode": mode,
+                "pages": best["pages"],
+                "seconds": round(best["seconds"], 3),
+                "pages_per_sec": round(best["pages"] / best["seconds"], 3),
+                "stages": {
+                    stage: round(seconds, 3)
+                    for stage, seconds in best["stages"].items()
+                },
+                "peak_rss_mb": round(max(run["peak_rss_mb"] for run in runs), 1),
+                "peak_child_rss_mb": round(
+                    max(run["peak_child_rss_mb"] for run in runs), 1
+                ),
+            }
+            print(
+                f"{mode:>9} {result['pdf_file']:<50} "
+                f"{result['pages_per_sec']:>8.2f} pages/sec "
+                f"{result['peak_rss_mb']:>8.1f} MB",
+                file=sys.stderr,
+            )
+            results.append(result)
+    return results
+
+
+def compare(
+    results: List[Dict[str, Any]],
+    baseline: List[Dict[str, Any]],
+    threshold: float,
+) -> List[str]:
+    """List the regressions of results against a baseline.
+
+    :param threshold: relative slow-down of pages/sec, or growth of peak RSS, that
+        is tolerated, e.g. 0.2 for 20%
+    :return: a message per regression
+    """
+    base = {(r["pdf_file"], r["mode"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = base.get((result["pdf_file"], result["mode"]))
+        if old is None:
+            continue
+        name = f"{result['pdf_file']} ({result['mode']})"
+        speed = result["pages_per_sec"] / old["pages_per_sec"]
+        if speed < 1 - threshold:
+            regressions.append(
+                f"{name}: {old['pages_per_sec']} -> {result['pages_per_sec']} "
+                f"pages/sec ({speed - 1:+.0%})"
+            )
+        rss = result["peak_rss_mb"] / old["peak_rss_mb"]
+        if rss > 1 + threshold:
+            regressions.append(
+                f"{name}: {old['peak_rss_mb']} -> {result['peak_rss_mb']} "
+                f"MB peak RSS ({rss - 1:+.0%})"
+            )
+    return regressions
+
+
+def get_commit() -> Optional[str]:
+    try:
+        proc = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return proc.stdout.decode("utf-8").strip()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+        Benchmark pdftotree on PDFs for each table detection mode and report
+        pages/sec, time per stage and peak RSS as JSON.
+        """,
+        usage="%(prog)s [options] [pdf_file ...]",
+    )
+    parser.add_argument(
+        "pdf_files",
+        nargs="*",
+        help="PDF files to benchmark. Default is all PDF files in tests/input.",
+    )
+    parser.add_argument(
+        "--modes",
+        type=lambda s: s.split(","),
+        default=list(MODES),
+        help="Comma-separated table detection modes. Default is all of "
+        + ",".join(MODES)
+        + ". A mode is skipped if its model is not found.",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs per document, of which the fastest is kept. Default is 3.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="Path to output JSON file. If not given, it will be printed to stdout.",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        default=None,
+        help="Results of another run to compare with.",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Tolerated relative slow-down or memory growth against the baseline. "
+        "Default is 0.2.",
+    )
+    parser.add_argument("--run_one", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(*args.run_one)))
+        sys.exit(0)
+
+    unknown = [mode for mode in args.modes if mode not in MODES]
+    if unknown:
+        parser.error(f"Unknown mode(s): {', '.join(unknown)}.")
+    if args.repeat < 1:
+        parser.error("The number of runs must be at least 1.")
+    pdf_files = args.pdf_files or sorted(glob.glob(os.path.join(TESTDATA, "*.pdf")))
+
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "results": run_benchmarks(pdf_files, args.modes, args.repeat),
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report["results"], baseline["results"], args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -1,24 +1,41 @@
+import io
 import logging
+import math
 import os
+import pickle
 import tempfile
-from base64 import b64encode
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import cmp_to_key
-from typing import Any, Dict, List, Optional, Tuple
-from xml.dom.minidom import Document, Element
+from itertools import islice
+from typing import (
+    Any,
+    Counter,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import numpy as np
 import tabula
-from pdfminer.image import ImageWriter
-from pdfminer.layout import LAParams, LTChar, LTImage, LTPage, LTTextLine
+from pdfminer.layout import LAParams, LTChar, LTComponent, LTImage, LTTextLine
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
 from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfparser import PDFParser
-from pdfminer.utils import Plane
 
 from pdftotree._version import __version__
 from pdftotree.ml.features import get_lines_features, get_mentions_within_bbox
-from pdftotree.utils.bbox_utils import bbox2str, get_rectangles
+from pdftotree.utils.bbox_utils import bbox2str, get_rectangles, isContained
+from pdftotree.utils.cluster_utils import UnionFind
+from pdftotree.utils.hocr_utils import HOCRWriter
+from pdftotree.utils.image_utils import ImageExporter
 from pdftotree.utils.lines_utils import (
     extend_horizontal_lines,
     extend_vertical_lines,
@@ -27,20 +44,88 @@ from pdftotree.utils.lines_utils import (
     merge_vertical_lines,
     reorder_lines,
 )
-from pdftotree.utils.pdf.pdf_parsers import parse_layout, parse_tree_structure
-from pdftotree.utils.pdf.pdf_utils import CustomPDFPageAggregator, PDFElems
+from pdftotree.utils.pdf.grid import get_table_grid
+from pdftotree.utils.pdf.page_cache import PageCache
+from pdftotree.utils.pdf.pdf_parsers import (
+    MAX_BOXES,
+    parse_layout,
+    parse_tree_structure,
+)
+from pdftotree.utils.pdf.pdf_utils import (
+    CustomPDFPageAggregator,
+    PDFElems,
+    WordBoxes,
+    detach_elems,
+    dumps_elems,
+    get_word_boundaries,
+)
 from pdftotree.utils.pdf.vector_utils import column_order, reading_order
+from pdftotree.utils.profile_utils import Profiler, timer
+from pdftotree.utils.tabula_worker import TabulaWorker
 
 logger = logging.getLogger(__name__)
 
+TABLE_ENGINES = ["tabula", "native"]
+# Maximum number of pages interpreted at once by a worker process
+MAX_CHUNK_SIZE = 16
+
 
 class TreeExtractor(object):
     """
     Object to extract tree structure from pdf files
     """
 
-    def __init__(self, pdf_file):
+    def __init__(
+        self,
+        pdf_file,
+        jobs=1,
+        pages: Optional[Iterable[int]] = None,
+        cache: Optional[PageCache] = None,
+        low_memory=False,
+        profile=False,
+        max_boxes: Optional[int] = MAX_BOXES,
+        tabula_worker: Optional[TabulaWorker] = None,
+        table_engine="tabula",
+        image_dir: Optional[str] = None,
+        image_src_dir: Optional[str] = None,
+    ):
+        """
+        :param pdf_file: path to a PDF file
+        :param jobs: number of processes to interpret pages with
+        :param pages: 1-based numbers of the pages to extract, or None for all.
+            The other pages are never interpreted.
+        :param cache: a cache of normalized pages to load pages from instead of
+            interpreting them again. Its directory must be trusted, as entries are
+            unpickled.
+        :param low_memory: whether to keep only the words of each line of text and
+            release its chars once the page is normalized
+        :param profile: whether to time each stage of the pipeline per page, see
+            :attr:`profile`
+        :param max_boxes: number of text boxes on a page above which its layout is
+            not analyzed, or None for no limit
+        :param tabula_worker: a long-lived tabula worker to recognize tables with, or
+            None to run tabula in this process
+        :param table_engine: "tabula" to recognize the cells of tables with
+            tabula-java, or "native" to lay them out from the segments and text
+            alignments of the page in this process, see :meth:`get_native_tables`
+        :param image_dir: directory to write images into as files named by the hash
+            of their content, or None to embed them in base64
+        :param image_src_dir: path to image_dir as referred to by the ``src`` of
+            images, e.g. relative to the hOCR file. Defaults to image_dir.
+        """
+        if table_engine not in TABLE_ENGINES:
+            raise ValueError(
+                f"table_engine must be one of {TABLE_ENGINES}, not {table_engine!r}"
+            )
         self.pdf_file = pdf_file
+        self.jobs = jobs
+        self.pages: Optional[Set[int]] = None if pages is None else set(pages)
+        self.cache = cache
+        self.low_memory = low_memory
+        self.profiler: Optional[Profiler] = Profiler() if profile else None
+        self.max_boxes = max_boxes
+        self.tabula_worker = tabula_worker
+        self.table_engine = table_engine
         self.elems: Dict[int, PDFElems] = {}  # key represents page_num
         self.font_stats: Dict[int, Any] = {}  # key represents page_num
         self.iou_thresh = 0.8
@@ -48,36 +133,36 @@ class TreeExtractor(object):
         self.tree: Dict[
             int, Dict[str, Tuple[int, int, int, float, float, float, float]]
         ] = {}  # key represents page_num
+        self.images = ImageExporter(image_dir, image_src_dir)
+
+    @property
+    def profile(self) -> Optional[Dict[str, Any]]:
+        """Seconds spent in each stage per page, or None if profiling is disabled.
+
+        Stages are "interpret" (pdfminer and normalization, or loading from the
+        cache), "table_detection" (e.g. clustering vertically aligned boxes),
+        "tree_structure" (extracting text candidates and building the tree) and
+        "html", which includes "tabula" or "native_tables" (recognizing table cells)
+        and "images" (exporting images).
+        """
+        if self.profiler is None:
+            return None
+        return self.profiler.to_dict()
 
     def identify_scanned_page(self, boxes, page_bbox, page_width, page_height):
-        plane = Plane(page_bbox)
-        plane.extend(boxes)
-        # initialize clusters
-        cid2obj = [set([i]) for i in range(len(boxes))]
-        # default object map to cluster with its own index
-        obj2cid = list(range(len(boxes)))
-        prev_clusters = obj2cid
-        while True:
-            for i1, b1 in enumerate(boxes):
-                for i2, b2 in enumerate(boxes):
-                    box1 = b1.bbox
-                    box2 = b2.bbox
-                    if (
-                        box1[0] == box2[0]
-                        and box1[2] == box2[2]
-                        and round(box1[3]) == round(box2[1])
-                    ):
-                        min_i = min(i1, i2)
-                        max_i = max(i1, i2)
-                        cid1 = obj2cid[min_i]
-                        cid2 = obj2cid[max_i]
-                        for obj_iter in cid2obj[cid2]:
-                            cid2obj[cid1].add(obj_iter)
-                            obj2cid[obj_iter] = cid1
-                        cid2obj[cid2] = set()
-            if prev_clusters == obj2cid:
-                break
-            prev_clusters = obj2cid
+        # Cluster boxes stacked exactly on top of each other, i.e., with the same x0
+        # and x1 and the rounded y1 of one equal to the rounded y0 of the other,
+        # by looking up the boxes starting where each box ends.
+        starts: Dict[Tuple[float, float, int], List[int]] = defaultdict(list)
+        for i, box in enumerate(boxes):
+            x0, y0, x1, _ = box.bbox
+            starts[(x0, x1, round(y0))].append(i)
+        clustering = UnionFind(len(boxes))
+        for i1, box in enumerate(boxes):
+            x0, _, x1, y1 = box.bbox
+            for i2 in starts.get((x0, x1, round(y1)), []):
+                clustering.union(min(i1, i2), max(i1, i2))
+        cid2obj, _ = clustering.to_clusters()
         clusters = [[boxes[i] for i in cluster] for cluster in filter(bool, cid2obj)]
         if (
             len(clusters) == 1
@@ -89,67 +174,134 @@ class TreeExtractor(object):
             return True
         return False
 
-    def parse(self):
+    def _iter_elems(self) -> Iterator[Tuple[int, PDFElems, Counter]]:
+        """Interpret and normalize the pages of the document one at a time.
+
+        Pages are interpreted by a pool of ``self.jobs`` processes when it is more
+        than one, and are still yielded in order.
+        The scanned status of the document is updated as the pages go by and is
+        settled once all of them have been yielded.
+
+        :return: an iterator of (1-based page number, elems, font stat)
+        """
         is_scanned = False
         lin_seg_present = False
-        layouts: List[LTPage] = []
-
-        log = logging.getLogger(__name__)
-        # Open a PDF file.
-        with open(os.path.realpath(self.pdf_file), "rb") as fp:
-            # Create a PDF parser object associated with the file object.
-            parser = PDFParser(fp)
-            # Create a PDF document object that stores the document structure.
-            # Supply the password for initialization.
-            document = PDFDocument(parser, password="")
-            # Create a PDF resource manager object that stores shared resources.
-            rsrcmgr = PDFResourceManager()
-            # Set parameters for analysis.
-            laparams = LAParams(char_margin=1.0, word_margin=0.1, detect_vertical=True)
-            # Create a PDF page aggregator object.
-            device = CustomPDFPageAggregator(rsrcmgr, laparams=laparams)
-            # Create a PDF interpreter object.
-            interpreter = PDFPageInterpreter(rsrcmgr, device)
-            # Process each page contained in the document.
-            for page_num, page in enumerate(PDFPage.create_pages(document)):
-                try:
-                    interpreter.process_page(page)
-                except OverflowError as oe:
-                    log.exception(
-                        "{}, skipping page {} of {}".format(oe, page_num, self.pdf_file)
-                    )
-                    continue
-                layout = device.get_result()
-                layouts.append(layout)
 
-        for page_num, layout in enumerate(layouts):
-            page_num += 1  # indexes start at 1
-            elems, font_stat = device.normalize_pdf(layout, scaler=1)
-            self.elems[page_num] = elems
-            self.font_stats[page_num] = font_stat
+        if self.cache is not None:
+            pages = self._iter_elems_cached()
+        elif self.jobs > 1:
+            pages = self._iter_elems_parallel(self.get_page_nums())
+        else:
+            pages = _interpret_pages(self.pdf_file, self.pages, self.low_memory)
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                break
+            page_num, elems, font_stat = page
+            if self.profiler is not None:
+                # Time waited for the page when it is interpreted by another process
+                self.profiler.add("interpret", time.perf_counter() - start, page_num)
             # code to detect if the page is scanned
             if len(elems.segments) > 0:
                 lin_seg_present = True
-            for fig in elems.figures:
-                if (
-                    fig.bbox[0] <= 0.0
-                    and fig.bbox[1] <= 0.0
-                    and round(fig.bbox[2]) == round(elems.layout.width)
-                    and round(fig.bbox[3]) == round(elems.layout.height)
-                ):
-                    is_scanned = True
-            page_scanned = self.identify_scanned_page(
-                elems.figures,
-                elems.layout.bbox,
-                elems.layout.width,
-                elems.layout.height,
-            )
             # doc is scanned if any page is scanned
-            if page_scanned:
+            if self.is_scanned_page(elems):
                 is_scanned = True
+            yield page_num, elems, font_stat
+
         if is_scanned or not lin_seg_present:
             self.scanned = True
 
+    def _iter_elems_parallel(
+        self, page_nums: List[int]
+    ) -> Iterator[Tuple[int, PDFElems, Counter]]:
+        # A few chunks per process to even out the load between them, but small
+        # enough for the chunks in flight to bound memory
+        chunk_size = max(
+            1, min(MAX_CHUNK_SIZE, math.ceil(len(page_nums) / (self.jobs * 4)))
+        )
+        chunks = (
+            page_nums[i : i + chunk_size] for i in range(0, len(page_nums), chunk_size)
+        )
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+
+            def submit(chunk: List[int]) -> Future:
+                return executor.submit(
+                    _interpret_chunk, self.pdf_file, chunk, self.low_memory
+                )
+
+            # Only up to 2 chunks per process are in flight, and another is submitted
+            # as each one is yielded, so that finished chunks do not pile up while
+            # the consumer is behind.
+            futures: Deque[Future] = deque(map(submit, islice(chunks, 2 * self.jobs)))
+            while futures:
+                pages = pickle.loads(futures.popleft().result())
+                futures.extend(map(submit, islice(chunks, 1)))
+                yield from pages
+                del pages
+
+    def _iter_elems_cached(self) -> Iterator[Tuple[int, PDFElems, Counter]]:
+        """Load pages from the cache and interpret (then cache) only missing ones."""
+        key = self.cache.get_key(self.pdf_file, get_laparams(), self.low_memory)
+        page_nums = self.get_page_nums()
+        missing = {p for p in page_nums if not self.cache.contains(key, p)}
+        logger.info(f"{len(page_nums) - len(missing)} page(s) found in the cache.")
+        if self.jobs > 1 and len(missing) > 1:
+            interpreted = self._iter_elems_parallel(sorted(missing))
+        else:
+            interpreted = _interpret_pages(self.pdf_file, missing, self.low_memory)
+        pending = next(interpreted, None)
+        for page_num in page_nums:
+            if pending is not None and pending[0] == page_num:
+                _, elems, font_stat = pending
+                yield (page_num,) + self.cache.put(key, page_num, elems, font_stat)
+                pending = next(interpreted, None)
+                continue
+            if page_num in missing:
+                continue  # failed to be interpreted
+            entry = self.cache.get(key, page_num)
+            if entry is None:  # evicted in the meantime
+                for _, elems, font_stat in _interpret_pages(
+                    self.pdf_file, {page_num}, self.low_memory
+                ):
+                    entry = self.cache.put(key, page_num, elems, font_stat)
+            if entry is not None:
+                yield (page_num,) + entry
+
+    def is_scanned_page(self, elems: PDFElems) -> bool:
+        for fig in elems.figures:
+            if (
+                fig.bbox[0] <= 0.0
+                and fig.bbox[1] <= 0.0
+                and round(fig.bbox[2]) == round(elems.layout.width)
+                and round(fig.bbox[3]) == round(elems.layout.height)
+            ):
+                return True
+        return self.identify_scanned_page(
+            elems.figures,
+            elems.layout.bbox,
+            elems.layout.width,
+            elems.layout.height,
+        )
+
+    def parse(self):
+        for page_num, elems, font_stat in self._iter_elems():
+            self.elems[page_num] = elems
+            self.font_stats[page_num] = font_stat
+
+    def get_page_nums(self) -> List[int]:
+        """List the 1-based numbers of the pages to extract without interpreting
+        them."""
+        with open(os.path.realpath(self.pdf_file), "rb") as fp:
+            document = PDFDocument(PDFParser(fp), password="")
+            num_pages = sum(1 for _ in PDFPage.create_pages(document))
+        return [
+            page_num
+            for page_num in range(1, num_pages + 1)
+            if self.pages is None or page_num in self.pages
+        ]
+
     def is_scanned(self):
         if len(self.elems) == 0:
             self.parse()
@@ -200,7 +352,7 @@ class TreeExtractor(object):
         page_height = int(elems.layout.height)
         font_stat = self.font_stats[page_num]
         try:
-            nodes, features = parse_layout(elems, font_stat)
+            nodes, features = parse_layout(elems, font_stat, max_boxes=self.max_boxes)
         except Exception as e:
             logger.exception(e)
             nodes, features = [], []
@@ -220,147 +372,216 @@ class TreeExtractor(object):
         return self.font_stats
 
     def get_tree_structure(self, model_type, model) -> Dict[str, Any]:
-        tables: Dict[int, List[Tuple(int, int, int, float, float, float, float)]] = {}
+        # Manage References - indicator to indicate if reference has been seen
+        ref_page_seen = False
+        for page_num in self.elems.keys():
+            # Get Tree Structure for this page
+            self.tree[page_num], ref_page_seen = self.get_tree_structure_page(
+                page_num, model_type, model, ref_page_seen
+            )
+        return self.tree
+
+    def get_tree_structure_page(
+        self, page_num: int, model_type, model, ref_page_seen: bool
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Build the tree structure of a single page.
+
+        :param page_num: 1-based page number
+        :param ref_page_seen: whether references have been seen on previous pages
+        :return: the tree of this page and the updated ref_page_seen
+        """
+        with timer(self.profiler, "table_detection", page_num):
+            tables_page = self.get_tables_page(page_num, model_type, model)
+        with timer(self.profiler, "tree_structure", page_num):
+            return parse_tree_structure(
+                self.elems[page_num],
+                self.font_stats[page_num],
+                page_num,
+                ref_page_seen,
+                tables_page,
+                self.max_boxes,
+            )
+
+    def get_tables_page(
+        self, page_num: int, model_type, model
+    ) -> List[Tuple[int, int, int, float, float, float, float]]:
         # use vision to get tables
         if model_type == "vision":
             from pdftotree.visual.visual_utils import get_bboxes, predict_heatmap
 
-            for page_num in self.elems.keys():
-                page_width = int(self.elems[page_num].layout.width)
-                page_height = int(self.elems[page_num].layout.height)
-                image, pred = predict_heatmap(
-                    self.pdf_file, page_num - 1, model
-                )  # index start at 0 with wand
-                bboxes, _ = get_bboxes(image, pred)
-                tables[page_num] = [
-                    (page_num, page_width, page_height)
-                    + (top, left, top + height, left + width)
-                    for (left, top, width, height) in bboxes
-                ]
+            page_width = int(self.elems[page_num].layout.width)
+            page_height = int(self.elems[page_num].layout.height)
+            image, pred = predict_heatmap(
+                self.pdf_file, page_num - 1, model
+            )  # index start at 0 with wand
+            bboxes, _ = get_bboxes(image, pred)
+            return [
+                (page_num, page_width, page_height)
+                + (top, left, top + height, left + width)
+                for (left, top, width, height) in bboxes
+            ]
 
         # use ML to get tables
         elif model_type == "ml":
-            for page_num in self.elems.keys():
-                t_cands, cand_feats = self.get_candidates_and_features_page_num(
-                    page_num
-                )
-                tables[page_num] = []
-                if len(cand_feats) != 0:
-                    table_predictions = model.predict(cand_feats)
-                    tables[page_num] = [
-                        t_cands[i]
-                        for i in range(len(t_cands))
-                        if table_predictions[i] > 0.5
-                    ]
+            t_cands, cand_feats = self.get_candidates_and_features_page_num(page_num)
+            if len(cand_feats) == 0:
+                return []
+            table_predictions = model.predict(cand_feats)
+            return [
+                t_cands[i] for i in range(len(t_cands)) if table_predictions[i] > 0.5
+            ]
 
         # use heuristics to get tables if no model_type is provided
         else:
-            for page_num in self.elems.keys():
-                tables[page_num] = self.get_tables_page_num(page_num)
+            return self.get_tables_page_num(page_num)
 
-        # Manage References - indicator to indicate if reference has been seen
+    def iter_pages(self, model_type=None, model=None) -> Iterator[str]:
+        """Yield the hOCR ``ocr_page`` of each page, one page at a time.
+
+        Each page is interpreted, normalized, structured and converted before the
+        next one is read, and its pdfminer objects are released once its
+        ``ocr_page`` is yielded. Memory thus stays flat whatever the page count.
+        Only the (small) tree of each page is kept in ``self.tree``.
+
+        :param model_type: "vision", "ml", or None for heuristics
+        :param model: a model loaded by :func:`pdftotree.core.load_model`
+        :return: an iterator of serialized ``ocr_page`` elements
+        """
         ref_page_seen = False
-        for page_num in self.elems.keys():
-            # Get Tree Structure for this page
-            self.tree[page_num], ref_page_seen = parse_tree_structure(
-                self.elems[page_num],
-                self.font_stats[page_num],
-                page_num,
-                ref_page_seen,
-                tables[page_num],
+        for page_num, elems, font_stat in self._iter_elems():
+            self.elems[page_num] = elems
+            self.font_stats[page_num] = font_stat
+            self.tree[page_num], ref_page_seen = self.get_tree_structure_page(
+                page_num, model_type, model, ref_page_seen
+            )
+            with timer(self.profiler, "html", page_num):
+                page = self.get_html_page(page_num)
+            del self.elems[page_num]
+            del self.font_stats[page_num]
+            yield page
+
+    def iter_hocr(self, model_type=None, model=None) -> Iterator[str]:
+        """Yield a whole hOCR document in chunks, one ``ocr_page`` at a time.
+
+        Concatenating the chunks gives the same document as
+        :meth:`get_html_tree`. Pages that fail to be interpreted are skipped, so
+        the number of pages in the head is only known once every page is
+        converted: until then, pages are spooled to a temporary file rather than
+        kept in memory. Use :meth:`iter_pages` to get each page as soon as it is
+        converted.
+        """
+        with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as spool:
+            lengths = []
+            for page in self.iter_pages(model_type, model):
+                spool.write(page)
+                lengths.append(len(page))
+            spool.seek(0)
+            yield from self._iter_html(
+                (spool.read(length) for length in lengths), len(lengths)
             )
-        return self.tree
 
     def get_html_tree(self) -> str:
-        # Create a temp folder where images are temporarily saved.
-        dirname = tempfile.mkdtemp()
-        imagewriter = ImageWriter(dirname)
-
-        doc = Document()
-        self.doc = doc
-        html = doc.createElement("html")
-        doc.appendChild(html)
-        head = doc.createElement("head")
-        html.appendChild(head)
-        # meta
-        meta = doc.createElement("meta")
-        head.appendChild(meta)
-        meta.setAttribute("name", "ocr-system")
-        meta.setAttribute("content", f"Converted from PDF by pdftotree {__version__}")
-        meta = doc.createElement("meta")
-        head.appendChild(meta)
-        meta.setAttribute("name", "ocr-capabilities")
-        meta.setAttribute(
-            "content", "ocr_page ocr_table ocrx_block ocrx_line ocrx_word"
-        )
-        meta = doc.createElement("meta")
-        head.appendChild(meta)
-        meta.setAttribute("name", "ocr-number-of-pages")
-        meta.setAttribute("content", f"{len(self.elems.keys())}")
-        # body
-        body = doc.createElement("body")
-        html.appendChild(body)
-        for page_num in self.elems.keys():  # 1-based
-            boxes: List[Tuple[str, float, float, float, float]] = []
-            for clust in self.tree[page_num]:
-                for (pnum, pwidth, pheight, top, left, bottom, right) in self.tree[
-                    page_num
-                ][clust]:
-                    boxes += [
-                        (clust.lower().replace(" ", "_"), top, left, bottom, right)
-                    ]
-            page = doc.createElement("div")
-            page.setAttribute("class", "ocr_page")
-            page.setAttribute("id", f"page_{page_num}")
-            width = int(self.elems[page_num].layout.width)
-            height = int(self.elems[page_num].layout.height)
-            page.setAttribute(
-                "title",
-                f"bbox 0 0 {width} {height}; ppageno {page_num-1}",
+        pages = (self._get_html_page_timed(page_num) for page_num in self.elems.keys())
+        return "".join(self._iter_html(pages, len(self.elems)))
+
+    def _get_html_page_timed(self, page_num: int) -> str:
+        with timer(self.profiler, "html", page_num):
+            return self.get_html_page(page_num)
+
+    def _iter_html(self, pages: Iterable[str], num_pages: int) -> Iterator[str]:
+        out = io.StringIO()
+        hocr = HOCRWriter(out, depth=1)
+        with hocr.element("head", {}):
+            hocr.empty_element(
+                "meta",
+                {
+                    "name": "ocr-system",
+                    "content": f"Converted from PDF by pdftotree {__version__}",
+                },
             )
-            body.appendChild(page)
-            # TODO: We need to detect columns and sort acccordingly.
-            boxes.sort(key=cmp_to_key(column_order))
-
-            for box in boxes:
-                if box[0] == "table":
-                    table = box[1:]  # bbox
-                    table_element = self.get_html_table(table, page_num)
-                    page.appendChild(table_element)
-                elif box[0] == "figure":
-                    elems: List[LTTextLine] = get_mentions_within_bbox(
-                        box, self.elems[page_num].figures
-                    )
-                    fig_element = doc.createElement("figure")
-                    page.appendChild(fig_element)
-                    top, left, bottom, right = [int(i) for i in box[1:]]
-                    fig_element.setAttribute(
-                        "title", f"bbox {left} {top} {right} {bottom}"
-                    )
-                    for img in [img for elem in elems for img in elem]:
-                        if not isinstance(img, LTImage):
-                            continue
-                        filename = imagewriter.export_image(img)
-                        with open(os.path.join(dirname, filename), "rb") as f:
-                            base64 = b64encode(f.read()).decode("ascii")
-                        if filename.endswith("jpg"):
-                            mediatype = "jpeg"
-                        elif filename.endswith("bmp"):
-                            mediatype = "bmp"
-                        else:
-                            logger.info(f"Skipping an unknown type image: {filename}.")
-                            continue
-                        logger.info(f"Embedding a known type image: {filename}.")
-                        img_element = doc.createElement("img")
-                        fig_element.appendChild(img_element)
-                        img_element.setAttribute("title", bbox2str(img.bbox))
-                        img_element.setAttribute(
-                            "src", f"data:image/{mediatype};base64,{base64}"
-                        )
-                else:
-                    element = self.get_html_others(box[0], box[1:], page_num)
-                    page.appendChild(element)
-        return doc.toprettyxml()
+            hocr.empty_element(
+                "meta",
+                {
+                    "name": "ocr-capabilities",
+                    "content": "ocr_page ocr_table ocrx_block ocrx_line ocrx_word",
+                },
+            )
+            hocr.empty_element(
+                "meta", {"name": "ocr-number-of-pages", "content": f"{num_pages}"}
+            )
+        yield '<?xml version="1.0" ?>\n<html>\n'
+        yield out.getvalue()
+        # body
+        yield "\t<body>\n"
+        yield from pages
+        yield "\t</body>\n</html>\n"
+
+    def get_html_page(self, page_num: int) -> str:
+        """Serialize the ``ocr_page`` of a page.
+
+        :param page_num: 1-based page number
+        :return: hOCR of the page, indented as in the whole document
+        """
+        out = io.StringIO()
+        self.write_html_page(HOCRWriter(out, depth=2), page_num)
+        return out.getvalue()
+
+    def write_html_page(self, hocr: HOCRWriter, page_num: int) -> None:
+        """Write the ``ocr_page`` of a page.
+
+        :param hocr: writer to write the page to
+        :param page_num: 1-based page number
+        """
+        boxes: List[Tuple[str, float, float, float, float]] = []
+        for clust in self.tree[page_num]:
+            for (pnum, pwidth, pheight, top, left, bottom, right) in self.tree[
+                page_num
+            ][clust]:
+                boxes += [(clust.lower().replace(" ", "_"), top, left, bottom, right)]
+        width = int(self.elems[page_num].layout.width)
+        height = int(self.elems[page_num].layout.height)
+        hocr.start(
+            "div",
+            {
+                "class": "ocr_page",
+                "id": f"page_{page_num}",
+                "title": f"bbox 0 0 {width} {height}; ppageno {page_num-1}",
+            },
+        )
+        # TODO: We need to detect columns and sort acccordingly.
+        boxes.sort(key=cmp_to_key(column_order))
+
+        # Recognize all the tables of the page at once
+        areas = [box[1:] for box in boxes if box[0] == "table"]
+        if self.table_engine == "native":
+            tables = iter(self.get_native_tables(page_num, areas))
+        else:
+            tables = iter(self.get_tabula_tables(page_num, areas))
+        for box in boxes:
+            if box[0] == "table":
+                self.write_html_table(hocr, next(tables), page_num)
+            elif box[0] == "figure":
+                elems: List[LTTextLine] = get_mentions_within_bbox(
+                    box,
+                    self.elems[page_num].figures,
+                    self.elems[page_num].figure_centroids,
+                )
+                top, left, bottom, right = [int(i) for i in box[1:]]
+                hocr.start("figure", {"title": f"bbox {left} {top} {right} {bottom}"})
+                for img in [img for elem in elems for img in elem]:
+                    if not isinstance(img, LTImage):
+                        continue
+                    with timer(self.profiler, "images", page_num):
+                        ext, src = self.images.export(img)
+                    if src is None:
+                        logger.info(f"Skipping an unknown type image: {img.name}{ext}.")
+                        continue
+                    logger.info(f"Embedding a known type image: {img.name}{ext}.")
+                    hocr.empty_element("img", {"title": bbox2str(img.bbox), "src": src})
+                hocr.end()
+            else:
+                self.write_html_others(hocr, box[0], box[1:], page_num)
+        hocr.end()
 
     def get_word_boundaries(
         self, mention: LTTextLine
@@ -370,35 +591,12 @@ class TreeExtractor(object):
         :param mention: a line of text
         :return: a list of words
         """
-        mention_text = mention.get_text()
-        mention_chars: List[Tuple[str, int, int, int, int]] = []
-        for obj in mention:
-            if isinstance(obj, LTChar):
-                x0, y0, x1, y1 = obj.bbox
-                mention_chars.append([obj.get_text(), y0, x0, y1, x1])
-        words = []
-        mention_words: List[str] = mention_text.split()  # word split by " " (space)
-        char_idx = 0
-        for word in mention_words:
-            curr_word = [word, float("Inf"), float("Inf"), float("-Inf"), float("-Inf")]
-            len_idx = 0
-            while len_idx < len(word):
-                char: str = mention_chars[char_idx][0]
-                if char in [" ", "\xa0"]:
-                    char_idx += 1
-                    continue
-                if word[len_idx : len_idx + len(char)] != char:
-                    logger.warning(
-                        "Out of order ({}, {})".format(word, mention_chars[char_idx][0])
-                    )
-                curr_word[1] = min(curr_word[1], mention_chars[char_idx][1])
-                curr_word[2] = min(curr_word[2], mention_chars[char_idx][2])
-                curr_word[3] = max(curr_word[3], mention_chars[char_idx][3])
-                curr_word[4] = max(curr_word[4], mention_chars[char_idx][4])
-                len_idx += len(mention_chars[char_idx][0])
-                char_idx += 1
-            words.append(curr_word)
-        return words
+        words: Optional[WordBoxes] = getattr(mention, "words", None)
+        if words is not None:  # precomputed in low-memory mode
+            return [
+                [text] + bbox for text, bbox in zip(words.texts, words.bbox.tolist())
+            ]
+        return get_word_boundaries(mention)
 
     def get_char_boundaries(self, mention):
         #  mention_text = mention.get_text()
@@ -409,64 +607,151 @@ class TreeExtractor(object):
                 mention_chars.append([obj.get_text(), y0, x0, y1, x1])
         return mention_chars
 
-    def get_html_others(self, tag: str, box: List[float], page_num: int) -> Element:
-        element = self.doc.createElement("div")
-        element.setAttribute("class", "ocrx_block")
-        element.setAttribute("pdftotree", tag)  # for backward-compatibility
+    def write_html_others(
+        self, hocr: HOCRWriter, tag: str, box: List[float], page_num: int
+    ) -> None:
+        """Write an ``ocrx_block`` of the lines of text within a box.
+
+        :param hocr: writer to write the block to
+        :param tag: type of the block, e.g. "paragraph"
+        :param box: bbox of the block (top, left, bottom, right)
+        :param page_num: 1-based page number
+        """
         top, left, bottom, right = [int(x) for x in box]
-        element.setAttribute("title", f"bbox {left} {top} {right} {bottom}")
+        hocr.start(
+            "div",
+            {
+                "class": "ocrx_block",
+                "pdftotree": tag,  # for backward-compatibility
+                "title": f"bbox {left} {top} {right} {bottom}",
+            },
+        )
         elems: List[LTTextLine] = get_mentions_within_bbox(
-            box, self.elems[page_num].mentions
+            box, self.elems[page_num].mentions, self.elems[page_num].mention_centroids
         )
         elems.sort(key=cmp_to_key(reading_order))
         for elem in elems:
-            line_element = self.doc.createElement("span")
-            element.appendChild(line_element)
-            line_element.setAttribute("class", "ocrx_line")
-            line_element.setAttribute("title", bbox2str(elem.bbox))
-            words = self.get_word_boundaries(elem)
-            for word in words:
-                top, left, bottom, right = [int(x) for x in word[1:]]
+            self._write_html_line(hocr, elem)
+        hocr.end()
 
-                word_element = self.doc.createElement("span")
-                line_element.appendChild(word_element)
-                word_element.setAttribute("class", "ocrx_word")
-                word_element.setAttribute(
-                    "title", f"bbox {left} {top} {right} {bottom}"
+    def _write_html_line(self, hocr: HOCRWriter, elem: LTTextLine) -> None:
+        """Write an ``ocrx_line`` and its words."""
+        with hocr.element("span", {"class": "ocrx_line", "title": bbox2str(elem.bbox)}):
+            for word in self.get_word_boundaries(elem):
+                top, left, bottom, right = [int(x) for x in word[1:]]
+                # No need to escape text here as the writer will do.
+                hocr.text_element(
+                    "span",
+                    {
+                        "class": "ocrx_word",
+                        "title": f"bbox {left} {top} {right} {bottom}",
+                    },
+                    word[0],
                 )
-                # No need to escape text here as minidom will do.
-                word_element.appendChild(self.doc.createTextNode(word[0]))
-        return element
 
-    def get_html_table(self, table: List[float], page_num) -> Optional[Element]:
-        """Recognize a table using tabula and return a DOM element.
+    def get_tabula_tables(
+        self, page_num: int, areas: List[Tuple[float, float, float, float]]
+    ) -> List[Optional[Dict[str, Any]]]:
+        """Recognize the tables in areas of a page with a single call to tabula.
 
-        :param table: bbox for a table (top,left,bottom,right)
         :param page_num: 1-based page number
-        :return: DOM element for a table
+        :param areas: bbox of each table (top,left,bottom,right)
+        :return: the JSON of the table recognized by tabula in each area, or None
+            if it recognizes none
         """
-        logger.debug(f"Calling tabula at page: {page_num} and area: {table}.")
+        if len(areas) == 0:
+            return []
+        logger.debug(f"Calling tabula at page: {page_num} and areas: {areas}.")
         loglevel = logging.getLogger("pdftotree").getEffectiveLevel()
-        table_json = tabula.read_pdf(
-            self.pdf_file,
-            pages=page_num,
-            area=table,
-            output_format="json",
-            silent=False if loglevel <= logging.DEBUG else True,
-        )
+        silent = False if loglevel <= logging.DEBUG else True
+        with timer(self.profiler, "tabula", page_num):
+            if self.tabula_worker is None:
+                table_json = tabula.read_pdf(
+                    self.pdf_file,
+                    pages=page_num,
+                    area=[list(area) for area in areas],
+                    output_format="json",
+                    silent=silent,
+                )
+            else:
+                table_json = self.tabula_worker.read_pdf(
+                    self.pdf_file,
+                    page_num,
+                    [[float(x) for x in area] for area in areas],
+                    silent,
+                )
         logger.debug(f"Tabula recognized {len(table_json)} table(s).")
-        if len(table_json) == 0:
-            return None
-        table_element = self.doc.createElement("table")
-        table_element.setAttribute("class", "ocr_table")
-        top = int(table_json[0]["top"])
-        left = int(table_json[0]["left"])
-        bottom = int(table_json[0]["bottom"])
-        right = int(table_json[0]["right"])
-        table_element.setAttribute("title", f"bbox {left} {top} {right} {bottom}")
-        for i, row in enumerate(table_json[0]["data"]):
-            row_element = self.doc.createElement("tr")
-            table_element.appendChild(row_element)
+        return _match_tables(areas, table_json)
+
+    def get_native_tables(
+        self, page_num: int, areas: List[Tuple[float, float, float, float]]
+    ) -> List[Optional[Dict[str, Any]]]:
+        """Recognize the tables in areas of a page from its segments and text.
+
+        Each table is laid out as a grid by
+        :func:`pdftotree.utils.pdf.grid.get_table_grid` over its area, widened to
+        the text found in it. The JSON has the fields of tabula's, along with the
+        rowspan, colspan and mentions of each cell.
+
+        :param page_num: 1-based page number
+        :param areas: bbox of each table (top,left,bottom,right)
+        :return: the JSON of the table in each area, or None if it has no text
+        """
+        elems = self.elems[page_num]
+        tables: List[Optional[Dict[str, Any]]] = []
+        with timer(self.profiler, "native_tables", page_num):
+            for area in areas:
+                mentions = get_mentions_within_bbox(
+                    area, elems.mentions, elems.mention_centroids
+                )
+                if len(mentions) == 0:
+                    tables.append(None)
+                    continue
+                top, left, bottom, right = area
+                region = LTComponent(
+                    (
+                        min([left] + [m.x0 for m in mentions]),
+                        min([top] + [m.y0 for m in mentions]),
+                        max([right] + [m.x1 for m in mentions]),
+                        max([bottom] + [m.y1 for m in mentions]),
+                    )
+                )
+                segments = [
+                    s
+                    for s in elems.segments
+                    if s.x1 >= region.x0
+                    and s.x0 <= region.x1
+                    and s.y1 >= region.y0
+                    and s.y0 <= region.y1
+                ]
+                grid = get_table_grid(mentions, segments, region)
+                tables.append(None if grid is None else grid.to_json())
+        return tables
+
+    def write_html_table(
+        self, hocr: HOCRWriter, table_json: Optional[Dict[str, Any]], page_num: int
+    ) -> bool:
+        """Write a table recognized by tabula as an ``ocr_table``.
+
+        :param hocr: writer to write the table to
+        :param table_json: a table recognized by :meth:`get_tabula_tables` or
+            :meth:`get_native_tables`
+        :param page_num: 1-based page number
+        :return: False if tabula recognized no table, in which case nothing is
+            written
+        """
+        if table_json is None:
+            return False
+        top = int(table_json["top"])
+        left = int(table_json["left"])
+        bottom = int(table_json["bottom"])
+        right = int(table_json["right"])
+        hocr.start(
+            "table",
+            {"class": "ocr_table", "title": f"bbox {left} {top} {right} {bottom}"},
+        )
+        for i, row in enumerate(table_json["data"]):
+            hocr.start("tr", {})
             for j, cell in enumerate(row):
                 # It is not explicitly stated anywhere but tabula seems to use the cell
                 # bbox to represent that of cell itself rather than that of text inside.
@@ -477,34 +762,130 @@ class TreeExtractor(object):
                     cell["top"] + cell["height"],
                     cell["left"] + cell["width"],
                 ]
-                cell_element = self.doc.createElement("td")
-                row_element.appendChild(cell_element)
-                elems = get_mentions_within_bbox(box, self.elems[page_num].mentions)
+                if "mentions" in cell:
+                    elems = list(cell["mentions"])
+                else:
+                    elems = get_mentions_within_bbox(
+                        box,
+                        self.elems[page_num].mentions,
+                        self.elems[page_num].mention_centroids,
+                    )
+                spans = {
+                    name: str(cell[name])
+                    for name in ["rowspan", "colspan"]
+                    if cell.get(name, 1) > 1
+                }
                 if len(elems) == 0:
+                    hocr.empty_element("td", spans)
                     continue
-                cell_element.setAttribute(
-                    "title",
-                    f"bbox {int(box[1])} {int(box[0])} {int(box[3])} {int(box[2])}",
+                hocr.start(
+                    "td",
+                    {
+                        "title": f"bbox {int(box[1])} {int(box[0])} "
+                        f"{int(box[3])} {int(box[2])}",
+                        **spans,
+                    },
                 )
                 elems.sort(key=cmp_to_key(reading_order))
                 for elem in elems:
-                    line_element = self.doc.createElement("span")
-                    cell_element.appendChild(line_element)
-                    line_element.setAttribute("class", "ocrx_line")
-                    line_element.setAttribute("title", bbox2str(elem.bbox))
-                    words = self.get_word_boundaries(elem)
-                    for word in words:
-                        top = int(word[1])
-                        left = int(word[2])
-                        bottom = int(word[3])
-                        right = int(word[4])
-
-                        word_element = self.doc.createElement("span")
-                        line_element.appendChild(word_element)
-                        word_element.setAttribute("class", "ocrx_word")
-                        word_element.setAttribute(
-                            "title", f"bbox {left} {top} {right} {bottom}"
-                        )
-                        # No need to escape text here as minidom will do.
-                        word_element.appendChild(self.doc.createTextNode(word[0]))
-        return table_element
+                    self._write_html_line(hocr, elem)
+                hocr.end()
+            hocr.end()
+        hocr.end()
+        return True
+
+
+def _match_tables(
+    areas: List[Tuple[float, float, float, float]], tables: List[Dict[str, Any]]
+) -> List[Optional[Dict[str, Any]]]:
+    """Map the tables recognized by tabula in several areas back to the areas.
+
+    Tabula lists the tables area by area, none or several per area, so each table
+    goes to the first area containing it from that of the previous table on,
+    preferably one without a table yet as areas may overlap. The first table of
+    each area is kept, as when tabula is given one area.
+
+    :param areas: bbox of each area (top,left,bottom,right)
+    :param tables: JSON of the tables recognized by tabula
+    :return: the first table recognized in each area, or None
+    """
+    if len(areas) == 1:
+        return [tables[0] if tables else None]
+    matched: List[Optional[Dict[str, Any]]] = [None] * len(areas)
+    k = 0
+    for table in tables:
+        bbox = (table["top"], table["left"], table["bottom"], table["right"])
+        found = [j for j in range(k, len(areas)) if isContained(bbox, areas[j])]
+        if not found:
+            continue
+        k = next((j for j in found if matched[j] is None), found[0])
+        if matched[k] is None:
+            matched[k] = table
+    return matched
+
+
+def get_laparams() -> LAParams:
+    """Parameters for layout analysis."""
+    return LAParams(char_margin=1.0, word_margin=0.1, detect_vertical=True)
+
+
+def _interpret_pages(
+    pdf_file, page_nums: Optional[Set[int]] = None, low_memory=False
+) -> Iterator[Tuple[int, PDFElems, Counter]]:
+    """Interpret and normalize the pages of a PDF file one at a time.
+
+    :param pdf_file: path to a PDF file
+    :param page_nums: 1-based numbers of the pages to interpret, or None for all
+    :return: an iterator of (1-based page number, elems, font stat)
+    """
+    # Open a PDF file.
+    with open(os.path.realpath(pdf_file), "rb") as fp:
+        # Create a PDF parser object associated with the file object.
+        parser = PDFParser(fp)
+        # Create a PDF document object that stores the document structure.
+        # Supply the password for initialization.
+        document = PDFDocument(parser, password="")
+        # Create a PDF resource manager object that stores shared resources.
+        rsrcmgr = PDFResourceManager()
+        # Create a PDF page aggregator object.
+        device = CustomPDFPageAggregator(rsrcmgr, laparams=get_laparams())
+        # Create a PDF interpreter object.
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        # Process each page contained in the document.
+        last_page_num = None if page_nums is None else max(page_nums, default=0)
+        for page_num, page in enumerate(PDFPage.create_pages(document), start=1):
+            if page_nums is not None and page_num not in page_nums:
+                if page_num > last_page_num:
+                    break
+                continue
+            try:
+                interpreter.process_page(page)
+            except OverflowError as oe:
+                logger.exception(
+                    "{}, skipping page {} of {}".format(oe, page_num, pdf_file)
+                )
+                continue
+            layout = device.get_result()
+            elems, font_stat = device.normalize_pdf(
+                layout, scaler=1, low_memory=low_memory
+            )
+            yield page_num, elems, font_stat
+
+
+def _interpret_chunk(pdf_file, page_nums: List[int], low_memory=False) -> bytes:
+    """Interpret a chunk of pages in a worker process.
+
+    The PDF file is opened by the worker itself and the results are detached from
+    it so that they can be sent back to the parent process.
+
+    :return: the list of (1-based page number, elems, font stat), pickled by
+        :func:`dumps_elems`
+    """
+    return dumps_elems(
+        [
+            (page_num, detach_elems(elems), font_stat)
+            for page_num, elems, font_stat in _interpret_pages(
+                pdf_file, set(page_nums), low_memory
+            )
+        ]
+    )
@@ -3,9 +3,9 @@
 import logging
 
 from pdftotree._version import __version__
-from pdftotree.core import parse
+from pdftotree.core import parse, parse_iter, probe_scanned
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
-__all__ = ["__version__", "parse"]
+__all__ = ["__version__", "parse", "parse_iter", "probe_scanned"]
@@ -0,0 +1,214 @@
+"""
+Convert a corpus of PDF documents into hOCR with a pool of worker processes.
+
+Each worker loads the table detection model once and converts many documents.
+Outputs are written atomically and the status and duration of each document are
+appended to a manifest, so that an interrupted run resumes where it left off.
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+from functools import partial
+from multiprocessing import Pool
+from typing import Any, Dict, Iterable, List, NamedTuple
+
+from pdftotree.core import load_model, parse_iter
+
+logger = logging.getLogger(__name__)
+
+# The model loaded by each worker process
+_model = None
+
+
+class Task(NamedTuple):
+    pdf_file: str
+    html_path: str
+
+
+def find_tasks(input_path: str, output_dir: str) -> List[Task]:
+    """
+    List the documents to convert and where to write them.
+
+    :param input_path: a directory searched recursively for PDF files, or a file
+        listing the paths of PDF files one per line
+    :param output_dir: directory to write hOCR files in, mirroring the directory
+        layout of the inputs
+    """
+    if os.path.isdir(input_path):
+        pdf_files = []
+        for dirpath, _, filenames in os.walk(input_path):
+            for filename in filenames:
+                if filename.lower().endswith(".pdf"):
+                    pdf_files.append(os.path.join(dirpath, filename))
+        pdf_files.sort()
+        root = input_path
+    else:
+        with open(input_path) as f:
+            pdf_files = [line.strip() for line in f if line.strip()]
+        if not pdf_files:
+            return []
+        root = os.path.commonpath(
+            [os.path.dirname(os.path.abspath(pdf_file)) for pdf_file in pdf_files]
+        )
+    return [
+        Task(
+            pdf_file,
+            os.path.join(
+                output_dir,
+                os.path.splitext(os.path.relpath(os.path.abspath(pdf_file), root))[0]
+                + ".html",
+            ),
+        )
+        for pdf_file in pdf_files
+    ]
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict[str, Any]]:
+    """Load the latest record of each document from a manifest, if any."""
+    records: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:  # partially written when a run was killed
+                continue
+            records[record["pdf_file"]] = record
+    return records
+
+
+def run_batch(
+    tasks: Iterable[Task],
+    manifest_path: str,
+    model_type=None,
+    model_path=None,
+    workers=1,
+    cache_dir=None,
+    low_memory=False,
+    persistent_tabula=False,
+    table_engine="tabula",
+    image_dir=None,
+) -> List[Dict[str, Any]]:
+    """
+    Convert documents, skipping those already converted according to the manifest.
+
+    :param tasks: documents to convert and where to write them
+    :param manifest_path: JSON lines file recording a status per document
+    :param model_type: "vision", "ml", or None for heuristics
+    :param model_path: path to a pretrained model for model_type
+    :param workers: number of worker processes
+    :param cache_dir: directory to cache normalized pages in, or None not to cache.
+        It must be trusted, as cached pages are unpickled.
+    :param low_memory: whether to release chars once words are computed
+    :param persistent_tabula: whether to recognize tables in a long-lived tabula
+        worker per worker process
+    :param table_engine: "tabula" to recognize the cells of tables with tabula-java,
+        or "native" to lay them out from the segments and text of the page
+    :param image_dir: directory to write the images of all documents into,
+        deduplicated by content, or None to embed them in base64
+    :return: the records of the documents converted in this run
+    """
+    done = load_manifest(manifest_path)
+    pending = [
+        task
+        for task in tasks
+        if done.get(task.pdf_file, {}).get("status") != "ok"
+        or not os.path.exists(task.html_path)
+    ]
+    logger.info(f"{len(pending)} document(s) to convert.")
+    convert = partial(
+        _convert,
+        model_type=model_type,
+        cache_dir=cache_dir,
+        low_memory=low_memory,
+        persistent_tabula=persistent_tabula,
+        table_engine=table_engine,
+        image_dir=image_dir,
+    )
+
+    records = []
+    with open(manifest_path, "a") as manifest:
+
+        def record(result: Dict[str, Any]):
+            manifest.write(json.dumps(result) + "\n")
+            manifest.flush()
+            records.append(result)
+            logger.info(
+                f"{result['status']}: {result['pdf_file']} ({result['duration']}s)"
+            )
+
+        if workers > 1:
+            with Pool(workers, _init_worker, (model_type, model_path)) as pool:
+                for result in pool.imap_unordered(convert, pending):
+                    record(result)
+        else:
+            _init_worker(model_type, model_path)
+            for task in pending:
+                record(convert(task))
+    return records
+
+
+def _init_worker(model_type, model_path):
+    global _model
+    _model = None
+    if model_type is not None and model_path is not None:
+        _model = load_model(model_type, model_path)
+
+
+def _convert(
+    task: Task,
+    model_type,
+    cache_dir,
+    low_memory,
+    persistent_tabula,
+    table_engine,
+    image_dir,
+) -> Dict[str, Any]:
+    start = time.time()
+    error = None
+    try:
+        hocr = parse_iter(
+            task.pdf_file,
+            model_type,
+            model=_model,
+            cache_dir=cache_dir,
+            low_memory=low_memory,
+            persistent_tabula=persistent_tabula,
+            table_engine=table_engine,
+            image_dir=image_dir,
+            # Refer to images relative to the hOCR file
+            image_src_dir=None
+            if image_dir is None
+            else os.path.relpath(
+                image_dir, os.path.dirname(os.path.abspath(task.html_path))
+            ),
+        )
+        _write_atomic(task.html_path, hocr)
+    except Exception as e:
+        logger.exception(f"Failed to convert {task.pdf_file}")
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "pdf_file": task.pdf_file,
+        "html_path": task.html_path,
+        "status": "ok" if error is None else "error",
+        "duration": round(time.time() - start, 3),
+        "error": error,
+    }
+
+
+def _write_atomic(path: str, chunks: Iterable[str]):
+    """Write chunks into a temporary file then move it to path at once."""
+    dirname = os.path.dirname(path) or "."
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -17,12 +17,25 @@ model_path argument = TreeStructure/data/paleo/ml/model.pkl.
 Other tree parts are detected using heuristic methods.
 """
 import codecs
+import json
 import logging
 import os
 import pickle
+from itertools import islice
+from typing import Iterator, Optional
+
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
 
 from pdftotree.TreeExtract import TreeExtractor
 from pdftotree.TreeVisualizer import TreeVisualizer
+from pdftotree.utils.pdf.page_cache import PageCache
+from pdftotree.utils.pdf.pdf_parsers import MAX_BOXES
+from pdftotree.utils.pdf.pdf_utils import ScanProbeDevice
+from pdftotree.utils.profile_utils import timer
+from pdftotree.utils.tabula_worker import get_shared_worker
 
 logger = logging.getLogger(__name__)
 
@@ -51,26 +64,175 @@ def parse(
     model_type=None,
     model_path=None,
     visualize=False,
+    jobs=1,
+    pages=None,
+    cache_dir=None,
+    model=None,
+    low_memory=False,
+    profile_path=None,
+    max_boxes=MAX_BOXES,
+    persistent_tabula=False,
+    table_engine="tabula",
+    image_dir=None,
 ):
-    model = None
-    if model_type is not None and model_path is not None:
-        model = load_model(model_type, model_path)
-    extractor = TreeExtractor(pdf_file)
-    if extractor.is_scanned():
-        logger.warning("Document looks scanned, the result may be far from expected.")
-    else:
-        logger.info("Digitized PDF detected, building tree structure...")
-
-    pdf_tree = extractor.get_tree_structure(model_type, model)
-    logger.info("Tree structure built, creating html...")
-    pdf_html = extractor.get_html_tree()
-    logger.info("HTML created.")
+    extractor = _get_extractor(
+        pdf_file,
+        jobs,
+        pages,
+        cache_dir,
+        low_memory,
+        profile=profile_path is not None,
+        max_boxes=max_boxes,
+        persistent_tabula=persistent_tabula,
+        table_engine=table_engine,
+        image_dir=image_dir,
+        # Refer to images relative to the hOCR file
+        image_src_dir=None
+        if image_dir is None or html_path is None
+        else os.path.relpath(image_dir, os.path.dirname(os.path.abspath(html_path))),
+    )
+    hocr = _iter_hocr(extractor, model_type, model_path, model)
     # TODO: what is the following substition for and is it required?
     # pdf_html = re.sub(r"[\x00-\x1F]+", "", pdf_html)
 
     if html_path is None:
-        return pdf_html
-    with codecs.open(html_path, encoding="utf-8", mode="w") as f:
-        f.write(pdf_html)
-    if visualize:
-        visualize_tree(pdf_file, pdf_tree, html_path)
+        result = "".join(hocr)
+    else:
+        result = None
+        with codecs.open(html_path, encoding="utf-8", mode="w") as f:
+            for chunk in hocr:
+                f.write(chunk)
+        if visualize:
+            with timer(extractor.profiler, "visualize"):
+                visualize_tree(pdf_file, extractor.tree, html_path)
+    if profile_path is not None:
+        with open(profile_path, "w") as f:
+            json.dump(dict(pdf_file=pdf_file, **extractor.profile), f, indent=2)
+    return result
+
+
+def parse_iter(
+    pdf_file,
+    model_type=None,
+    model_path=None,
+    jobs=1,
+    pages=None,
+    cache_dir=None,
+    model=None,
+    low_memory=False,
+    max_boxes=MAX_BOXES,
+    persistent_tabula=False,
+    table_engine="tabula",
+    image_dir=None,
+    image_src_dir=None,
+) -> Iterator[str]:
+    """Parse a PDF page by page and yield its hOCR in chunks.
+
+    Only one page is held in memory at a time. Concatenating the chunks gives the
+    same document as :func:`parse`.
+
+    :param pdf_file: path to a PDF file
+    :param model_type: "vision", "ml", or None for heuristics
+    :param model_path: path to a pretrained model for model_type
+    :param jobs: number of processes to interpret pages with
+    :param pages: 1-based numbers of the pages to extract, or None for all
+    :param cache_dir: directory to cache normalized pages in, or None not to cache.
+        It must be trusted, as cached pages are unpickled.
+    :param model: a model for model_type already loaded by :func:`load_model`,
+        which is used instead of loading model_path
+    :param low_memory: whether to release chars once words are computed
+    :param max_boxes: number of text boxes on a page above which its layout is not
+        analyzed, or None for no limit
+    :param persistent_tabula: whether to recognize tables in a long-lived tabula
+        worker shared by every document converted in this process, which keeps
+        tabula-java's JVM running if installed with pdftotree[persistent_tabula]
+    :param table_engine: "tabula" to recognize the cells of tables with tabula-java,
+        or "native" to lay them out from the segments and text of the page
+    :param image_dir: directory to write images into, deduplicated by content, or
+        None to embed them in base64
+    :param image_src_dir: path to image_dir as referred to by the ``src`` of images,
+        e.g. relative to where the hOCR is written. Defaults to image_dir.
+    :return: an iterator of hOCR chunks, one ``ocr_page`` at a time
+    """
+    extractor = _get_extractor(
+        pdf_file,
+        jobs,
+        pages,
+        cache_dir,
+        low_memory,
+        max_boxes=max_boxes,
+        persistent_tabula=persistent_tabula,
+        table_engine=table_engine,
+        image_dir=image_dir,
+        image_src_dir=image_src_dir,
+    )
+    return _iter_hocr(extractor, model_type, model_path, model)
+
+
+def probe_scanned(pdf_file, max_pages: Optional[int] = None) -> bool:
+    """Tell quickly if a PDF looks like an image scan without layout analysis.
+
+    A page looks scanned when images, either a single one or vertically stacked
+    strips, cover its whole mediabox and no vector segments are drawn on it.
+    Unlike :meth:`TreeExtractor.is_scanned`, a born-digital PDF without ruling
+    lines is not considered scanned.
+
+    :param pdf_file: path to a PDF file
+    :param max_pages: number of leading pages to probe, or None for all
+    :return: True if any probed page looks scanned
+    """
+    with open(pdf_file, "rb") as fp:
+        document = PDFDocument(PDFParser(fp), password="")
+        rsrcmgr = PDFResourceManager()
+        device = ScanProbeDevice(rsrcmgr)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        for page in islice(PDFPage.create_pages(document), max_pages):
+            interpreter.process_page(page)
+            if device.is_scanned():
+                return True
+    return False
+
+
+def _get_extractor(
+    pdf_file,
+    jobs,
+    pages,
+    cache_dir,
+    low_memory,
+    profile=False,
+    max_boxes=MAX_BOXES,
+    persistent_tabula=False,
+    table_engine="tabula",
+    image_dir=None,
+    image_src_dir=None,
+) -> TreeExtractor:
+    cache = None if cache_dir is None else PageCache(cache_dir)
+    tabula_worker = get_shared_worker() if persistent_tabula else None
+    return TreeExtractor(
+        pdf_file,
+        jobs=jobs,
+        pages=pages,
+        cache=cache,
+        low_memory=low_memory,
+        profile=profile,
+        max_boxes=max_boxes,
+        tabula_worker=tabula_worker,
+        table_engine=table_engine,
+        image_dir=image_dir,
+        image_src_dir=image_src_dir,
+    )
+
+
+def _iter_hocr(
+    extractor: TreeExtractor, model_type, model_path, model=None
+) -> Iterator[str]:
+    if model is None and model_type is not None and model_path is not None:
+        with timer(extractor.profiler, "load_model"):
+            model = load_model(model_type, model_path)
+    logger.info("Building tree structure and html page by page...")
+    yield from extractor.iter_hocr(model_type, model)
+    logger.info("HTML created.")
+    if extractor.scanned:
+        logger.warning("Document looks scanned, the result may be far from expected.")
+    else:
+        logger.info("Digitized PDF detected.")
@@ -1,16 +1,15 @@
 import string
-from builtins import str
-from collections import defaultdict
-from typing import Any, List
+from typing import Any, List, Optional
 
-from pdfminer.layout import LTComponent, LTTextLine
+from pdfminer.layout import LTComponent
 
-from pdftotree.utils.bbox_utils import isContained
+from pdftotree.utils.bbox_utils import CentroidIndex, isContained
 from pdftotree.utils.pdf.pdf_parsers import (
     cluster_vertically_aligned_boxes,
     get_char_width,
     get_most_common_font_pts,
     get_page_width,
+    set_atomic_features,
 )
 from pdftotree.utils.pdf.vector_utils import intersect
 
@@ -36,14 +35,20 @@ def get_height_coverage(bbox):
 
 
 def get_mentions_within_bbox(
-    bbox: List[Any], mentions: List[LTComponent]
+    bbox: List[Any],
+    mentions: List[LTComponent],
+    centroids: Optional[CentroidIndex] = None,
 ) -> List[LTComponent]:
     """Get textlines within bbox.
 
     :param bbox: a list containing (top, left, bottom, right) in the last 4 digits
     :param mentions: a list of textlines
+    :param centroids: an index of the centroids of mentions to look them up
+        instead of checking every mention
     :return: a list of textlines within the given bbox
     """
+    if centroids is not None:
+        return [mentions[i] for i in centroids.query(bbox)]
     mentions_within_bbox = []
     for mention in mentions:
         # Compute the centroid
@@ -102,7 +107,9 @@ def get_lines_within_bbox(bbox, segments):
 def get_lines_features(bboxes, elems):
     features = []
     for bbox in bboxes:
-        mentions = get_mentions_within_bbox(bbox, elems.mentions)
+        mentions = get_mentions_within_bbox(
+            bbox, elems.mentions, elems.mention_centroids
+        )
         segments = get_lines_within_bbox(bbox, elems.segments)
         feat = [get_area_coverage(bbox)]
         feat += [get_height_coverage(bbox)]
@@ -119,11 +126,15 @@ def get_lines_features(bboxes, elems):
 
 def get_alignment_features(line_bboxes, elems, font_stat):
     alignment_features = []
+    set_atomic_features(elems)
     for line_bbox in line_bboxes:
         line_bbox_ordered = (line_bbox[4], line_bbox[3], line_bbox[6], line_bbox[5])
-        boxes = [
-            elem for elem in elems.mentions if intersect(line_bbox_ordered, elem.bbox)
+        box_indices = [
+            i
+            for i, elem in enumerate(elems.mentions)
+            if intersect(line_bbox_ordered, elem.bbox)
         ]
+        boxes = [elems.mentions[i] for i in box_indices]
         boxes_segments = [
             elem for elem in elems.segments if intersect(line_bbox_ordered, elem.bbox)
         ]
@@ -141,19 +152,6 @@ def get_alignment_features(line_bboxes, elems, font_stat):
             alignment_features += [[0] * 17]
             continue
         char_width = get_char_width(boxes)
-        grid_size = avg_font_pts / 2.0
-        for i, m in enumerate(boxes + elems.figures):
-            m.id = i
-            m.feats = defaultdict(bool)
-            prefix = ""
-            if isinstance(m, LTTextLine) and m.font_name:
-                prefix = m.font_name + "-" + str(m.font_size) + "-"
-            m.xc = (m.x0 + m.x1) / 2.0
-            m.yc = (m.y0 + m.y1) / 2.0
-            m.feats[prefix + "x0"] = m.x0_grid = m.x0 // grid_size
-            m.feats[prefix + "x1"] = m.x1_grid = m.x1 // grid_size
-            m.feats[prefix + "xc"] = m.xc_grid = m.xc // grid_size
-            m.feats[prefix + "yc"] = m.yc_grid = m.yc // grid_size
 
         nodes, nodes_features = cluster_vertically_aligned_boxes(
             boxes,
@@ -166,6 +164,7 @@ def get_alignment_features(line_bboxes, elems, font_stat):
             boxes_figures,
             page_width,
             True,
+            elems.arrays.bbox[box_indices],
         )
         if len(nodes_features) == 0:
             alignment_features += [[0] * 17]
@@ -1,4 +1,9 @@
-from typing import Tuple
+import math
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
 
 TOLERANCE = 5
 
@@ -159,3 +164,127 @@ def bbox2str(bbox: Tuple[float, float, float, float]) -> str:
     """
     (x0, y0, x1, y1) = bbox
     return f"bbox {int(x0)} {int(y0)} {int(x1)} {int(y1)}"
+
+
+class GridIndex(object):
+    """
+    A uniform grid of square cells over bounding boxes (x0, y0, x1, y1), each of
+    which is registered in every cell it covers, to find the boxes that may
+    intersect a given one without comparing it with every box.
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[int]] = defaultdict(set)
+        self.extents: Dict[int, Tuple[int, int, int, int]] = {}
+
+    @classmethod
+    def for_bboxes(cls, bboxes: Iterable[Tuple[float, float, float, float]]):
+        """Build a grid with cells about the size of the boxes and register them.
+
+        The cells are no smaller than 1/32 of the extent of all the boxes so that
+        large boxes cover a bounded number of cells.
+
+        :param bboxes: boxes registered by their position in bboxes
+        """
+        bboxes = list(bboxes)
+        if not bboxes:
+            return cls(1.0)
+        sides = sorted(max(x1 - x0, y1 - y0) for x0, y0, x1, y1 in bboxes)
+        extent = max(
+            max(x1 for _, _, x1, _ in bboxes) - min(x0 for x0, _, _, _ in bboxes),
+            max(y1 for _, _, _, y1 in bboxes) - min(y0 for _, y0, _, _ in bboxes),
+        )
+        index = cls(max(sides[len(sides) // 2], extent / 32) or 1.0)
+        for key, bbox in enumerate(bboxes):
+            index.insert(key, bbox)
+        return index
+
+    def _extent(self, bbox: Tuple[float, float, float, float]):
+        x0, y0, x1, y1 = bbox
+        size = self.cell_size
+        return (
+            math.floor(x0 / size),
+            math.floor(y0 / size),
+            math.floor(x1 / size),
+            math.floor(y1 / size),
+        )
+
+    def insert(self, key: int, bbox: Tuple[float, float, float, float]) -> None:
+        """Register a box, or extend a registered one to also cover bbox."""
+        i0, j0, i1, j1 = self._extent(bbox)
+        if key in self.extents:
+            k0, l0, k1, l1 = self.extents[key]
+            i0, j0, i1, j1 = min(i0, k0), min(j0, l0), max(i1, k1), max(j1, l1)
+        else:
+            k0, l0, k1, l1 = 0, 0, -1, -1  # no cell
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                if not (k0 <= i <= k1 and l0 <= j <= l1):
+                    self.cells[(i, j)].add(key)
+        self.extents[key] = (i0, j0, i1, j1)
+
+    def remove(self, key: int) -> None:
+        """Unregister a box."""
+        i0, j0, i1, j1 = self.extents.pop(key)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                self.cells[(i, j)].discard(key)
+
+    def query(self, bbox: Tuple[float, float, float, float]) -> Set[int]:
+        """
+        :return: the keys of the boxes in the cells covered by bbox, among which
+            are all the boxes intersecting bbox (borders included)
+        """
+        i0, j0, i1, j1 = self._extent(bbox)
+        keys: Set[int] = set()
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                cell = self.cells.get((i, j))
+                if cell:
+                    keys |= cell
+        return keys
+
+
+class CentroidIndex(object):
+    """
+    Centroids of boxes (x0, y0, x1, y1), truncated to integers, sorted by y then x
+    to find those within a box in time proportional to the number of distinct y
+    it spans and the number of centroids found.
+    """
+
+    def __init__(self, bboxes: np.ndarray):
+        """
+        :param bboxes: (n, 4) array of boxes, indexed by their row
+        """
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        xc = np.trunc((bboxes[:, 0] + bboxes[:, 2]) / 2)
+        yc = np.trunc((bboxes[:, 1] + bboxes[:, 3]) / 2)
+        order = np.lexsort((xc, yc))
+        ys, starts = np.unique(yc[order], return_index=True)
+        self.order: List[int] = order.tolist()
+        self.xs: List[float] = xc[order].tolist()
+        self.ys: List[float] = ys.tolist()
+        # Centroids at ys[k] are at order[starts[k]:starts[k + 1]]
+        self.starts: List[int] = starts.tolist() + [len(self.order)]
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def query(self, bbox: Iterable[float], tol: float = TOLERANCE) -> List[int]:
+        """Find the boxes whose centroid is contained in bbox as by isContained.
+
+        :param bbox: a list containing (top, left, bottom, right) in the last 4 digits
+        :return: the rows of the boxes found, in order
+        """
+        top, left, bottom, right = bbox[-4:]
+        found: List[int] = []
+        k0 = bisect_right(self.ys, top - tol)
+        k1 = bisect_left(self.ys, bottom + tol)
+        for k in range(k0, k1):
+            start, end = self.starts[k], self.starts[k + 1]
+            i0 = bisect_right(self.xs, left - tol, start, end)
+            i1 = bisect_left(self.xs, right + tol, start, end)
+            found += self.order[i0:i1]
+        found.sort()
+        return found
@@ -0,0 +1,57 @@
+from typing import List, Set, Tuple
+
+
+class UnionFind(object):
+    """
+    Disjoint sets of the integers 0..n-1 with path compression and union by size,
+    so that any sequence of unions and finds runs in near-linear time.
+
+    Each set is labeled by one of its members, initially each integer by itself.
+    """
+
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.label = list(range(n))  # label of the set of each root
+
+    def find(self, i: int) -> int:
+        """Find the representative of the set containing i."""
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def label_of(self, i: int) -> int:
+        """Label of the set containing i."""
+        return self.label[self.find(i)]
+
+    def union(self, i: int, j: int) -> bool:
+        """Merge the set containing j into that containing i, whose label is kept.
+
+        :return: False if they were already the same set
+        """
+        root_i = self.find(i)
+        root_j = self.find(j)
+        if root_i == root_j:
+            return False
+        label = self.label[root_i]
+        if self.size[root_i] < self.size[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.size[root_i] += self.size[root_j]
+        self.label[root_i] = label
+        return True
+
+    def to_clusters(self) -> Tuple[List[Set[int]], List[int]]:
+        """
+        :return: cid2obj, the members of the set labeled by each integer (empty if
+            it labels no set), and obj2cid, the label of the set of each integer
+        """
+        n = len(self.parent)
+        obj2cid = [self.label[self.find(i)] for i in range(n)]
+        cid2obj: List[Set[int]] = [set() for _ in range(n)]
+        for i, cid in enumerate(obj2cid):
+            cid2obj[cid].add(i)
+        return cid2obj, obj2cid
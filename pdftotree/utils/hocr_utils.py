@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, TextIO
+
+
+def escape(data: str) -> str:
+    """Escape text or an attribute value as xml.dom.minidom does."""
+    return (
+        data.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace('"', "&quot;")
+        .replace(">", "&gt;")
+    )
+
+
+class HOCRWriter(object):
+    """
+    Write hOCR elements to a text stream as they are opened and closed, without
+    building a DOM.
+
+    The output is laid out as ``xml.dom.minidom`` pretty-prints a document: one
+    element per line indented by tabs, an element with a single text child on a
+    single line, and an element without children as an empty-element tag.
+    """
+
+    def __init__(self, out: TextIO, depth: int = 0):
+        """
+        :param out: stream to write to
+        :param depth: indentation level of the top-level elements
+        """
+        self.out = out
+        self.depth = depth
+        # Tag of each open element and whether it has a child yet
+        self._open: List[List] = []
+
+    def _start_child(self) -> str:
+        """Close the start tag of the parent if needed and return the indent."""
+        if self._open and not self._open[-1][1]:
+            self.out.write(">\n")
+            self._open[-1][1] = True
+        return "\t" * (self.depth + len(self._open))
+
+    @staticmethod
+    def _attrs(attrs: Dict[str, str]) -> str:
+        return "".join(f' {name}="{escape(value)}"' for name, value in attrs.items())
+
+    def start(self, tag: str, attrs: Dict[str, str]) -> None:
+        """Open an element, whose start tag is closed once its first child comes."""
+        indent = self._start_child()
+        self.out.write(f"{indent}<{tag}{self._attrs(attrs)}")
+        self._open.append([tag, False])
+
+    def end(self) -> None:
+        """Close the innermost open element."""
+        tag, has_child = self._open.pop()
+        if has_child:
+            self.out.write("\t" * (self.depth + len(self._open)) + f"</{tag}>\n")
+        else:
+            self.out.write("/>\n")
+
+    @contextmanager
+    def element(self, tag: str, attrs: Dict[str, str]) -> Iterator[None]:
+        """Write an element around what is written in the enclosed block."""
+        self.start(tag, attrs)
+        yield
+        self.end()
+
+    def text_element(self, tag: str, attrs: Dict[str, str], text: str) -> None:
+        """Write an element containing text only."""
+        indent = self._start_child()
+        self.out.write(f"{indent}<{tag}{self._attrs(attrs)}>{escape(text)}</{tag}>\n")
+
+    def empty_element(self, tag: str, attrs: Dict[str, str]) -> None:
+        """Write an element without children."""
+        indent = self._start_child()
+        self.out.write(f"{indent}<{tag}{self._attrs(attrs)}/>\n")
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import tempfile
+from base64 import b64encode
+from typing import Dict, Optional, Tuple
+
+from pdfminer.image import ImageWriter
+from pdfminer.layout import LTImage
+
+# Media types of the images that browsers display, by extension
+MEDIA_TYPES = {".jpg": "jpeg", ".bmp": "bmp"}
+
+
+def export_image(img: LTImage) -> Tuple[str, bytes]:
+    """Encode an image with pdfminer's ImageWriter, in a temporary directory.
+
+    :return: the extension of the file ImageWriter wrote and its content
+    """
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = ImageWriter(dirname).export_image(img)
+        with open(os.path.join(dirname, filename), "rb") as f:
+            data = f.read()
+    return os.path.splitext(filename)[1], data
+
+
+class ImageExporter(object):
+    """
+    Export the images of a document for hOCR, encoded by pdfminer's ImageWriter,
+    either inline as base64 data URIs or as files.
+
+    Images are deduplicated by the hash of their stream, so that an image repeated
+    on many pages, e.g. a logo, is encoded once per document and written once.
+    """
+
+    def __init__(self, image_dir: Optional[str] = None, src_dir: Optional[str] = None):
+        """
+        :param image_dir: directory to write images into, or None to embed them
+        :param src_dir: path to image_dir as referred to by the ``src`` of images,
+            e.g. relative to the hOCR file. Defaults to image_dir.
+        """
+        self.image_dir = image_dir
+        self.src_dir = image_dir if src_dir is None else src_dir
+        # Extension and src of each image, keyed by its digest
+        self._exported: Dict[str, Tuple[str, Optional[str]]] = {}
+
+    def export(self, img: LTImage) -> Tuple[str, Optional[str]]:
+        """Get the ``src`` of an image, encoding it if it has not been yet.
+
+        :return: the extension of the image, as named by pdfminer's ImageWriter,
+            and its src, or None if browsers cannot display the type of image
+        """
+        digest = self._digest(img)
+        if digest not in self._exported:
+            ext, data = export_image(img)
+            src = None
+            if ext in MEDIA_TYPES:
+                if self.image_dir is None:
+                    base64 = b64encode(data).decode("ascii")
+                    src = f"data:image/{MEDIA_TYPES[ext]};base64,{base64}"
+                else:
+                    filename = digest + ext
+                    self._write(filename, data)
+                    src = os.path.join(self.src_dir, filename)
+            self._exported[digest] = (ext, src)
+        return self._exported[digest]
+
+    @staticmethod
+    def _digest(img: LTImage) -> str:
+        h = hashlib.sha1(img.stream.get_data() or b"")
+        h.update(repr((img.srcsize, img.bits, img.colorspace)).encode("utf-8"))
+        h.update(repr(img.stream.get_filters()).encode("utf-8"))
+        return h.hexdigest()
+
+    def _write(self, filename: str, data: bytes) -> None:
+        """Write an image atomically unless a document wrote it already."""
+        path = os.path.join(self.image_dir, filename)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.image_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.image_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
@@ -9,12 +9,13 @@ from builtins import object, range, zip
 from collections import defaultdict
 from functools import cmp_to_key
 from pprint import pformat
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import pandas as pd
-from pdfminer.utils import Plane
+from pdfminer.layout import LTComponent, LTLine, LTTextLine
 
-from pdftotree.utils.pdf.vector_utils import inside, reading_order
+from pdftotree.utils.pdf.vector_utils import reading_order
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +23,14 @@ logger = logging.getLogger(__name__)
 class Cell(object):
     """Represents a cell with no visual dividers inside"""
 
-    def __init__(self, origin, texts=[], rowspan=1, colspan=1):
+    def __init__(self, origin, texts=None, rowspan=1, colspan=1):
         """
         origin: the top left grid coordinate of the cell
         """
         self.rowstart, self.colstart = origin
         self.rowend = self.rowstart + rowspan
         self.colend = self.colstart + colspan
-        self.texts = texts
+        self.texts = [] if texts is None else texts
 
     def __str__(self, *args, **kwargs):
         return ",".join([m.get_text().encode("utf8") for m in self.texts])
@@ -47,8 +48,8 @@ class Grid(object):
         self.min_cell_size = min_cell_size
         vlines, hlines = _split_vlines_hlines(lines)
 
-        self.xs = [v.xc for v in vlines]
-        self.ys = [h.yc for h in hlines]
+        self.xs = [_center(v)[0] for v in vlines]
+        self.ys = [_center(h)[1] for h in hlines]
 
         # Remove closely clustered lines
         # Also make sure there is at least 1 mega column for the table
@@ -68,10 +69,8 @@ class Grid(object):
         grid = self._grid
 
         # Record whether a particular cell boundary is present
-        line_plane = Plane(region.bbox)
-        line_plane.extend(lines)
-        vbars, hbars = self._mark_grid_bounds(line_plane, region)
-        cells = []
+        vbars, hbars = self._mark_grid_bounds(vlines, hlines, region)
+        self.cells: List[Cell] = []
         # Establish cell regions
         for i in range(self.num_rows):
             for j in range(self.num_cols):
@@ -88,26 +87,52 @@ class Grid(object):
                 # Create new cell otherwise
                 else:
                     grid[i, j] = cell = Cell([i, j])
-                    cells.append(cell)
-
-        # Now get the cell's contents by using its boundary
-        text_plane = Plane(region.bbox)
-        text_plane.extend(mentions)
-
-        for cell in cells:
-            x0 = self.xs[cell.colstart]
-            x1 = self.xs[cell.colend]
-            y0 = self.ys[cell.rowstart]
-            y1 = self.ys[cell.rowend]
-            bbox = (x0, y0, x1, y1)
-            # Keep mentions whose centers are inside the cell
-            cell.texts = [
-                m for m in text_plane.find(bbox) if inside(bbox, (m.xc, m.yc) * 2)
-            ]
-
-        # TODO: provide HTML conversion here
-
-        self.get_normalized_grid()
+                    self.cells.append(cell)
+
+        # Now put each mention in the cell its center is inside
+        if self.num_rows > 0 and self.num_cols > 0:
+            for m in mentions:
+                xc, yc = _center(m)
+                if not (
+                    self.xs[0] <= xc <= self.xs[-1] and self.ys[0] <= yc <= self.ys[-1]
+                ):
+                    continue
+                col = min(bisect.bisect_right(self.xs, xc) - 1, self.num_cols - 1)
+                row = min(bisect.bisect_right(self.ys, yc) - 1, self.num_rows - 1)
+                grid[row, col].texts.append(m)
+        # Keep cell text in reading order
+        for cell in self.cells:
+            cell.texts.sort(key=cmp_to_key(reading_order))
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Describe the table as tabula does in its JSON output, with the rowspan,
+        colspan and mentions of each cell in addition. Each row lists the cells
+        starting in it; the cells it shares with rows above are left out.
+        """
+        data: List[List[Dict[str, Any]]] = [[] for _ in range(self.num_rows)]
+        for cell in self.cells:
+            top, bottom = self.ys[cell.rowstart], self.ys[cell.rowend]
+            left, right = self.xs[cell.colstart], self.xs[cell.colend]
+            data[cell.rowstart].append(
+                {
+                    "top": top,
+                    "left": left,
+                    "width": right - left,
+                    "height": bottom - top,
+                    "text": " ".join(m.get_text().strip() for m in cell.texts),
+                    "rowspan": cell.rowend - cell.rowstart,
+                    "colspan": cell.colend - cell.colstart,
+                    "mentions": cell.texts,
+                }
+            )
+        return {
+            "top": self.ys[0],
+            "left": self.xs[0],
+            "bottom": self.ys[-1],
+            "right": self.xs[-1],
+            "data": data,
+        }
 
     def to_dataframe(self):
         return pd.DataFrame(self._grid)
@@ -142,33 +167,151 @@ class Grid(object):
 
         return mega_rows
 
-    def _mark_grid_bounds(self, plane, region_bbox):
+    def _mark_grid_bounds(self, vlines, hlines, region):
         """
-        Assume all lines define a complete grid over the region_bbox.
+        Assume all lines define a complete grid over the region.
         Detect which lines are missing so that we can recover merged
         cells.
         """
         # Grid boundaries
-        vbars = np.zeros([self.num_rows, self.num_cols + 1], dtype=np.bool)
-        hbars = np.zeros([self.num_rows + 1, self.num_cols], dtype=np.bool)
-
-        def closest_idx(arr, elem):
-            left = bisect.bisect_left(arr, elem) - 1
-            right = bisect.bisect_right(arr, elem) - 1
-            return left if abs(arr[left] - elem) < abs(arr[right] - elem) else right
-
-        # Figure out which separating segments are missing, i.e. merge cells
-        for row, (y0, y1) in enumerate(self.yranges):
-            yc = (y0 + y1) // 2
-            for l in plane.find((region_bbox.x0, yc, region_bbox.x1, yc)):
-                vbars[row, closest_idx(self.xs, l.xc)] = True
-        for col, (x0, x1) in enumerate(self.xranges):
-            xc = (x0 + x1) // 2
-            for l in plane.find((xc, region_bbox.y0, xc, region_bbox.y1)):
-                hbars[closest_idx(self.ys, l.yc), col] = True
+        vbars = np.zeros([self.num_rows, self.num_cols + 1], dtype=bool)
+        hbars = np.zeros([self.num_rows + 1, self.num_cols], dtype=bool)
+
+        # Figure out which separating segments are missing, i.e. merge cells:
+        # a bar is present where a line crosses the middle of a row (column).
+        if vlines:
+            bboxes = np.array([v.bbox for v in vlines], dtype=float)
+            xc = (bboxes[:, 0] + bboxes[:, 2]) / 2
+            inside = (xc >= region.x0) & (xc <= region.x1)
+            closest = np.abs(xc[:, None] - np.array(self.xs)).argmin(axis=1)[inside]
+            bboxes = bboxes[inside]
+            for row, (y0, y1) in enumerate(self.yranges):
+                yc = (y0 + y1) / 2
+                crossing = (bboxes[:, 1] < yc) & (bboxes[:, 3] > yc)
+                vbars[row, closest[crossing]] = True
+        if hlines:
+            bboxes = np.array([h.bbox for h in hlines], dtype=float)
+            yc = (bboxes[:, 1] + bboxes[:, 3]) / 2
+            inside = (yc >= region.y0) & (yc <= region.y1)
+            closest = np.abs(yc[:, None] - np.array(self.ys)).argmin(axis=1)[inside]
+            bboxes = bboxes[inside]
+            for col, (x0, x1) in enumerate(self.xranges):
+                xc = (x0 + x1) / 2
+                crossing = (bboxes[:, 0] < xc) & (bboxes[:, 2] > xc)
+                hbars[closest[crossing], col] = True
         return vbars, hbars
 
 
+def get_table_grid(
+    mentions: List[LTTextLine],
+    segments: List[LTLine],
+    region: LTComponent,
+    min_cell_size=6.0,
+) -> Optional[Grid]:
+    """
+    Lay out the table in a region as a grid from its ruling lines, or from the
+    alignment of its text where it has too few of them.
+
+    Rows are separated by the horizontal segments if at least two of them lie
+    inside the region away from its borders, as in a ruled table, and by the
+    space between lines of text otherwise. Likewise for columns with the vertical
+    segments, or with the gaps in the text that at most one in five rows overlaps;
+    a mention across such a gap makes its cell span the columns on both sides.
+
+    :param mentions: lines of text in the region
+    :param segments: segments drawn over the region
+    :param region: bbox of the table
+    :param min_cell_size: distance under which separators are merged into one
+    :return: None if there is no text in the region
+    """
+    if len(mentions) == 0:
+        return None
+    vlines, hlines = _split_vlines_hlines(segments)
+    lines: List[LTLine] = []
+
+    ys = _retain_centroids(
+        [_center(h)[1] for h in hlines] + [region.y0, region.y1], min_cell_size
+    )
+    if _count_inner(ys, region.y0, region.y1, min_cell_size) >= 2:
+        lines += hlines
+    else:
+        ys = _text_row_bounds(mentions, region, min_cell_size)
+        lines += [LTLine(0, (region.x0, y), (region.x1, y)) for y in ys]
+
+    xs = _retain_centroids(
+        [_center(v)[0] for v in vlines] + [region.x0, region.x1], min_cell_size
+    )
+    if _count_inner(xs, region.x0, region.x1, min_cell_size) >= 2:
+        lines += vlines
+    else:
+        # Separate the columns of each row where no mention of the row crosses
+        rows = _group_by_row(mentions, ys)
+        for x in _text_col_bounds(rows, min_cell_size):
+            for (y0, y1), row in zip(zip(ys, ys[1:]), rows):
+                if not any(m.x0 < x < m.x1 for m in row):
+                    lines.append(LTLine(0, (x, y0), (x, y1)))
+    return Grid(mentions, lines, region, min_cell_size)
+
+
+def _text_row_bounds(mentions, region, min_cell_size):
+    """Separate the lines of text, with the center of each line below the last."""
+    rows: List[List[float]] = []  # top and bottom of each line of text
+    for m in sorted(mentions, key=lambda m: m.y0):
+        if rows and _center(m)[1] < rows[-1][1]:
+            rows[-1][1] = max(rows[-1][1], m.y1)
+        else:
+            rows.append([m.y0, m.y1])
+    separators = [(above[1] + below[0]) / 2 for above, below in zip(rows, rows[1:])]
+    return _retain_centroids(separators + [region.y0, region.y1], min_cell_size)
+
+
+def _group_by_row(mentions, ys):
+    """Group mentions by the row between ys their center is in."""
+    rows: List[List[LTTextLine]] = [[] for _ in range(len(ys) - 1)]
+    for m in mentions:
+        row = bisect.bisect_right(ys, _center(m)[1]) - 1
+        rows[min(max(row, 0), len(rows) - 1)].append(m)
+    return rows
+
+
+def _text_col_bounds(rows, min_cell_size):
+    """
+    Find where to separate the columns of text: in the middle of the widest
+    stretch overlapped by the fewest rows, within each gap between text that at
+    most one in five rows overlaps.
+    """
+    # Number of rows whose text overlaps each stretch between consecutive edges
+    events = []
+    for row in rows:
+        for x0, x1 in _merge_intervals([(m.x0, m.x1) for m in row]):
+            events += [(x0, 1), (x1, -1)]
+    events.sort()
+    stretches = []
+    count = 0
+    for (x, delta), (next_x, _) in zip(events, events[1:]):
+        count += delta
+        if next_x > x:
+            stretches.append((x, next_x, count))
+
+    max_count = sum(1 for row in rows if row) // 5
+    bounds = []
+    gap: List = []
+    for stretch in stretches:
+        if stretch[2] <= max_count:
+            gap.append(stretch)
+            continue
+        # Only gaps with text on both sides separate columns
+        if gap and gap[0][0] > stretches[0][0]:
+            if gap[-1][1] - gap[0][0] >= min_cell_size / 2:
+                fewest = min(count for _, _, count in gap)
+                x0, x1, _ = max(
+                    (s for s in gap if s[2] == fewest), key=lambda s: s[1] - s[0]
+                )
+                bounds.append((x0 + x1) / 2)
+        gap = []
+    return bounds
+
+
 ############################
 # Utilities
 ############################
@@ -186,6 +329,27 @@ def _retain_centroids(numbers, thres):
     return ret
 
 
+def _center(elem):
+    """Center of the bbox of an element"""
+    return (elem.x0 + elem.x1) / 2, (elem.y0 + elem.y1) / 2
+
+
+def _count_inner(numbers, lower, upper, thres):
+    """Count the numbers more than thres inside of the bounds"""
+    return sum(1 for n in numbers if lower + thres < n < upper - thres)
+
+
+def _merge_intervals(intervals):
+    """Merge overlapping intervals into their union, sorted"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
 def _split_vlines_hlines(lines):
     """Separates lines into horizontal and vertical ones"""
     vlines, hlines = [], []
@@ -0,0 +1,134 @@
+"""
+A persistent on-disk cache of normalized pages so that re-running pdftotree on the
+same documents (e.g., with another table detection) skips pdfminer's
+interpretation.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import zlib
+from typing import Counter, Dict, List, Optional, Tuple
+
+from pdfminer.layout import LAParams
+
+from pdftotree._version import __version__
+from pdftotree.utils.pdf.pdf_utils import PDFElems, detach_elems, dumps_elems
+
+logger = logging.getLogger(__name__)
+
+# Bump this when the pickled representation of PDFElems changes.
+CACHE_FORMAT = 3
+DEFAULT_CACHE_SIZE = 1 << 30  # 1 GiB
+
+_ENTRY_SUFFIX = ".pkl.z"
+
+
+class PageCache(object):
+    """
+    A size-bounded cache of normalized pages (PDFElems and font stat) on disk.
+
+    Entries are keyed by the content hash of the PDF, the LAParams values and the
+    version of pdftotree, and are stored one file per page in a compressed binary
+    format. The least recently used entries are evicted once the cache grows
+    larger than max_size.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_CACHE_SIZE):
+        """
+        :param cache_dir: directory to store entries in, created if missing. It
+            must be trusted: entries are unpickled, which can run arbitrary code.
+        :param max_size: maximum size of the cache in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size: Optional[int] = None  # lazily computed
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, pdf_file: str, laparams: LAParams, low_memory=False) -> str:
+        """Compute the key of a document analyzed with given parameters."""
+        h = hashlib.sha256()
+        with open(pdf_file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        params = sorted(vars(laparams).items())
+        h.update(repr((params, low_memory, __version__, CACHE_FORMAT)).encode("utf-8"))
+        return h.hexdigest()
+
+    def contains(self, key: str, page_num: int) -> bool:
+        return os.path.isfile(self._get_path(key, page_num))
+
+    def get(self, key: str, page_num: int) -> Optional[Tuple[PDFElems, Counter]]:
+        """Load a page, or return None if it is not cached."""
+        path = self._get_path(key, page_num)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring a broken cache entry {path}: {e}")
+            return None
+        return entry
+
+    def put(
+        self, key: str, page_num: int, elems: PDFElems, font_stat: Counter
+    ) -> Tuple[PDFElems, Counter]:
+        """Store a page and return it as detached from the document."""
+        elems = detach_elems(elems)
+        data = zlib.compress(dumps_elems((elems, font_stat)))
+        path = self._get_path(key, page_num)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write atomically not to leave a partial entry behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = sum(size for _, _, size in self._list_entries())
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self._evict()
+        return elems, font_stat
+
+    def _get_path(self, key: str, page_num: int) -> str:
+        return os.path.join(self.cache_dir, key, f"{page_num}{_ENTRY_SUFFIX}")
+
+    def _list_entries(self) -> List[Tuple[float, str, int]]:
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(_ENTRY_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits."""
+        entries = sorted(self._list_entries())
+        size = sum(size for _, _, size in entries)
+        dirs: Dict[str, None] = {}
+        for _, path, entry_size in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            dirs[os.path.dirname(path)] = None
+        for dirpath in dirs:
+            try:
+                os.rmdir(dirpath)  # only when it has become empty
+            except OSError:
+                pass
+        self._size = size
+        logger.info(f"Evicted cache entries down to {size} bytes.")
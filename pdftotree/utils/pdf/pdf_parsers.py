@@ -8,26 +8,36 @@ import logging
 import math
 import operator
 import sys
+from bisect import bisect_left
 from builtins import filter, range, str, zip
 from collections import Counter, defaultdict
 from functools import cmp_to_key
-from typing import Any, Dict, List, Tuple
+from heapq import heappop, heappush
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import numpy as np
 from pdfminer.layout import LTFigure, LTTextLine
-from pdfminer.utils import Plane
 
+from pdftotree.utils.bbox_utils import GridIndex
+from pdftotree.utils.cluster_utils import UnionFind
 from pdftotree.utils.pdf.node import Node
-from pdftotree.utils.pdf.pdf_utils import PDFElems
-from pdftotree.utils.pdf.vector_utils import center, intersect, l1, xy_reading_order
+from pdftotree.utils.pdf.pdf_utils import PDFElems, get_most_common_font_pts
+from pdftotree.utils.pdf.vector_utils import intersect, xy_reading_order
 
 logger = logging.getLogger(__name__)
 
+# Default number of text boxes on a page above which it is not clustered, as a
+# safety limit on time and memory
+MAX_BOXES = 50000
 
-def parse_layout(elems, font_stat, combine=False):
+
+def parse_layout(elems, font_stat, combine=False, max_boxes: Optional[int] = MAX_BOXES):
     """
     Parses pdf texts into a hypergraph grouped into rows
     and columns and then output
+
+    :param max_boxes: number of text boxes above which the page is not clustered,
+        or None for no limit
     """
     boxes_segments = elems.segments
     boxes_curves = elems.curves
@@ -38,19 +48,7 @@ def parse_layout(elems, font_stat, combine=False):
     avg_font_pts = get_most_common_font_pts(elems.mentions, font_stat)
     width = get_page_width(boxes + boxes_segments + boxes_figures + boxes_curves)
     char_width = get_char_width(boxes)
-    grid_size = avg_font_pts / 2.0
-    for i, m in enumerate(boxes + elems.figures):
-        m.id = i
-        m.feats = defaultdict(bool)
-        prefix = ""
-        if isinstance(m, LTTextLine) and m.font_name:
-            prefix = m.font_name + "-" + str(m.font_size) + "-"
-        m.xc = (m.x0 + m.x1) / 2.0
-        m.yc = (m.y0 + m.y1) / 2.0
-        m.feats[prefix + "x0"] = m.x0_grid = m.x0 // grid_size
-        m.feats[prefix + "x1"] = m.x1_grid = m.x1 // grid_size
-        m.feats[prefix + "xc"] = m.xc_grid = m.xc // grid_size
-        m.feats[prefix + "yc"] = m.yc_grid = m.yc // grid_size
+    set_atomic_features(elems)
 
     tbls, tbl_features = cluster_vertically_aligned_boxes(
         boxes,
@@ -63,10 +61,488 @@ def parse_layout(elems, font_stat, combine=False):
         boxes_figures,
         page_width,
         combine,
+        elems.arrays.bbox[: len(boxes)],
+        max_boxes,
     )
     return tbls, tbl_features
 
 
+def set_atomic_features(elems: PDFElems) -> None:
+    """
+    Attaches the centers and grid-snapped coordinates in elems.arrays to the
+    mentions and figures, as read by Node, along with their row in elems.arrays
+    as id.
+    """
+    arrays = elems.arrays
+    prefixes = [f"{font_name}-{font_size}-" for font_name, font_size in arrays.fonts]
+    for i, (m, (xc, yc), (x0_grid, x1_grid, xc_grid, yc_grid), font) in enumerate(
+        zip(
+            elems.mentions + elems.figures,
+            arrays.center.tolist(),
+            arrays.grid.tolist(),
+            arrays.font.tolist(),
+        )
+    ):
+        m.id = i
+        m.xc = xc
+        m.yc = yc
+        # Here we snap the elements to its closest grid line to detect rows/columns
+        m.x0_grid = x0_grid
+        m.x1_grid = x1_grid
+        m.xc_grid = xc_grid
+        m.yc_grid = yc_grid
+        prefix = prefixes[font] if font >= 0 else ""
+        m.feats = defaultdict(bool)
+        m.feats[prefix + "x0"] = x0_grid
+        m.feats[prefix + "x1"] = x1_grid
+        m.feats[prefix + "xc"] = xc_grid
+        m.feats[prefix + "yc"] = yc_grid
+
+
+def _close_pairs(
+    values: np.ndarray, max_gap: Optional[float]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the pairs (i1, i2), i1 < i2, of values closer than max_gap, or equal if
+    max_gap is None, by a sweep over the values in sorted order: the gaps between
+    values k places apart only grow with k, so the sweep stops at the first k at
+    which no gap is small enough.
+    """
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    i1s, i2s = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+    for k in range(1, len(values)):
+        gaps = sorted_values[k:] - sorted_values[:-k]
+        close = gaps == 0 if max_gap is None else gaps < max_gap
+        if not close.any():
+            break
+        a, b = order[:-k][close], order[k:][close]
+        i1s.append(np.minimum(a, b))
+        i2s.append(np.maximum(a, b))
+    return np.concatenate(i1s), np.concatenate(i2s)
+
+
+def _iter_sorted_pairs(i1s: np.ndarray, i2s: np.ndarray) -> Iterator[Tuple[int, int]]:
+    """Yields pairs (i1, i2) in the same order as nested loops over i1 then i2
+    would."""
+    order = np.lexsort((i2s, i1s))
+    return zip(i1s[order].tolist(), i2s[order].tolist())
+
+
+def cluster_rows(
+    bboxes: np.ndarray, avg_font_pts: float
+) -> Tuple[List[Set[int]], List[int]]:
+    """
+    Groups horizontally aligned boxes into rows, i.e., boxes whose y0 or y1 are
+    closer than 0.11 * avg_font_pts or whose rounded y centers are equal, along
+    with the boxes aligned with them and so on.
+
+    Aligned pairs are found by sorting boxes by y0, y1 and y center instead of
+    comparing every pair of boxes. They are merged in the order of their first box
+    then second one, each row keeping the label of the first box's row, to label
+    rows as merging every pair in nested loops would.
+
+    :return: rid2obj, the boxes in each row (empty if unused), and obj2rid, the
+        row of each box
+    """
+    y0, y1 = bboxes[:, 1], bboxes[:, 3]
+    yc = np.round((y0 + y1) / 2)
+    i1s, i2s = zip(
+        _close_pairs(y0, 0.11 * avg_font_pts),
+        _close_pairs(y1, 0.11 * avg_font_pts),
+        _close_pairs(yc, None),
+    )
+    i1s, i2s = np.concatenate(i1s), np.concatenate(i2s)
+    rows = UnionFind(len(bboxes))
+    for i1, i2 in _iter_sorted_pairs(i1s, i2s):
+        rows.union(i1, i2)
+    return rows.to_clusters()
+
+
+def _iter_row_pairs(
+    bboxes: np.ndarray, obj2rid: List[int], max_gap: float
+) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the pairs (i1, i2), i1 < i2, of boxes in the same row, one following
+    the other within max_gap, in the order of nested loops over i1 then i2.
+    """
+    i1s, i2s = _close_pairs(np.array(obj2rid), None)
+    x0, x1 = bboxes[:, 0], bboxes[:, 2]
+    x0_1, x1_1, x0_2, x1_2 = x0[i1s], x1[i1s], x0[i2s], x1[i2s]
+    close = ((x0_1 < x0_2) & (x0_2 - x1_1 <= max_gap)) | (
+        (x0_2 < x0_1) & (x0_1 - x1_2 <= max_gap)
+    )
+    return _iter_sorted_pairs(i1s[close], i2s[close])
+
+
+def _iter_vertical_pairs(
+    bboxes: np.ndarray,
+    reach: float,
+    related: Callable[[np.ndarray, np.ndarray], np.ndarray],
+) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the pairs (i1, i2), i1 < i2, of related boxes whose y0 differ, in the
+    order of nested loops over i1 then i2.
+
+    Boxes are only compared with the boxes starting below them by less than reach
+    from their bottom (y1), which are found by a window query over the boxes
+    sorted by y0. related tells if such pairs of boxes are related given the lower
+    ones (smaller y0) and the upper ones.
+    """
+    y0 = bboxes[:, 1]
+    order = np.argsort(y0, kind="stable")
+    sorted_y0 = y0[order]
+    # Positions in sorted_y0 of the window of each box
+    starts = np.searchsorted(sorted_y0, y0, side="right")
+    ends = np.searchsorted(sorted_y0, bboxes[:, 3] + reach, side="right")
+    counts = np.maximum(ends - starts, 0)
+    lower = np.repeat(np.arange(len(bboxes)), counts)
+    upper = order[
+        np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        + np.arange(counts.sum())
+    ]
+    keep = related(bboxes[lower], bboxes[upper])
+    lower, upper = lower[keep], upper[keep]
+    return _iter_sorted_pairs(np.minimum(lower, upper), np.maximum(lower, upper))
+
+
+def _aligned_cluster_pairs(
+    bboxes: np.ndarray,
+    cid2obj: List[Set[int]],
+    obj2cid: List[int],
+    obj2rid: List[int],
+    blacklist_obj: Set[int],
+    cid2span: Dict[int, Dict[str, float]],
+) -> List[Tuple[int, int]]:
+    """
+    Finds the pairs (cid1, cid2), cid1 < cid2, of clusters that do not overlap
+    vertically, are aligned on their left, right or center and have no box of
+    another cluster in their bounding box, in the order in which comparing every
+    pair of boxes in different rows, but blacklisted ones, would find them.
+
+    Clusters are only compared with the clusters of the same alignment below
+    them, and only down to the first boxes of two other clusters below them
+    within their x-range, as those boxes would lie in between. Boxes in between
+    are looked for by a window query over boxes sorted by y0.
+    """
+    # The first box of each cluster that is not blacklisted, and its first box in
+    # another row (-1 if none)
+    first_boxes: Dict[int, Tuple[int, int]] = {}
+    for cid, objs in enumerate(cid2obj):
+        objs = sorted(obj for obj in objs if obj not in blacklist_obj)
+        if objs:
+            m1 = objs[0]
+            m2 = next((obj for obj in objs if obj2rid[obj] != obj2rid[m1]), -1)
+            first_boxes[cid] = (m1, m2)
+    if len(first_boxes) < 2:
+        return []
+
+    def first_pair(cid1: int, cid2: int) -> Optional[Tuple[int, int]]:
+        # The first pair of boxes (i1, i2), one of each cluster, in different rows
+        def first_box(cid: int, other: int) -> int:
+            m1, m2 = first_boxes[cid]
+            o1, o2 = first_boxes[other]
+            if o2 >= 0 or obj2rid[o1] != obj2rid[m1]:
+                return m1
+            return m2
+
+        firsts = [
+            (i1, other)
+            for i1, other in [
+                (first_box(cid1, cid2), cid2),
+                (first_box(cid2, cid1), cid1),
+            ]
+            if i1 >= 0
+        ]
+        if not firsts:
+            return None
+        i1, other = min(firsts)
+        o1, o2 = first_boxes[other]
+        return i1, (o1 if obj2rid[o1] != obj2rid[i1] else o2)
+
+    # Boxes sorted by y0 for window queries
+    order = np.argsort(bboxes[:, 1], kind="stable")
+    sorted_bboxes = bboxes[order]
+    sorted_cids = np.array(obj2cid)[order]
+    # Boxes starting above y0 - max_height end above y0 (with a margin for
+    # rounding errors)
+    max_height = (bboxes[:, 3] - bboxes[:, 1]).max() + 1
+
+    def iter_window(rect: Tuple[float, float, float, float]) -> Iterator[np.ndarray]:
+        # Chunks of the positions in sorted_bboxes of the boxes intersecting rect,
+        # from top to bottom
+        start = np.searchsorted(sorted_bboxes[:, 1], rect[1] - max_height)
+        end = np.searchsorted(sorted_bboxes[:, 1], rect[3], side="right")
+        size = 64
+        while start < end:
+            stop = min(start + size, end)
+            b = sorted_bboxes[start:stop]
+            hit = (
+                (rect[0] <= b[:, 2])
+                & (b[:, 0] <= rect[2])
+                & (rect[1] <= b[:, 3])
+                & (b[:, 1] <= rect[3])
+            )
+            yield start + np.flatnonzero(hit)
+            start = stop
+            size *= 2
+
+    def blockers(cid: int) -> Tuple[float, int, float]:
+        # The y0 of the first box of another cluster below the top of a cluster
+        # within its x-range, that cluster, and the y0 of the first box of a third
+        # one
+        span = cid2span[cid]
+        rect = (span["min_x"], span["min_y"], span["max_x"], float("inf"))
+        t1, blocking = float("inf"), -1
+        for hits in iter_window(rect):
+            for pos in hits.tolist():
+                other = sorted_cids[pos]
+                if other == cid or other == blocking:
+                    continue
+                if blocking < 0:
+                    t1, blocking = sorted_bboxes[pos, 1], other
+                else:
+                    return t1, blocking, sorted_bboxes[pos, 1]
+        return t1, blocking, float("inf")
+
+    def connected(cid1: int, cid2: int, rect: Tuple[float, float, float, float]):
+        # Whether no box of another cluster intersects rect
+        for hits in iter_window(rect):
+            others = sorted_cids[hits]
+            if ((others != cid1) & (others != cid2)).any():
+                return False
+        return True
+
+    # Clusters by alignment, sorted by min_y
+    keys = {}
+    columns = defaultdict(list)
+    for cid in first_boxes:
+        span = cid2span[cid]
+        keys[cid] = [
+            ("left", round(span["min_x"])),
+            ("right", round(span["max_x"])),
+            ("center", round((span["min_x"] + span["max_x"]) / 2)),
+        ]
+        for key in keys[cid]:
+            columns[key].append(cid)
+    columns_min_y = {}
+    for key, cids in columns.items():
+        cids.sort(key=lambda cid: cid2span[cid]["min_y"])
+        columns_min_y[key] = [cid2span[cid]["min_y"] for cid in cids]
+
+    candidates = set()
+    for cid1 in first_boxes:
+        min_y = cid2span[cid1]["min_y"]
+        t1, blocking, t2 = blockers(cid1)
+        for key in keys[cid1]:
+            cids = columns[key]
+            for k in range(bisect_left(columns_min_y[key], min_y), len(cids)):
+                cid2 = cids[k]
+                if columns_min_y[key][k] >= t2:
+                    break
+                if cid2 == cid1 or (columns_min_y[key][k] >= t1 and cid2 != blocking):
+                    continue
+                candidates.add((min(cid1, cid2), max(cid1, cid2)))
+
+    pairs = []
+    for cid1, cid2 in candidates:
+        span1, span2 = cid2span[cid1], cid2span[cid2]
+        if span1["min_y"] > span2["min_y"]:
+            span1, span2 = span2, span1
+        if span1["min_y"] < span2["min_y"] < span1["max_y"]:
+            continue
+        compared = first_pair(cid1, cid2)
+        if compared is None:
+            continue
+        rect = (
+            min(span1["min_x"], span2["min_x"]),
+            span1["min_y"],
+            max(span1["max_x"], span2["max_x"]),
+            max(span1["max_y"], span2["max_y"]),
+        )
+        if connected(cid1, cid2, rect):
+            pairs.append((compared, cid1, cid2))
+    return [(cid1, cid2) for _, cid1, cid2 in sorted(pairs)]
+
+
+def _merge_aligned_clusters(
+    cid2obj: List[Set[int]],
+    obj2cid: List[int],
+    pairs: Iterable[Tuple[int, int]],
+    if_row_connected: Dict[int, int],
+    num_row_connected: Dict[int, int],
+    if_connected_by_span: Dict[int, int],
+    num_connected_by_span: Dict[int, int],
+    if_connected_by_align: Dict[int, int],
+    num_connected_by_align: Dict[int, int],
+) -> Tuple[List[Set[int]], List[int]]:
+    """
+    Merges the pairs (cid1, cid2) of clusters aligned in columns, in order, the
+    cluster of cid2 into that of cid1, so that chains of pairs end in a single
+    cluster. The alignment features of the merged clusters are updated in place.
+
+    :return: cid2obj2, the boxes in each cluster (empty if merged), and obj2cid2,
+        the cluster of each box
+    """
+    aligned = UnionFind(len(cid2obj))
+    for cid1, cid2 in pairs:
+        aligned.union(cid1, cid2)
+
+    # post-process cid2cid
+    cid2obj2 = cid2obj[:]
+    obj2cid2 = obj2cid[:]
+    for cid in range(len(cid2obj)):
+        cid_merge = aligned.label_of(cid)
+        if cid != cid_merge:
+            for obj_iter in cid2obj2[cid]:
+                cid2obj2[cid_merge].add(obj_iter)
+                obj2cid2[obj_iter] = cid_merge
+            cid2obj2[cid] = set()
+            # Features
+            if_connected_by_align[cid_merge] = 1
+            if_connected_by_align[cid] = 0
+            if if_row_connected[cid_merge] == 1 or if_row_connected[cid] == 1:
+                if_row_connected[cid_merge] = 1
+                num_row_connected[cid_merge] += num_row_connected[cid]
+                num_row_connected[cid] = 0
+                if_row_connected[cid] = 0
+            if if_connected_by_span[cid_merge] == 1 or if_connected_by_span[cid] == 1:
+                if_connected_by_span[cid_merge] = 1
+                num_connected_by_span[cid_merge] += num_connected_by_span[cid]
+                num_connected_by_span[cid] = 0
+                if_connected_by_span[cid] = 0
+            num_connected_by_align[cid_merge] += num_connected_by_align[cid]
+            num_connected_by_align[cid] = 0
+    return cid2obj2, obj2cid2
+
+
+def _merge_table_columns(
+    cid2obj2: List[Set[int]],
+    obj2cid2: List[int],
+    rid2obj: List[Set[int]],
+    obj2rid: List[int],
+    blacklist: Set[int],
+    blacklist_obj: Set[int],
+    if_row_connected: Dict[int, int],
+    num_row_connected: Dict[int, int],
+    if_connected_by_span: Dict[int, int],
+    num_connected_by_span: Dict[int, int],
+    if_connected_by_align: Dict[int, int],
+    num_connected_by_align: Dict[int, int],
+    if_vertical_columns_merged: Dict[int, int],
+    num_vertical_columns_merged: Dict[int, int],
+) -> None:
+    """
+    Merges, in place, the clusters (columns) of boxes with the clusters sharing a
+    row with them and another row with other boxes of their own cluster, in a
+    single pass: columns merged here are not compared again. The alignment
+    features of the merged clusters are updated in place.
+    """
+    # Rows of the boxes of each cluster, and of those not blacklisted
+    cid2rows = [Counter() for _ in range(len(cid2obj2))]
+    cid2rows_kept = [Counter() for _ in range(len(cid2obj2))]
+    for obj, cid in enumerate(obj2cid2):
+        cid2rows[cid][obj2rid[obj]] += 1
+        if obj not in blacklist_obj:
+            cid2rows_kept[cid][obj2rid[obj]] += 1
+    # Up to two rows shared by the kept boxes of a cluster and the boxes of another,
+    # cleared on every merge
+    shared_rows: Dict[Tuple[int, int], List[int]] = {}
+
+    def merge_columns(min_cid: int, max_cid: int) -> List[int]:
+        # Merges cluster max_cid into min_cid and returns the boxes moved
+        moved = list(cid2obj2[max_cid])
+        for obj_iter in cid2obj2[max_cid]:
+            cid2obj2[min_cid].add(obj_iter)
+            obj2cid2[obj_iter] = min_cid
+        cid2obj2[max_cid] = set()
+        cid2rows[min_cid].update(cid2rows[max_cid])
+        cid2rows[max_cid] = Counter()
+        cid2rows_kept[min_cid].update(cid2rows_kept[max_cid])
+        cid2rows_kept[max_cid] = Counter()
+        shared_rows.clear()
+        # Features
+        if_vertical_columns_merged[min_cid] = 1
+        if_vertical_columns_merged[max_cid] = 0
+        num_vertical_columns_merged[min_cid] += num_vertical_columns_merged[max_cid]
+        num_vertical_columns_merged[max_cid] = 0
+        if if_row_connected[min_cid] == 1 or if_row_connected[max_cid] == 1:
+            if_row_connected[min_cid] = 1
+            num_row_connected[min_cid] += num_row_connected[max_cid]
+            num_row_connected[max_cid] = 0
+            if_row_connected[max_cid] = 0
+        if if_connected_by_span[min_cid] == 1 or if_connected_by_span[max_cid] == 1:
+            if_connected_by_span[min_cid] = 1
+            num_connected_by_span[min_cid] += num_connected_by_span[max_cid]
+            num_connected_by_span[max_cid] = 0
+            if_connected_by_span[max_cid] = 0
+        if if_connected_by_align[min_cid] == 1 or if_connected_by_align[max_cid] == 1:
+            if_connected_by_align[min_cid] = 1
+            num_connected_by_align[min_cid] += num_connected_by_align[max_cid]
+            num_connected_by_align[max_cid] = 0
+            if_connected_by_align[max_cid] = 0
+        return moved
+
+    def shares_two_rows(cid1: int, rid1: int) -> bool:
+        # Whether another cluster has a box in row rid1 and a kept box in another
+        # row of cid1, i.e., whether the columns of cid1 and rid1 would be merged
+        for cid3 in set(obj2cid2[obj] for obj in rid2obj[rid1]):
+            if cid3 == cid1:
+                continue
+            if (cid1, cid3) not in shared_rows:
+                rows1, rows3 = cid2rows[cid1], cid2rows_kept[cid3]
+                if len(rows3) < len(rows1):
+                    rows1, rows3 = rows3, rows1
+                shared = []
+                for rid in rows1:
+                    if rid in rows3:
+                        shared.append(rid)
+                        if len(shared) == 2:
+                            break
+                shared_rows[(cid1, cid3)] = shared
+            if any(rid != rid1 for rid in shared_rows[(cid1, cid3)]):
+                return True
+        return False
+
+    # Merge the columns of boxes with the columns sharing a row with them and
+    # another row with other boxes of their own column. Only when there are such
+    # columns are the boxes of the column and rows walked through, in the order
+    # (and with the order-dependent results) of comparing every pair of boxes.
+    for obj1 in range(len(obj2cid2)):
+        cid1 = obj2cid2[obj1]
+        rid1 = obj2rid[obj1]
+        if cid1 in blacklist:
+            continue
+        if obj1 in blacklist_obj:
+            continue
+        if not shares_two_rows(cid1, rid1):
+            continue
+        # Boxes of cid1 by index, including those merged into it on the way
+        members = sorted(cid2obj2[cid1])
+        last = -1
+        while members:
+            obj2 = heappop(members)
+            if obj2 <= last or obj2cid2[obj2] != cid1:
+                continue
+            last = obj2
+            if obj1 == obj2:
+                continue
+            rid2 = obj2rid[obj2]
+            if rid1 == rid2:
+                continue
+            for obj3 in rid2obj[rid2]:
+                cid3 = obj2cid2[obj3]
+                if obj3 in blacklist_obj:
+                    continue
+                if cid1 != cid3 and cid2rows[cid3][rid1] > 0:
+                    min_cid = min(cid1, cid3)
+                    max_cid = max(cid1, cid3)
+                    moved = merge_columns(min_cid, max_cid)
+                    if min_cid == cid1:
+                        for obj in moved:
+                            heappush(members, obj)
+
+
 def cluster_vertically_aligned_boxes(
     boxes,
     page_bbox,
@@ -78,131 +554,77 @@ def cluster_vertically_aligned_boxes(
     boxes_figures,
     page_width,
     combine,
+    bboxes: Optional[np.ndarray] = None,
+    max_boxes: Optional[int] = MAX_BOXES,
 ):
+    if bboxes is None:
+        bboxes = np.array([b.bbox for b in boxes], dtype=float).reshape(-1, 4)
     # Filter out boxes with zero width or height
-    filtered_boxes = []
-    for bbox in boxes:
-        if bbox.x1 - bbox.x0 > 0 and bbox.y1 - bbox.y0 > 0:
-            filtered_boxes.append(bbox)
-    boxes = filtered_boxes
+    keep = (bboxes[:, 2] - bboxes[:, 0] > 0) & (bboxes[:, 3] - bboxes[:, 1] > 0)
+    boxes = [b for b, k in zip(boxes, keep.tolist()) if k]
+    bboxes = bboxes[keep]
 
-    # Too many "." in the Table of Content pages
     if len(boxes) == 0:
         logger.warning("No boxes were found to cluster.")
         return [], []
-    elif len(boxes) > 3500:
-        logger.warning("Too many '.' in the Table of Content pages?")
+    elif max_boxes is not None and len(boxes) > max_boxes:
+        logger.warning(
+            f"Too many boxes to cluster ({len(boxes)} > max_boxes={max_boxes})."
+        )
         return [], []
 
-    plane = Plane(page_bbox)
-    plane.extend(boxes)
-
-    # initialize clusters
-    cid2obj = [set([i]) for i in range(len(boxes))]
-    # default object map to cluster with its own index
-    obj2cid = list(range(len(boxes)))
-    prev_clusters = obj2cid
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2cid[i1] == obj2cid[i2]):
-                    continue
-                if b1.bbox[1] < b2.bbox[1]:
-                    box1 = b1.bbox
-                    box2 = b2.bbox
-                elif b2.bbox[1] < b1.bbox[1]:
-                    box1 = b2.bbox
-                    box2 = b1.bbox
-                else:
-                    # horizontally aligned
-                    continue
-                if (
-                    box2[1] < box1[3]
-                    or (box2[1] - box1[1] < 1.5 * avg_font_pts)
-                    or (box2[3] - box1[3] < 1.5 * avg_font_pts)
-                ):
-                    # can probably do better if we find the average space
-                    # between words
-                    if (
-                        abs(box1[0] - box2[0]) < 3
-                        or abs(box1[2] - box2[2]) < 3
-                        or (((box1[0] + box1[2]) / 2) == ((box2[0] + box2[2]) / 2))
-                        or ((box1[0] < box2[0]) and (box1[2] > box2[0]))
-                        or ((box1[0] > box2[0]) and (box2[2] > box1[0]))
-                    ):
-                        min_i = min(i1, i2)
-                        max_i = max(i1, i2)
-                        cid1 = obj2cid[min_i]
-                        cid2 = obj2cid[max_i]
-                        # move all objects from cluster cid2 to cid1
-                        # reassign cluster ids for all such objects as well
-                        for obj_iter in cid2obj[cid2]:
-                            cid2obj[cid1].add(obj_iter)
-                            obj2cid[obj_iter] = cid1
-                        cid2obj[cid2] = set()
-        if prev_clusters == obj2cid:
-            break
-        prev_clusters = obj2cid
-    clusters = [[boxes[i] for i in cluster] for cluster in filter(bool, cid2obj)]
-
-    rid2obj = [set([i]) for i in range(len(boxes))]  # initialize clusters
-    # default object map to cluster with its own index
-    obj2rid = list(range(len(boxes)))
-    prev_clusters = obj2rid
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2rid[i1] == obj2rid[i2]):
-                    continue
-                box1 = b1.bbox
-                box2 = b2.bbox
-                if (
-                    (abs(box1[1] - box2[1]) < 0.11 * avg_font_pts)
-                    or ((abs(box1[3] - box2[3]) < 0.11 * avg_font_pts))
-                    or (
-                        round((box1[1] + box1[3]) / 2) == round((box2[1] + box2[3]) / 2)
-                    )
-                ):
-                    min_i = min(i1, i2)
-                    max_i = max(i1, i2)
-                    rid1 = obj2rid[min_i]
-                    rid2 = obj2rid[max_i]
-                    for obj_iter in rid2obj[rid2]:
-                        rid2obj[rid1].add(obj_iter)
-                        obj2rid[obj_iter] = rid1
-                    rid2obj[rid2] = set()
-        if prev_clusters == obj2rid:
-            break
-        prev_clusters = obj2rid
-
-    not_merge = set()
-    for i1, b1 in enumerate(boxes):
-        for i2 in cid2obj[obj2cid[i1]]:
-            if i1 == i2:
-                continue
-            row1 = obj2rid[i1]
-            row2 = obj2rid[i2]
-            if row1 == row2:
-                continue
-            if b1.bbox[1] < b2.bbox[1]:
-                box1 = b1.bbox
-                box2 = b2.bbox
-            elif b2.bbox[1] < b1.bbox[1]:
-                box1 = b2.bbox
-                box2 = b1.bbox
-            else:
-                # horizontally aligned
-                continue
-            text_1 = 0.0
-            for obj in rid2obj[row1]:
-                text_1 += boxes[obj].bbox[2] - boxes[obj].bbox[0]
-            text_2 = 0.0
-            for obj in rid2obj[row2]:
-                text_2 += boxes[obj].bbox[2] - boxes[obj].bbox[0]
-            if abs(text_1 - text_2) / width > 0.1:
-                min_i = min(i1, i2)
-                max_i = max(i1, i2)
-                not_merge.add((min_i, max_i))
+    def vertically_aligned(
+        box1: np.ndarray, box2: np.ndarray, overlapping: bool
+    ) -> np.ndarray:
+        # can probably do better if we find the average space between words
+        close = (
+            (box2[..., 1] < box1[..., 3])
+            | (box2[..., 1] - box1[..., 1] < 1.5 * avg_font_pts)
+            | (box2[..., 3] - box1[..., 3] < 1.5 * avg_font_pts)
+        )
+        aligned = (
+            (np.abs(box1[..., 0] - box2[..., 0]) < 3)
+            | (np.abs(box1[..., 2] - box2[..., 2]) < 3)
+            | ((box1[..., 0] + box1[..., 2]) / 2 == (box2[..., 0] + box2[..., 2]) / 2)
+        )
+        if overlapping:
+            aligned |= (box1[..., 0] < box2[..., 0]) & (box1[..., 2] > box2[..., 0])
+            aligned |= (box1[..., 0] > box2[..., 0]) & (box2[..., 2] > box1[..., 0])
+        return close & aligned
+
+    # Vertically aligned boxes are close only if the upper one starts less than
+    # 1.5 * avg_font_pts below the bottom of the lower one (plus a margin for
+    # rounding errors).
+    reach = 1.5 * avg_font_pts + 1
+
+    clustering = UnionFind(len(boxes))
+    for i1, i2 in _iter_vertical_pairs(
+        bboxes,
+        reach,
+        lambda box1, box2: vertically_aligned(box1, box2, overlapping=True),
+    ):
+        clustering.union(i1, i2)
+    _, obj2aligned = clustering.to_clusters()
+
+    rid2obj, obj2rid = cluster_rows(bboxes, avg_font_pts)
+
+    # Total width of the text in each row
+    rid2text_width = {}
+    for rid in set(obj2rid):
+        text_width = 0.0
+        for obj in rid2obj[rid]:
+            text_width += boxes[obj].bbox[2] - boxes[obj].bbox[0]
+        rid2text_width[rid] = text_width
+
+    def not_merge(i1: int, i2: int) -> bool:
+        # Aligned boxes in rows of too different text widths
+        row1 = obj2rid[i1]
+        row2 = obj2rid[i2]
+        return (
+            obj2aligned[i1] == obj2aligned[i2]
+            and row1 != row2
+            and abs(rid2text_width[row1] - rid2text_width[row2]) / width > 0.1
+        )
 
     # Alignment Features
     # If text boxes are very close in a row
@@ -230,99 +652,44 @@ def cluster_vertically_aligned_boxes(
     avg_node_space = defaultdict(float)
     avg_node_space_norm = defaultdict(float)
 
-    cid2obj = [set([i]) for i in range(len(boxes))]  # initialize clusters
-    obj2cid = list(
-        range(len(boxes))
-    )  # default object map to cluster with its own index
-    prev_clusters = obj2cid
+    clustering = UnionFind(len(boxes))
     # add the code for merging close text boxes in particular row
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2cid[i1] == obj2cid[i2]):
-                    continue
-                box1 = b1.bbox
-                box2 = b2.bbox
-                if obj2rid[i1] == obj2rid[i2]:
-                    if (
-                        (b1.bbox[0] < b2.bbox[0])
-                        and ((b2.bbox[0] - b1.bbox[2]) <= 2 * char_width)
-                    ) or (
-                        (b2.bbox[0] < b1.bbox[0])
-                        and ((b1.bbox[0] - b2.bbox[2]) <= 2 * char_width)
-                    ):
-                        min_i = min(i1, i2)
-                        max_i = max(i1, i2)
-                        cid1 = obj2cid[min_i]
-                        cid2 = obj2cid[max_i]
-                        for obj_iter in cid2obj[cid2]:
-                            cid2obj[cid1].add(obj_iter)
-                            obj2cid[obj_iter] = cid1
-                        cid2obj[cid2] = set()
-                        # Features
-                        if_row_connected[cid1] = 1
-                        if_row_connected[cid2] = 0
-                        num_row_connected[cid1] += num_row_connected[cid2]
-                        num_row_connected[cid2] = 0
-        if prev_clusters == obj2cid:
-            break
-        prev_clusters = obj2cid
+    for i1, i2 in _iter_row_pairs(bboxes, obj2rid, 2 * char_width):
+        cid1 = clustering.label_of(i1)
+        cid2 = clustering.label_of(i2)
+        if not clustering.union(i1, i2):
+            continue
+        # Features
+        if_row_connected[cid1] = 1
+        if_row_connected[cid2] = 0
+        num_row_connected[cid1] += num_row_connected[cid2]
+        num_row_connected[cid2] = 0
 
     # vertical alignment code
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2cid[i1] == obj2cid[i2]):
-                    continue
-                if b1.bbox[1] < b2.bbox[1]:
-                    box1 = b1.bbox
-                    box2 = b2.bbox
-                elif b2.bbox[1] < b1.bbox[1]:
-                    box1 = b2.bbox
-                    box2 = b1.bbox
-                else:
-                    # horizontally aligned
-                    continue
-                if (
-                    box2[1] < box1[3]
-                    or (box2[1] - box1[1] < 1.5 * avg_font_pts)
-                    or (box2[3] - box1[3] < 1.5 * avg_font_pts)
-                ):  # can probably do better if we find the average space between words
-                    if (
-                        abs(box1[0] - box2[0]) < 3
-                        or abs(box1[2] - box2[2]) < 3
-                        or (((box1[0] + box1[2]) / 2) == ((box2[0] + box2[2]) / 2))
-                    ):
-                        min_i = min(i1, i2)
-                        max_i = max(i1, i2)
-                        if (min_i, max_i) not in not_merge:
-                            cid1 = obj2cid[min_i]
-                            cid2 = obj2cid[max_i]
-                            # move all objects from cluster cid2 to cid1
-                            # reassign cluster ids for all such objects as well
-                            for obj_iter in cid2obj[cid2]:
-                                cid2obj[cid1].add(obj_iter)
-                                obj2cid[obj_iter] = cid1
-                            cid2obj[cid2] = set()
-                            # Features
-                            if_connected_by_span[cid1] = 1
-                            if_connected_by_span[cid2] = 0
-                            if (
-                                if_row_connected[cid1] == 1
-                                or if_row_connected[cid2] == 1
-                            ):
-                                if_row_connected[cid1] = 1
-                                num_row_connected[cid1] += num_row_connected[cid2]
-                                num_row_connected[cid2] = 0
-                                if_row_connected[cid2] = 0
-                            num_connected_by_span[cid1] = (
-                                num_connected_by_span[cid1]
-                                + num_connected_by_span[cid2]
-                            )
-                            num_connected_by_span[cid2] = 0
-        if prev_clusters == obj2cid:
-            break
-        prev_clusters = obj2cid
+    for i1, i2 in _iter_vertical_pairs(
+        bboxes,
+        reach,
+        lambda box1, box2: vertically_aligned(box1, box2, overlapping=False),
+    ):
+        if not_merge(i1, i2):
+            continue
+        cid1 = clustering.label_of(i1)
+        cid2 = clustering.label_of(i2)
+        if not clustering.union(i1, i2):
+            continue
+        # Features
+        if_connected_by_span[cid1] = 1
+        if_connected_by_span[cid2] = 0
+        if if_row_connected[cid1] == 1 or if_row_connected[cid2] == 1:
+            if_row_connected[cid1] = 1
+            num_row_connected[cid1] += num_row_connected[cid2]
+            num_row_connected[cid2] = 0
+            if_row_connected[cid2] = 0
+        num_connected_by_span[cid1] = (
+            num_connected_by_span[cid1] + num_connected_by_span[cid2]
+        )
+        num_connected_by_span[cid2] = 0
+    cid2obj, obj2cid = clustering.to_clusters()
 
     # blacklist nearly half-page wide clusters before horizontal merging
     cid2obj2 = cid2obj[:]
@@ -363,187 +730,39 @@ def cluster_vertically_aligned_boxes(
             cid2span[cid]["min_y"] = min(cid2span[cid]["min_y"], boxes[obj].bbox[1])
             cid2span[cid]["max_y"] = max(cid2span[cid]["max_y"], boxes[obj].bbox[3])
 
-    cid2cid = {}
-    cid_pair_compared = set()
-    cid2cid2 = [cid for cid in range(len(cid2obj))]
-    for i1, b1 in enumerate(boxes):
-        for i2, b2 in enumerate(boxes):
-            if i1 == i2:
-                continue
-            if i1 in blacklist_obj or i2 in blacklist_obj:
-                continue
-            cid1 = obj2cid[i1]
-            cid2 = obj2cid[i2]
-            if (min(cid1, cid2), max(cid1, cid2)) in cid_pair_compared:
-                continue
-            if cid1 == cid2:
-                continue
-            if obj2rid[i1] == obj2rid[i2]:
-                continue
-            if cid1 not in cid2cid:
-                cid2cid[cid1] = set()
-            if cid2 not in cid2cid:
-                cid2cid[cid2] = set()
-            if cid2span[cid1]["min_y"] < cid2span[cid2]["min_y"]:
-                box1 = [
-                    cid2span[cid1]["min_x"],
-                    cid2span[cid1]["min_y"],
-                    cid2span[cid1]["max_x"],
-                    cid2span[cid1]["max_y"],
-                ]
-                box2 = [
-                    cid2span[cid2]["min_x"],
-                    cid2span[cid2]["min_y"],
-                    cid2span[cid2]["max_x"],
-                    cid2span[cid2]["max_y"],
-                ]
-            else:
-                box1 = [
-                    cid2span[cid2]["min_x"],
-                    cid2span[cid2]["min_y"],
-                    cid2span[cid2]["max_x"],
-                    cid2span[cid2]["max_y"],
-                ]
-                box2 = [
-                    cid2span[cid1]["min_x"],
-                    cid2span[cid1]["min_y"],
-                    cid2span[cid1]["max_x"],
-                    cid2span[cid1]["max_y"],
-                ]
-            if ((box1[1] < box2[1]) and (box1[3] > box2[1])) or (
-                (box1[1] > box2[1]) and (box1[1] < box2[3])
-            ):
-                continue
-            cid_pair_compared.add((min(cid1, cid2), max(cid1, cid2)))
-            query_rect = (
-                min(box1[0], box2[0]),
-                min(box1[1], box2[1]),
-                max(box1[2], box2[2]),
-                max(box1[3], box2[3]),
-            )
-            connected = True
-            for i3, b3 in enumerate(boxes):
-                if (i3 == i1) or (i3 == i2):
-                    continue
-                if obj2cid[i1] == obj2cid[i3] or obj2cid[i2] == obj2cid[i3]:
-                    continue
-                box3 = b3.bbox
-                if intersect(query_rect, box3):
-                    connected = False
-                    break
-            if (
-                (round(box1[0]) == round(box2[0]) or round(box1[2]) == round(box2[2]))
-                and connected
-            ) or (
-                round((box1[0] + box1[2]) / 2) == round((box2[0] + box2[2]) / 2)
-                and connected
-            ):
-                cid2cid[min(cid1, cid2)].add(max(cid1, cid2))
-                min_cid = min(cid1, cid2)
-                max_cid = max(cid1, cid2)
-                for cid_iter in cid2cid2:
-                    if cid2cid2[cid_iter] == cid2cid2[max_cid]:
-                        cid2cid2[cid_iter] = cid2cid2[min_cid]
-
-    # post-process cid2cid
-    cid2obj2 = cid2obj[:]
-    obj2cid2 = obj2cid[:]
-    for cid in range(len(cid2cid2)):
-        cid_merge = cid2cid2[cid]
-        if cid != cid_merge:
-            for obj_iter in cid2obj2[cid]:
-                cid2obj2[cid_merge].add(obj_iter)
-                obj2cid2[obj_iter] = cid_merge
-            cid2obj2[cid] = set()
-            # Features
-            if_connected_by_align[cid_merge] = 1
-            if_connected_by_align[cid] = 0
-            if if_row_connected[cid_merge] == 1 or if_row_connected[cid] == 1:
-                if_row_connected[cid_merge] = 1
-                num_row_connected[cid_merge] += num_row_connected[cid]
-                num_row_connected[cid] = 0
-                if_row_connected[cid2] = 0
-            if if_connected_by_span[cid_merge] == 1 or if_connected_by_span[cid] == 1:
-                if_connected_by_span[cid_merge] = 1
-                num_connected_by_span[cid_merge] += num_connected_by_span[cid]
-                num_connected_by_span[cid] = 0
-                if_connected_by_span[cid] = 0
-            num_connected_by_align[cid_merge] += num_connected_by_align[cid]
-            num_connected_by_align[cid] = 0
+    # merge clusters aligned in columns with nothing in between
+    cid2obj2, obj2cid2 = _merge_aligned_clusters(
+        cid2obj,
+        obj2cid,
+        _aligned_cluster_pairs(
+            bboxes, cid2obj, obj2cid, obj2rid, blacklist_obj, cid2span
+        ),
+        if_row_connected,
+        num_row_connected,
+        if_connected_by_span,
+        num_connected_by_span,
+        if_connected_by_align,
+        num_connected_by_align,
+    )
 
-            # code to merge columns for table
-    prev_clusters = obj2cid2
-    while True:
-        for obj1, b1 in enumerate(boxes):
-            cid1 = obj2cid2[obj1]
-            rid1 = obj2rid[obj1]
-            if cid1 in blacklist:
-                continue
-            if obj1 in blacklist_obj:
-                continue
-            for obj2, b2 in enumerate(boxes):
-                if obj1 == obj2:
-                    continue
-                if obj2cid2[obj2] == cid1:
-                    rid2 = obj2rid[obj2]
-                    if rid1 == rid2:
-                        continue
-                    for obj3 in rid2obj[rid2]:
-                        cid3 = obj2cid2[obj3]
-                        if obj3 in blacklist_obj:
-                            continue
-                        if cid1 != cid3:
-                            for obj4 in cid2obj2[cid3]:
-                                if obj4 == obj3:
-                                    continue
-                                if obj2rid[obj4] == rid1:
-                                    min_cid = min(cid1, cid3)
-                                    max_cid = max(cid1, cid3)
-                                    for obj_iter in cid2obj2[max_cid]:
-                                        cid2obj2[min_cid].add(obj_iter)
-                                        obj2cid2[obj_iter] = min_cid
-                                    cid2obj2[max_cid] = set()
-                                    # Features
-                                    if_vertical_columns_merged[min_cid] = 1
-                                    if_vertical_columns_merged[max_cid] = 0
-                                    num_vertical_columns_merged[
-                                        min_cid
-                                    ] += num_vertical_columns_merged[max_cid]
-                                    num_vertical_columns_merged[max_cid] = 0
-                                    if (
-                                        if_row_connected[min_cid] == 1
-                                        or if_row_connected[max_cid] == 1
-                                    ):
-                                        if_row_connected[min_cid] = 1
-                                        num_row_connected[min_cid] += num_row_connected[
-                                            max_cid
-                                        ]
-                                        num_row_connected[max_cid] = 0
-                                        if_row_connected[max_cid] = 0
-                                    if (
-                                        if_connected_by_span[min_cid] == 1
-                                        or if_connected_by_span[max_cid] == 1
-                                    ):
-                                        if_connected_by_span[min_cid] = 1
-                                        num_connected_by_span[
-                                            min_cid
-                                        ] += num_connected_by_span[max_cid]
-                                        num_connected_by_span[max_cid] = 0
-                                        if_connected_by_span[max_cid] = 0
-                                    if (
-                                        if_connected_by_align[min_cid] == 1
-                                        or if_connected_by_align[max_cid] == 1
-                                    ):
-                                        if_connected_by_align[min_cid] = 1
-                                        num_connected_by_align[
-                                            min_cid
-                                        ] += num_connected_by_align[max_cid]
-                                        num_connected_by_align[max_cid] = 0
-                                        if_connected_by_align[max_cid] = 0
-                                    break
-        if prev_clusters == obj2cid2:
-            break
-        prev_clusters = obj2cid2
+    # code to merge columns for table, in a single pass: columns merged here are
+    # not compared again
+    _merge_table_columns(
+        cid2obj2,
+        obj2cid2,
+        rid2obj,
+        obj2rid,
+        blacklist,
+        blacklist_obj,
+        if_row_connected,
+        num_row_connected,
+        if_connected_by_span,
+        num_connected_by_span,
+        if_connected_by_align,
+        num_connected_by_align,
+        if_vertical_columns_merged,
+        num_vertical_columns_merged,
+    )
 
     clusters = [[boxes[i] for i in cluster] for cluster in filter(bool, cid2obj2)]
     nodes = [Node(elems) for elems in clusters]
@@ -599,32 +818,24 @@ def cluster_vertically_aligned_boxes(
             )
         rid2space_norm[rid] = rid2space[rid] / (len(obj_list) - 1)
 
+    # Nodes merged into each node
+    merged_into = defaultdict(list)
+    for idx in range(len(merge_indices)):
+        merged_into[merge_indices[idx]].append(idx)
     for idx, node in enumerate(nodes):
         node_idx = node_indices[idx]
         if merge_indices[idx] == idx:
             obj_list = []
-            for idx_iter in range(len(merge_indices)):
-                if merge_indices[idx_iter] == idx:
-                    obj_list += list(cid2obj2[node_indices[idx_iter]])
+            for idx_iter in merged_into[idx]:
+                obj_list += list(cid2obj2[node_indices[idx_iter]])
             obj_list = list(set(obj_list))
             rid_list = list(set([obj2rid[obj] for obj in obj_list]))
             for rid in rid_list:
                 total_word_space[node_idx] += rid2space[rid]
                 avg_word_space_norm[node_idx] += rid2space_norm[rid]
-                obj_boxes = [
-                    boxes[obj].bbox[0] for obj in rid2obj if obj in cid2obj2[node_idx]
-                ]
-                sorted_obj_idx = [
-                    i[0] for i in sorted(enumerate(obj_boxes), key=lambda x: x[1])
-                ]
-                for obj_idx in range(len(sorted_obj_idx) - 1):
-                    node_space[node_idx] += (
-                        boxes[obj_list[sorted_obj_idx[obj_idx + 1]]].bbox[2]
-                        - boxes[obj_list[sorted_obj_idx[obj_idx]]].bbox[0]
-                    )
-                avg_node_space_norm[node_idx] += node_space[node_idx] / (
-                    len(obj_boxes) - 1
-                )
+            # node_space and avg_node_space_norm are left 0: they used to be summed
+            # over the rows (sets) found in the node's set of boxes, i.e., none,
+            # and the trained models expect them so.
             avg_word_space[node_idx] = total_word_space[node_idx] / len(rid_list)
             avg_word_space_norm[node_idx] /= len(rid_list)
             avg_node_space[node_idx] = node_space[node_idx] / len(rid_list)
@@ -726,12 +937,48 @@ def cluster_vertically_aligned_boxes(
         return tables, table_features
 
 
+def _outside_tables(
+    bboxes: np.ndarray,
+    tables_page: List[Tuple[int, int, int, float, float, float, float]],
+) -> np.ndarray:
+    """Find the boxes that do not intersect any table (borders included).
+
+    :param bboxes: (x0, y0, x1, y1) of the boxes
+    :param tables_page: tables as (page_num, page_width, page_height, top, left,
+        bottom, right)
+    :return: the indices of the boxes outside tables, in order
+    """
+    keep = np.ones(len(bboxes), dtype=bool)
+    if len(bboxes) == 0:
+        return np.flatnonzero(keep)
+    # Boxes sorted by y0 for window queries
+    order = np.argsort(bboxes[:, 1], kind="stable")
+    sorted_y0 = bboxes[order, 1]
+    # Boxes starting above y0 - max_height end above y0 (with a margin for
+    # rounding errors)
+    max_height = (bboxes[:, 3] - bboxes[:, 1]).max() + 1
+    for (_, _, _, top, left, bottom, right) in tables_page:
+        start = np.searchsorted(sorted_y0, top - max_height)
+        end = np.searchsorted(sorted_y0, bottom, side="right")
+        window = order[start:end]
+        b = bboxes[window]
+        hit = (
+            (left <= b[:, 2])
+            & (b[:, 0] <= right)
+            & (top <= b[:, 3])
+            & (b[:, 1] <= bottom)
+        )
+        keep[window[hit]] = False
+    return np.flatnonzero(keep)
+
+
 def parse_tree_structure(
     elems: PDFElems,
     font_stat: Counter,
     page_num: int,
     ref_page_seen: bool,
     tables_page: List[Tuple[int, int, int, float, float, float, float]],
+    max_boxes: Optional[int] = MAX_BOXES,
 ) -> Tuple[Dict[str, Any], bool]:
     boxes_segments = elems.segments
     boxes_curves = elems.curves
@@ -745,23 +992,8 @@ def parse_tree_structure(
 
     char_width = get_char_width(mentions)
 
-    grid_size = avg_font_pts / 2.0
-
     # Atomic features and marking initialization
-    for i, m in enumerate(mentions + boxes_figures):
-        m.id = i
-        m.feats = defaultdict(bool)
-        prefix = ""
-        if isinstance(m, LTTextLine) and m.font_name:
-            prefix = m.font_name + "-" + str(m.font_size) + "-"
-        # center X coordinate
-        m.xc = (m.x0 + m.x1) / 2.0
-        m.yc = (m.y0 + m.y1) / 2.0
-        # Here we snap the elements to its closest grid line to detect rows/columns
-        m.feats[prefix + "x0"] = m.x0_grid = m.x0 // grid_size
-        m.feats[prefix + "x1"] = m.x1_grid = m.x1 // grid_size
-        m.feats[prefix + "xc"] = m.xc_grid = m.xc // grid_size
-        m.feats[prefix + "yc"] = m.yc_grid = m.yc // grid_size
+    set_atomic_features(elems)
 
     # Figures for this page
     nodes = get_figures(boxes_figures)
@@ -773,22 +1005,8 @@ def parse_tree_structure(
     ]
 
     # Eliminate tables from these boxes
-    boxes: List[LTTextLine] = []
-    for idx1, box in enumerate(mentions):
-        intersect = False
-        for idx2, table in enumerate(tables_page):
-            table_box = tuple(table[3:])
-            bool_overlap = (
-                table_box[1] <= box.bbox[2]
-                and box.bbox[0] <= table_box[3]
-                and table_box[0] <= box.bbox[3]
-                and box.bbox[1] <= table_box[2]
-            )
-            if bool_overlap:
-                intersect = True
-                break
-        if not intersect:
-            boxes.append(box)
+    box_indices = _outside_tables(elems.arrays.bbox[: len(mentions)], tables_page)
+    boxes: List[LTTextLine] = [mentions[i] for i in box_indices]
 
     text_candidates, ref_page_seen = extract_text_candidates(
         boxes,
@@ -801,6 +1019,8 @@ def parse_tree_structure(
         boxes_figures,
         page_width,
         page_height,
+        elems.arrays.bbox[box_indices],
+        max_boxes,
     )
     text_candidates["figure"] = figures_page
     text_candidates["table"] = tables_page
@@ -819,126 +1039,56 @@ def extract_text_candidates(
     boxes_figures,
     page_width,
     page_height,
+    bboxes: Optional[np.ndarray] = None,
+    max_boxes: Optional[int] = MAX_BOXES,
 ) -> Tuple[Dict[str, List], bool]:
+    if bboxes is None:
+        bboxes = np.array([b.bbox for b in boxes], dtype=float).reshape(-1, 4)
     # Filter out boxes with zero width or height
-    filtered_boxes = []
-    for bbox in boxes:
-        if bbox.x1 - bbox.x0 > 0 and bbox.y1 - bbox.y0 > 0:
-            filtered_boxes.append(bbox)
-    boxes = filtered_boxes
-
-    # Too many "." in the Table of Content pages - ignore because it takes a lot of time
-    if len(boxes) == 0 or len(boxes) > 3500:
-        return {}, False
-    plane = Plane(page_bbox)
-    plane.extend(boxes)
+    keep = (bboxes[:, 2] - bboxes[:, 0] > 0) & (bboxes[:, 3] - bboxes[:, 1] > 0)
+    boxes = [b for b, k in zip(boxes, keep.tolist()) if k]
+    bboxes = bboxes[keep]
 
+    if len(boxes) == 0:
+        return {}, False
+    elif max_boxes is not None and len(boxes) > max_boxes:
+        logger.warning(
+            f"Too many boxes to cluster ({len(boxes)} > max_boxes={max_boxes})."
+        )
+        return {}, False
     # Row level clustering - identify objects that have same horizontal alignment
-    rid2obj = [set([i]) for i in range(len(boxes))]  # initialize clusters
-    obj2rid = list(
-        range(len(boxes))
-    )  # default object map to cluster with its own index
-    prev_clusters = obj2rid
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2rid[i1] == obj2rid[i2]):
-                    continue
-                box1 = b1.bbox
-                box2 = b2.bbox
-                if (
-                    (abs(box1[1] - box2[1]) < 0.11 * avg_font_pts)
-                    or ((abs(box1[3] - box2[3]) < 0.11 * avg_font_pts))
-                    or (
-                        round((box1[1] + box1[3]) / 2) == round((box2[1] + box2[3]) / 2)
-                    )
-                ):
-                    min_i = min(i1, i2)
-                    max_i = max(i1, i2)
-                    rid1 = obj2rid[min_i]
-                    rid2 = obj2rid[max_i]
-                    for obj_iter in rid2obj[rid2]:
-                        rid2obj[rid1].add(obj_iter)
-                        obj2rid[obj_iter] = rid1
-                    rid2obj[rid2] = set()
-        if prev_clusters == obj2rid:
-            break
-        prev_clusters = obj2rid
-
-    cid2obj = [set([i]) for i in range(len(boxes))]  # initialize clusters
-    obj2cid = list(
-        range(len(boxes))
-    )  # default object map to cluster with its own index
-    prev_clusters = obj2cid
+    rid2obj, obj2rid = cluster_rows(bboxes, avg_font_pts)
 
+    clustering = UnionFind(len(boxes))
     # add the code for merging close text boxes in particular row
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2cid[i1] == obj2cid[i2]):
-                    continue
-                box1 = b1.bbox
-                box2 = b2.bbox
-                if obj2rid[i1] == obj2rid[i2]:
-                    if (
-                        (b1.bbox[0] < b2.bbox[0])
-                        and ((b2.bbox[0] - b1.bbox[2]) <= 2 * char_width)
-                    ) or (
-                        (b2.bbox[0] < b1.bbox[0])
-                        and ((b1.bbox[0] - b2.bbox[2]) <= 2 * char_width)
-                    ):
-                        min_i = min(i1, i2)
-                        max_i = max(i1, i2)
-                        cid1 = obj2cid[min_i]
-                        cid2 = obj2cid[max_i]
-                        for obj_iter in cid2obj[cid2]:
-                            cid2obj[cid1].add(obj_iter)
-                            obj2cid[obj_iter] = cid1
-                        cid2obj[cid2] = set()
-        if prev_clusters == obj2cid:
-            break
-        prev_clusters = obj2cid
+    for i1, i2 in _iter_row_pairs(bboxes, obj2rid, 2 * char_width):
+        clustering.union(i1, i2)
 
     # vertical alignment code
-    while True:
-        for i1, b1 in enumerate(boxes):
-            for i2, b2 in enumerate(boxes):
-                if (i1 == i2) or (obj2cid[i1] == obj2cid[i2]):
-                    continue
-                if b1.bbox[1] < b2.bbox[1]:
-                    box1 = b1.bbox
-                    box2 = b2.bbox
-                elif b2.bbox[1] < b1.bbox[1]:
-                    box1 = b2.bbox
-                    box2 = b1.bbox
-                else:
-                    # horizontally aligned
-                    continue
-                if abs((box2[3] - box2[1]) - (box1[3] - box1[1])) > 0.5 * avg_font_pts:
-                    continue
-                if (
-                    box2[1] < box1[3]
-                    or (box2[1] - box1[1] < 1.5 * avg_font_pts)
-                    or (box2[3] - box1[3] < 1.5 * avg_font_pts)
-                ):  # can probably do better if we find the average space between words
-                    if (
-                        abs(box1[0] - box2[0]) < 3 * char_width
-                        or abs(box1[2] - box2[2]) < 3 * char_width
-                        or (((box1[0] + box1[2]) / 2) == ((box2[0] + box2[2]) / 2))
-                    ):
-                        min_i = min(i1, i2)
-                        max_i = max(i1, i2)
-                        cid1 = obj2cid[min_i]
-                        cid2 = obj2cid[max_i]
-                        # move all objects from cluster cid2 to cid1
-                        # reassign cluster ids for all such objects as well
-                        for obj_iter in cid2obj[cid2]:
-                            cid2obj[cid1].add(obj_iter)
-                            obj2cid[obj_iter] = cid1
-                        cid2obj[cid2] = set()
-        if prev_clusters == obj2cid:
-            break
-        prev_clusters = obj2cid
+    def vertically_aligned(box1: np.ndarray, box2: np.ndarray) -> np.ndarray:
+        similar_height = np.abs(
+            (box2[..., 3] - box2[..., 1]) - (box1[..., 3] - box1[..., 1])
+        ) <= (0.5 * avg_font_pts)
+        # can probably do better if we find the average space between words
+        close = (
+            (box2[..., 1] < box1[..., 3])
+            | (box2[..., 1] - box1[..., 1] < 1.5 * avg_font_pts)
+            | (box2[..., 3] - box1[..., 3] < 1.5 * avg_font_pts)
+        )
+        aligned = (
+            (np.abs(box1[..., 0] - box2[..., 0]) < 3 * char_width)
+            | (np.abs(box1[..., 2] - box2[..., 2]) < 3 * char_width)
+            | ((box1[..., 0] + box1[..., 2]) / 2 == (box2[..., 0] + box2[..., 2]) / 2)
+        )
+        return similar_height & close & aligned
+
+    # Vertically aligned boxes are close only if the upper one starts less than
+    # 1.5 * avg_font_pts below the bottom of the lower one (plus a margin for
+    # rounding errors).
+    reach = 1.5 * avg_font_pts + 1
+    for i1, i2 in _iter_vertical_pairs(bboxes, reach, vertically_aligned):
+        clustering.union(i1, i2)
+    cid2obj, obj2cid = clustering.to_clusters()
 
     # get cluster spans
     cid2span = {}
@@ -978,13 +1128,14 @@ def extract_text_candidates(
     # get a list of empty cids
     empty_cids = [cid for cid in range(len(cid2obj)) if len(cid2obj[cid]) == 0]
     empty_idx = 0
+    empty_cid_set = set(empty_cids)
 
     # Split paras based on whitespaces - seems to work
     if not ref_page_seen:
         for cid in range(len(cid2obj)):
             if (
                 len(cid2obj[cid]) > 0
-                and cid not in empty_cids
+                and cid not in empty_cid_set
                 and cid not in references_cid
             ):
                 cid_maxx = max([boxes[obj].bbox[2] for obj in cid2obj[cid]])
@@ -1210,60 +1361,53 @@ def get_figures(
 def merge_nodes(nodes: List[Node], merge_indices: List[int]) -> List[int]:
     """Merges overlapping nodes.
 
+    Each node in turn is merged into the best of the nodes it overlaps that are not
+    merged yet, which are looked for in a grid index of the nodes.
+
     :param nodes: Nodes to be merged
     :param merge_indices: Indices of nodes
     :return: a list of indices, indicating which node is its most outer node.
     """
-    # Merge inner boxes to the best outer box
-    # nodes.sort(key=Node.area)
-    to_be_removed = set()
-    for inner_idx in range(len(nodes)):
-        inner = nodes[inner_idx]
-        outers = []
-        outers_indices = []
-        for outer_idx in range(len(nodes)):
-            outer = nodes[outer_idx]
-            if outer is inner or outer in to_be_removed:
-                continue
-            if intersect(outer.bbox, inner.bbox):
-                outers.append(outer)
-                outers_indices.append(outer_idx)
-        if not outers:
+    index = GridIndex.for_bboxes(node.bbox for node in nodes)
+    bboxes = np.array([node.bbox for node in nodes], dtype=float).reshape(-1, 4)
+    # Nodes with zero width or height intersect nothing
+    empty = (bboxes[:, 0] == bboxes[:, 2]) | (bboxes[:, 1] == bboxes[:, 3])
+    clustering = UnionFind(len(nodes))
+    for inner_idx, inner in enumerate(nodes):
+        if empty[inner_idx]:
+            continue
+        outers_indices = np.array(sorted(index.query(inner.bbox)), dtype=int)
+        outers = bboxes[outers_indices]
+        x0, y0, x1, y1 = bboxes[inner_idx]
+        overlap = (
+            (outers_indices != inner_idx)
+            & ~empty[outers_indices]
+            & (outers[:, 0] <= x1)
+            & (x0 <= outers[:, 2])
+            & (outers[:, 1] <= y1)
+            & (y0 <= outers[:, 3])
+        )
+        if not overlap.any():
             continue
-        # Best is defined as min L1 distance to outer center
-        best_outer = min(
-            outers, key=lambda outer: l1(center(outer.bbox), center(inner.bbox))
+        outers_indices, outers = outers_indices[overlap], outers[overlap]
+        # Best is defined as min L1 distance to outer center (the first one if tied)
+        distances = np.abs((outers[:, 0] + outers[:, 2]) / 2 - (x0 + x1) / 2) + np.abs(
+            (outers[:, 1] + outers[:, 3]) / 2 - (y0 + y1) / 2
         )
-        best_outer_idx = outers_indices[outers.index(best_outer)]
-        to_be_removed.add(inner)
+        best_outer_idx = int(outers_indices[np.argmin(distances)])
+        best_outer = nodes[best_outer_idx]
+        index.remove(inner_idx)
         best_outer.merge(inner)
-        for cid_iter in range(len(merge_indices)):
-            if merge_indices[cid_iter] == merge_indices[inner_idx]:
-                merge_indices[cid_iter] = merge_indices[best_outer_idx]
+        index.insert(best_outer_idx, best_outer.bbox)
+        bboxes[best_outer_idx] = best_outer.bbox
+        clustering.union(best_outer_idx, inner_idx)
+    outer_indices = [
+        merge_indices[clustering.label_of(idx)] for idx in range(len(merge_indices))
+    ]
+    merge_indices[:] = outer_indices
     return merge_indices
 
 
-def get_most_common_font_pts(mentions, font_stat):
-    """
-    font_stat: Counter object of font sizes
-    """
-    try:
-        # default min font size of 1 pt in case no font present
-        most_common_font_size = font_stat.most_common(1)[0][0]
-
-        count = 0.01  # avoid division by zero
-        height_sum = 0.02  # default to pts 2.0
-        for m in mentions:
-            if m.font_size == most_common_font_size:
-                height_sum += m.height
-                count += 1
-        return height_sum / count
-
-    except IndexError:
-        logger.info("No text found on page. Default most_common_font_pts to 2.0")
-        return 2.0
-
-
 def get_page_width(boxes):
     xmin = float("Inf")
     xmax = float("-Inf")
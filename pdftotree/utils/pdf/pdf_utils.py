@@ -6,11 +6,16 @@ extracted with PDFminer
 @author: xiao
 """
 import collections
+import copyreg
+import io
+import logging
+import pickle
 import re
 import string
 from collections import Counter
-from typing import List, NamedTuple, Optional, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
+import numpy as np
 from pdfminer.converter import PDFPageAggregator
 from pdfminer.layout import (
     LTAnno,
@@ -19,18 +24,51 @@ from pdfminer.layout import (
     LTContainer,
     LTCurve,
     LTFigure,
+    LTImage,
     LTLayoutContainer,
     LTLine,
     LTPage,
     LTTextContainer,
     LTTextLine,
 )
+from pdfminer.pdfdevice import PDFDevice
+from pdfminer.pdftypes import PDFObjRef, PDFStream
+from pdfminer.psparser import KWD, LIT, PSKeyword, PSLiteral
 from pdfminer.utils import INF, apply_matrix_pt
 
+from pdftotree.utils.bbox_utils import CentroidIndex
 from pdftotree.utils.img_utils import normalize_bbox, normalize_pts
 
 #  from pdftotree.utils.pdf.vector_utils import *
 
+logger = logging.getLogger(__name__)
+
+# Kinds of elements in PageArrays
+KIND_MENTION = 0
+KIND_FIGURE = 1
+
+
+class PageArrays(NamedTuple):
+    """
+    Struct-of-arrays representation of the geometry of a page. Row i describes
+    (mentions + figures)[i].
+    """
+
+    bbox: np.ndarray  # (n, 4) x0, y0, x1, y1
+    center: np.ndarray  # (n, 2) xc, yc
+    grid: np.ndarray  # (n, 4) x0, x1, xc, yc snapped to grid_size
+    font: np.ndarray  # (n,) index in fonts, or -1 without font
+    kind: np.ndarray  # (n,) KIND_MENTION or KIND_FIGURE
+    fonts: List[Tuple[str, float]]  # (font_name, font_size)
+    grid_size: float
+
+
+class WordBoxes(NamedTuple):
+    """Words of a line of text, kept in place of its chars in low-memory mode."""
+
+    texts: List[str]
+    bbox: np.ndarray  # (n, 4) top, left, bottom, right
+
 
 # Compact wrapper representation for the pdf
 class PDFElems(NamedTuple):
@@ -40,6 +78,10 @@ class PDFElems(NamedTuple):
     figures: List[LTFigure]
     layout: LTPage
     chars: List[Union[LTChar, LTAnno]]
+    arrays: Optional[PageArrays] = None
+    # Indexes of the centroids of mentions and figures
+    mention_centroids: Optional[CentroidIndex] = None
+    figure_centroids: Optional[CentroidIndex] = None
 
 
 class CustomPDFPageAggregator(PDFPageAggregator):
@@ -109,11 +151,15 @@ class CustomPDFPageAggregator(PDFPageAggregator):
         # Add the curve as an arbitrary polyline (belzier curve info is lost here)
         self.cur_item.add(LTCurve(gstate.linewidth, pts))
 
-    def normalize_pdf(self, layout: LTPage, scaler) -> Tuple[PDFElems, Counter]:
+    def normalize_pdf(
+        self, layout: LTPage, scaler, low_memory=False
+    ) -> Tuple[PDFElems, Counter]:
         """
         Normalizes pdf object coordinates (bot left) to image
         conventions (top left origin).
         Returns the list of chars and average char size
+        In low-memory mode, each mention only keeps its words (as WordBoxes) and
+        its text, and chars are released.
         """
         chars = []
         mentions: List[LTTextContainer] = []
@@ -192,10 +238,303 @@ class CustomPDFPageAggregator(PDFPageAggregator):
                 m.set_bbox((m.x0, alphanum_c.y0, m.x1, alphanum_c.y1))
 
             #     mentions.sort(key = lambda m: (m.y0,m.x0))
-        elems = PDFElems(mentions, segments, curves, figures, layout, chars)
+        if low_memory:
+            for m in mentions:
+                words = get_word_boundaries(m)
+                m.words = WordBoxes(
+                    [word[0] for word in words],
+                    np.array([word[1:] for word in words], dtype=float).reshape(-1, 4),
+                )
+                # Keep the text of the line only
+                m._objs = [LTAnno(m.get_text())]
+            for fig in figures:
+                _release_chars(fig)
+            chars = []
+
+        # Grid lines to snap elements to in order to detect rows/columns
+        grid_size = get_most_common_font_pts(mentions, font_size_counter) / 2.0
+        arrays = build_page_arrays(mentions, figures, grid_size)
+        elems = PDFElems(
+            mentions,
+            segments,
+            curves,
+            figures,
+            layout,
+            chars,
+            arrays,
+            CentroidIndex(arrays.bbox[: len(mentions)]),
+            CentroidIndex(arrays.bbox[len(mentions) :]),
+        )
         return elems, font_size_counter
 
 
+class ScanProbeDevice(PDFDevice):
+    """
+    A lightweight device that only tells whether a page looks scanned.
+    It records where images are placed and whether any vector segments are drawn,
+    and neither renders text nor runs layout analysis.
+    """
+
+    line_only_shape = CustomPDFPageAggregator.line_only_shape
+    # Split long paths into single paths just like CustomPDFPageAggregator
+    paint_path = CustomPDFPageAggregator.paint_path
+
+    def __init__(self, rsrcmgr):
+        super().__init__(rsrcmgr)
+        self.page_bbox = (0, 0, 0, 0)
+        self.image_bboxes: List[Tuple[float, float, float, float]] = []
+        self.has_segments = False
+        self._ctm_stack = []
+
+    def begin_page(self, page, ctm):
+        (x0, y0, x1, y1) = page.mediabox
+        (x0, y0) = apply_matrix_pt(ctm, (x0, y0))
+        (x1, y1) = apply_matrix_pt(ctm, (x1, y1))
+        self.page_bbox = (0, 0, abs(x0 - x1), abs(y0 - y1))
+        self.image_bboxes = []
+        self.has_segments = False
+        self._ctm_stack = []
+
+    def begin_figure(self, name, bbox, matrix):
+        self._ctm_stack.append(self.ctm)
+
+    def end_figure(self, name):
+        # Restore the ctm that a form XObject may have changed
+        self.ctm = self._ctm_stack.pop()
+
+    def render_image(self, name, stream):
+        # An image is drawn onto the unit square transformed by the ctm
+        pts = [apply_matrix_pt(self.ctm, p) for p in [(0, 0), (0, 1), (1, 0), (1, 1)]]
+        xs, ys = zip(*pts)
+        self.image_bboxes.append((min(xs), min(ys), max(xs), max(ys)))
+
+    def paint_single_path(self, gstate, stroke, fill, evenodd, path):
+        """Check if a single path would make segments in normalize_pdf."""
+        if self.has_segments or len(path) < 2:
+            return
+        shape = "".join(x[0] for x in path)
+        if not self.line_only_shape.match(shape):
+            return
+        pts = []
+        for p in path:
+            for i in range(1, len(p), 2):
+                pts.append(apply_matrix_pt(self.ctm, (p[i], p[i + 1])))
+        if shape.endswith("h"):
+            pts.append(pts[0])
+        lines = list(zip(pts[:-1], pts[1:]))
+        if any(p0[0] != p1[0] and p0[1] != p1[1] for p0, p1 in lines):
+            return  # a sloped polyline makes a curve
+        # Lines longer than this are segments
+        pts_thres = 2.0
+        for p0, p1 in lines:
+            if max(abs(p0[0] - p1[0]), abs(p0[1] - p1[1])) > pts_thres:
+                self.has_segments = True
+                return
+
+    def is_scanned(self) -> bool:
+        """
+        Tell if the last processed page looks scanned, i.e., has no vector
+        segments and has images, either a single one or vertically stacked strips,
+        that cover the whole page.
+        """
+        if self.has_segments:
+            return False
+        tol = 5
+        _, _, width, height = self.page_bbox
+        # Stack strips of the same horizontal extent on top of each other
+        stacks: Dict[Tuple[int, int], Tuple[float, float]] = {}
+        for x0, y0, x1, y1 in sorted(self.image_bboxes, key=lambda b: b[1]):
+            key = (round(x0), round(x1))
+            bottom, top = stacks.get(key, (y0, y0))
+            if round(y0) > round(top):
+                bottom = y0  # a gap breaks the stack
+            top = max(top, y1)
+            stacks[key] = (bottom, top)
+            if (
+                x0 <= tol
+                and x1 >= width - tol
+                and bottom <= tol
+                and top >= height - tol
+            ):
+                return True
+        return False
+
+
+def build_page_arrays(
+    mentions: List[LTTextLine], figures: List[LTFigure], grid_size: float
+) -> PageArrays:
+    """Builds the PageArrays of normalized mentions and figures."""
+    n = len(mentions) + len(figures)
+    bbox = np.array(
+        [m.bbox for m in mentions] + [fig.bbox for fig in figures], dtype=float
+    ).reshape(n, 4)
+    center = np.column_stack(
+        [(bbox[:, 0] + bbox[:, 2]) / 2.0, (bbox[:, 1] + bbox[:, 3]) / 2.0]
+    )
+    grid = np.column_stack([bbox[:, 0], bbox[:, 2], center[:, 0], center[:, 1]])
+    grid //= grid_size
+    fonts: List[Tuple[str, float]] = []
+    font_ids: Dict[Tuple[str, float], int] = {}
+    font = np.full(n, -1, dtype=np.int32)
+    for i, m in enumerate(mentions):
+        if m.font_name:
+            key = (m.font_name, m.font_size)
+            if key not in font_ids:
+                font_ids[key] = len(fonts)
+                fonts.append(key)
+            font[i] = font_ids[key]
+    kind = np.full(n, KIND_MENTION, dtype=np.int8)
+    kind[len(mentions) :] = KIND_FIGURE
+    return PageArrays(bbox, center, grid, font, kind, fonts, grid_size)
+
+
+def get_word_boundaries(mention: LTTextLine) -> List[List]:
+    """Split a line of text into words.
+
+    :param mention: a line of text
+    :return: a list of words as [text, top, left, bottom, right]
+    """
+    mention_text = mention.get_text()
+    mention_chars: List[Tuple[str, int, int, int, int]] = []
+    for obj in mention:
+        if isinstance(obj, LTChar):
+            x0, y0, x1, y1 = obj.bbox
+            mention_chars.append([obj.get_text(), y0, x0, y1, x1])
+    words = []
+    mention_words: List[str] = mention_text.split()  # word split by " " (space)
+    char_idx = 0
+    for word in mention_words:
+        curr_word = [word, float("Inf"), float("Inf"), float("-Inf"), float("-Inf")]
+        len_idx = 0
+        while len_idx < len(word):
+            char: str = mention_chars[char_idx][0]
+            if char in [" ", "\xa0"]:
+                char_idx += 1
+                continue
+            if word[len_idx : len_idx + len(char)] != char:
+                logger.warning(
+                    "Out of order ({}, {})".format(word, mention_chars[char_idx][0])
+                )
+            curr_word[1] = min(curr_word[1], mention_chars[char_idx][1])
+            curr_word[2] = min(curr_word[2], mention_chars[char_idx][2])
+            curr_word[3] = max(curr_word[3], mention_chars[char_idx][3])
+            curr_word[4] = max(curr_word[4], mention_chars[char_idx][4])
+            len_idx += len(mention_chars[char_idx][0])
+            char_idx += 1
+        words.append(curr_word)
+    return words
+
+
+def _release_chars(container: LTContainer):
+    """Removes chars, already grouped into mentions, from a figure."""
+    container._objs = [
+        obj for obj in container if not isinstance(obj, (LTChar, LTAnno))
+    ]
+    for obj in container:
+        if isinstance(obj, LTContainer):
+            _release_chars(obj)
+
+
+def get_most_common_font_pts(mentions, font_stat):
+    """
+    font_stat: Counter object of font sizes
+    """
+    try:
+        # default min font size of 1 pt in case no font present
+        most_common_font_size = font_stat.most_common(1)[0][0]
+
+        count = 0.01  # avoid division by zero
+        height_sum = 0.02  # default to pts 2.0
+        for m in mentions:
+            if m.font_size == most_common_font_size:
+                height_sum += m.height
+                count += 1
+        return height_sum / count
+
+    except IndexError:
+        logger.info("No text found on page. Default most_common_font_pts to 2.0")
+        return 2.0
+
+
+def detach_elems(elems: PDFElems) -> PDFElems:
+    """
+    Makes PDFElems self-contained so that they can be pickled, e.g., to be
+    sent across processes.
+    The layout is replaced by an empty LTPage of the same geometry as only the
+    latter is used once normalized, and image streams are detached from the
+    document they are read from.
+    """
+
+    def detach(m):
+        if isinstance(m, LTImage):
+            memo = {}
+            m.stream = _detach_obj(m.stream, memo)
+            m.colorspace = _detach_obj(m.colorspace, memo)
+        elif isinstance(m, LTContainer):
+            for child in m:
+                detach(child)
+
+    for fig in elems.figures:
+        detach(fig)
+    layout = LTPage(elems.layout.pageid, elems.layout.bbox, elems.layout.rotate)
+    return elems._replace(layout=layout)
+
+
+def _intern_literal(name) -> PSLiteral:
+    return LIT(name)
+
+
+def _intern_keyword(name) -> PSKeyword:
+    return KWD(name)
+
+
+class _ElemsPickler(pickle.Pickler):
+    """
+    A pickler of detached PDFElems. pdfminer compares literals and keywords by
+    identity, so they are interned again when unpickled (e.g., in the parent
+    process of a worker). This is registered in a private dispatch table rather
+    than with copyreg so as not to change how other code pickles pdfminer objects.
+    """
+
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[PSLiteral] = lambda lit: (_intern_literal, (lit.name,))
+    dispatch_table[PSKeyword] = lambda kwd: (_intern_keyword, (kwd.name,))
+
+
+def dumps_elems(obj) -> bytes:
+    """Pickle detached PDFElems, or objects holding them, to be loaded with
+    ``pickle.loads``."""
+    f = io.BytesIO()
+    _ElemsPickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return f.getvalue()
+
+
+def _detach_obj(obj, memo: Dict[int, Any]):
+    """
+    Recursively resolves references and copies streams with their data
+    deciphered so that nothing refers to the document anymore.
+    A reference that cycles back to itself is replaced by None.
+    """
+    if isinstance(obj, PDFObjRef):
+        if obj.objid not in memo:
+            memo[obj.objid] = None  # break reference cycles
+            memo[obj.objid] = _detach_obj(obj.resolve(default=None), memo)
+        return memo[obj.objid]
+    if isinstance(obj, list):
+        return [_detach_obj(v, memo) for v in obj]
+    if isinstance(obj, dict):
+        return {k: _detach_obj(v, memo) for k, v in obj.items()}
+    if isinstance(obj, PDFStream):
+        rawdata = obj.rawdata
+        if rawdata is not None and obj.decipher:
+            rawdata = obj.decipher(obj.objid, obj.genno, rawdata, obj.attrs)
+        stream = PDFStream(_detach_obj(obj.attrs, memo), rawdata)
+        stream.data = obj.data
+        stream.set_objid(obj.objid, obj.genno)
+        return stream
+    return obj
+
+
 def _print_dict(elem_dict):
     """
     Print a dict in a readable way
@@ -0,0 +1,71 @@
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, Optional
+
+# Reused by disabled timers so that they cost no allocation
+_NO_TIMER = nullcontext()
+
+
+class Profiler(object):
+    """
+    Accumulate the wall-clock time spent in each stage of the pipeline, per page.
+
+    Stages that do not belong to a page (e.g. loading a model) are recorded for the
+    whole document.
+    """
+
+    def __init__(self):
+        self.pages: Dict[int, Dict[str, float]] = {}
+        self.document: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float, page_num: Optional[int] = None):
+        """Add time spent in a stage.
+
+        :param stage: name of the stage
+        :param seconds: time spent in the stage
+        :param page_num: 1-based page number, or None for the whole document
+        """
+        stages = (
+            self.document if page_num is None else self.pages.setdefault(page_num, {})
+        )
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, stage: str, page_num: Optional[int] = None) -> Iterator[None]:
+        """Time the enclosed block as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, page_num)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Report the time of each stage per page, for the document and in total.
+
+        :return: a dict with "pages" (page number to stage times), "document"
+            and "total" (stage times summed over pages and the document)
+        """
+        total = dict(self.document)
+        for stages in self.pages.values():
+            for stage, seconds in stages.items():
+                total[stage] = total.get(stage, 0.0) + seconds
+        return {
+            "pages": {
+                page_num: dict(self.pages[page_num]) for page_num in sorted(self.pages)
+            },
+            "document": dict(self.document),
+            "total": total,
+        }
+
+
+def timer(
+    profiler: Optional[Profiler], stage: str, page_num: Optional[int] = None
+) -> ContextManager:
+    """Time the enclosed block as a stage if profiling is enabled.
+
+    :param profiler: a profiler, or None if profiling is disabled
+    :return: a context manager that does nothing when profiler is None
+    """
+    if profiler is None:
+        return _NO_TIMER
+    return profiler.measure(stage, page_num)
@@ -0,0 +1,246 @@
+"""
+A long-lived subprocess recognizing tables with tabula, to be reused for every
+table of every document converted by a process.
+
+The worker speaks JSON lines over its stdin and stdout, one request and one response
+per line. It keeps tabula-py imported and, when JPype is installed (``pip install
+pdftotree[persistent_tabula]``), tabula-java's JVM running and warmed up between
+requests. Without JPype, tabula-py still starts tabula-java for each request, which
+the worker reports in its reply to a health check and :class:`TabulaWorker` warns
+of. Running tabula in a subprocess rather than in the converting process lets a
+crashed or stuck JVM be replaced.
+
+This file is run as a script by :class:`TabulaWorker` so that the worker imports
+nothing but tabula-py.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a table recognition, and for a health check
+TIMEOUT = 300.0
+PING_TIMEOUT = 60.0
+
+
+class TabulaWorker(object):
+    """
+    Client of a tabula worker subprocess, which is started on first use and
+    restarted if it crashes or stops responding.
+    """
+
+    def __init__(self, timeout: float = TIMEOUT, ping_timeout: float = PING_TIMEOUT):
+        """
+        :param timeout: seconds to wait for tabula to recognize the tables of a page
+            before restarting the worker
+        :param ping_timeout: seconds to wait for the worker to answer a health check,
+            including its start
+        """
+        self.timeout = timeout
+        self.ping_timeout = ping_timeout
+        self.pid = os.getpid()  # of the process owning the worker
+        self._proc: Optional[subprocess.Popen] = None
+        self._responses: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._next_id = 0
+        # Whether the worker keeps the JVM running, known once it has started
+        self.keeps_jvm: Optional[bool] = None
+
+    def read_pdf(
+        self, pdf_file: str, pages: int, area: List[List[float]], silent=True
+    ) -> List[Dict[str, Any]]:
+        """Recognize tables as ``tabula.read_pdf`` with ``output_format="json"``.
+
+        The request is tried again once in a new worker if the worker crashes or
+        times out.
+
+        :param pdf_file: path to a PDF file
+        :param pages: 1-based page number
+        :param area: areas (top, left, bottom, right) to recognize a table in
+        :param silent: whether to suppress tabula-java's log messages
+        :return: JSON of the tables recognized by tabula
+        """
+        request = {
+            "op": "read_pdf",
+            "pdf_file": os.path.abspath(pdf_file),
+            "pages": pages,
+            "area": area,
+            "silent": silent,
+        }
+        for attempt in range(2):
+            self._ensure_alive()
+            try:
+                response = self._call(request, self.timeout)
+            except RuntimeError as e:
+                self._kill()
+                if attempt > 0:
+                    raise
+                logger.warning(f"Restarting the tabula worker: {e}")
+                continue
+            if "error" in response:
+                raise RuntimeError(f"tabula failed on {pdf_file}: {response['error']}")
+            return response["tables"]
+
+    def ping(self) -> bool:
+        """Check if the worker is running and responding."""
+        if self._proc is None or self._proc.poll() is not None:
+            return False
+        try:
+            response = self._call({"op": "ping"}, self.ping_timeout)
+        except RuntimeError:
+            return False
+        self.keeps_jvm = response.get("jpype", False)
+        return response.get("ok", False)
+
+    def close(self) -> None:
+        """Stop the worker. It is started again if used afterwards."""
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()  # the worker exits at the end of its input
+            self._proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        self._kill()
+
+    def _ensure_alive(self) -> None:
+        if self._proc is not None and self._proc.poll() is None:
+            return
+        if self._proc is not None:
+            logger.warning(
+                f"The tabula worker exited with code {self._proc.returncode}."
+            )
+        warn = self.keeps_jvm is None  # once, not on every restart
+        self._start()
+        if not self.ping():
+            self._kill()
+            raise RuntimeError("The tabula worker did not start.")
+        if warn and not self.keeps_jvm:
+            logger.warning(
+                "JPype is not installed, so the tabula worker starts tabula-java for "
+                "each page. Install pdftotree[persistent_tabula] to keep its JVM "
+                "running."
+            )
+
+    def _start(self) -> None:
+        self._proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        self._responses = queue.Queue()
+        threading.Thread(
+            target=_read_lines,
+            args=(self._proc.stdout, self._responses),
+            daemon=True,
+        ).start()
+        logger.info(f"Started a tabula worker (pid {self._proc.pid}).")
+
+    def _kill(self) -> None:
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        for stream in [self._proc.stdin, self._proc.stdout]:
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self._proc = None
+
+    def _call(self, request: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        """Send a request and wait for its response.
+
+        :raise RuntimeError: if the worker exits or does not respond in time
+        """
+        self._next_id += 1
+        request = dict(request, id=self._next_id)
+        try:
+            self._proc.stdin.write(json.dumps(request) + "\n")
+            self._proc.stdin.flush()
+        except OSError as e:
+            raise RuntimeError(f"failed to send a request ({e})")
+        while True:
+            try:
+                line = self._responses.get(timeout=timeout)
+            except queue.Empty:
+                raise RuntimeError(f"no response in {timeout}s")
+            if line is None:
+                raise RuntimeError("the worker exited")
+            response = json.loads(line)
+            # Skip a late response to a request that has timed out.
+            if response.get("id") == request["id"]:
+                return response
+
+
+def _read_lines(stream, lines: "queue.Queue[Optional[str]]") -> None:
+    for line in stream:
+        lines.put(line)
+    lines.put(None)  # end of output: the worker exited
+
+
+_shared: Optional[TabulaWorker] = None
+
+
+def get_shared_worker() -> TabulaWorker:
+    """Get the tabula worker shared by everything in this process.
+
+    A forked process gets its own worker rather than that of its parent.
+    """
+    global _shared
+    if _shared is None or _shared.pid != os.getpid():
+        _shared = TabulaWorker()
+        atexit.register(_shared.close)
+    return _shared
+
+
+def _serve() -> None:
+    """Answer requests on stdin until its end."""
+    # Keep the original stdout for responses only, and send anything else written
+    # to it, e.g. by tabula-java, to stderr.
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    import tabula
+
+    try:
+        import jpype  # noqa: F401
+
+        has_jpype = True
+    except ImportError:
+        has_jpype = False
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        response: Dict[str, Any] = {"id": request.get("id")}
+        try:
+            if request["op"] == "ping":
+                response["ok"] = True
+                response["jpype"] = has_jpype
+            elif request["op"] == "read_pdf":
+                response["tables"] = tabula.read_pdf(
+                    request["pdf_file"],
+                    pages=request["pages"],
+                    area=request["area"],
+                    output_format="json",
+                    silent=request["silent"],
+                )
+            else:
+                response["error"] = f"unknown operation {request['op']!r}"
+        except Exception as e:
+            response["error"] = f"{type(e).__name__}: {e}"
+        out.write(json.dumps(response) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    _serve()
@@ -22,11 +22,12 @@ setup(
         "tensorflow>=2.2",
         "wand",
     ],
+    extras_require={"persistent_tabula": ["jpype1"]},
     keywords=["pdf", "parsing", "html", "hocr"],
     setup_requires=["pytest-runner"],
     tests_require=["pytest"],
     url="https://github.com/HazyResearch/pdftotree",
-    scripts=["bin/pdftotree", "bin/extract_tables"],
+    scripts=["bin/pdftotree", "bin/pdftotree-batch", "bin/extract_tables"],
     classifiers=[  # https://pypi.python.org/pypi?:action=list_classifiers
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
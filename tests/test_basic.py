@@ -1,13 +1,22 @@
+import copyreg
+import json
 import logging
 import os
+import pickle
 from subprocess import PIPE, Popen
 from typing import Optional
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag
+from pdfminer.pdfinterp import PDFPageInterpreter
+from pdfminer.psparser import LIT, PSLiteral
 from shapely.geometry import box
 
 import pdftotree
+from pdftotree.batch import find_tasks, load_manifest, run_batch
+from pdftotree.ml.features import get_mentions_within_bbox
+from pdftotree.TreeExtract import TreeExtractor
+from pdftotree.utils.pdf.pdf_utils import KIND_FIGURE, dumps_elems
 
 
 # Adapted from https://github.com/ocropus/hocr-tools/blob/v1.3.0/hocr-check
@@ -37,6 +46,157 @@ def test_heuristic_completion():
     assert output is not None
 
 
+def test_parse_iter():
+    """Test if parse_iter yields pages one by one and the same hOCR as parse."""
+    chunks = list(pdftotree.parse_iter("tests/input/paleo.pdf"))
+    soup = BeautifulSoup("".join(chunks), "lxml")
+    pages = soup.find_all(class_="ocr_page")
+    # declaration, head, start of body, each page, and tail
+    assert len(chunks) == len(pages) + 4
+    assert "".join(chunks) == pdftotree.parse("tests/input/paleo.pdf")
+
+
+def test_parse_iter_should_not_count_skipped_pages(monkeypatch):
+    """Test if streaming skips and does not count a page that overflows."""
+    process_page = PDFPageInterpreter.process_page
+
+    def process_page_but_second(self, page):
+        self.num_pages = getattr(self, "num_pages", 0) + 1
+        if self.num_pages == 2:
+            raise OverflowError("cannot convert float infinity to integer")
+        process_page(self, page)
+
+    monkeypatch.setattr(PDFPageInterpreter, "process_page", process_page_but_second)
+    output = "".join(pdftotree.parse_iter("tests/input/paleo.pdf"))
+    # The same as interpreting every page before converting them
+    extractor = TreeExtractor("tests/input/paleo.pdf")
+    extractor.parse()
+    extractor.get_tree_structure(None, None)
+    assert output == extractor.get_html_tree()
+    soup = BeautifulSoup(output, "lxml")
+    pages = soup.find_all(class_="ocr_page")
+    assert "page_2" not in [page["id"] for page in pages]
+    pages_num = soup.find("meta", attrs={"name": "ocr-number-of-pages"})
+    assert pages_num["content"] == str(len(pages))
+
+
+def test_parallel_parse_should_be_identical_to_serial():
+    """Test if pages interpreted across processes give the same output."""
+    output = pdftotree.parse("tests/input/112823.pdf")
+    assert pdftotree.parse("tests/input/112823.pdf", jobs=2) == output
+
+
+def test_page_selection():
+    """Test if only selected pages are extracted with their original numbers."""
+    output = pdftotree.parse("tests/input/paleo.pdf", pages=[2, 4])
+    soup = BeautifulSoup(output, "lxml")
+    pages = soup.find_all(class_="ocr_page")
+    assert [page["id"] for page in pages] == ["page_2", "page_4"]
+    assert get_prop(pages[1], "ppageno") == "3"
+    pages_num = soup.find("meta", attrs={"name": "ocr-number-of-pages"})
+    assert pages_num["content"] == "2"
+
+
+def test_dumps_elems_should_intern_literals():
+    """Test if pickled literals are interned again, without changing how other code
+    pickles them."""
+    lit = LIT("DeviceRGB")
+    assert pickle.loads(dumps_elems([lit]))[0] is lit
+    assert PSLiteral not in copyreg.dispatch_table
+
+
+def test_page_cache(tmp_path):
+    """Test if pages loaded from the cache give the same output."""
+    cache_dir = os.path.join(tmp_path, "cache")
+    output = pdftotree.parse("tests/input/paleo.pdf", cache_dir=cache_dir)
+    (key,) = os.listdir(cache_dir)
+    assert len(os.listdir(os.path.join(cache_dir, key))) > 0
+    assert pdftotree.parse("tests/input/paleo.pdf", cache_dir=cache_dir) == output
+
+
+def test_probe_scanned():
+    """Test if scanned PDFs are told apart without layout analysis."""
+    assert pdftotree.probe_scanned("tests/input/CaseStudy_ACS.pdf")
+    assert not pdftotree.probe_scanned("tests/input/md.pdf")
+    assert not pdftotree.probe_scanned("tests/input/paleo.pdf", max_pages=3)
+
+
+def test_batch_should_resume(tmp_path):
+    """Test if a batch run converts documents and skips them when resumed."""
+    list_path = os.path.join(tmp_path, "list.txt")
+    with open(list_path, "w") as f:
+        f.write("tests/input/md.pdf\ntests/input/missing.pdf\n")
+    tasks = find_tasks(list_path, os.path.join(tmp_path, "html"))
+    manifest_path = os.path.join(tmp_path, "manifest.jsonl")
+    records = run_batch(tasks, manifest_path, workers=2)
+    assert sorted(record["status"] for record in records) == ["error", "ok"]
+    assert os.path.isfile(os.path.join(tmp_path, "html", "md.html"))
+
+    # Only the failed document is tried again.
+    records = run_batch(tasks, manifest_path)
+    assert [record["pdf_file"] for record in records] == ["tests/input/missing.pdf"]
+    assert load_manifest(manifest_path)["tests/input/md.pdf"]["status"] == "ok"
+
+
+def test_page_arrays():
+    """Test if the columnar page representation matches mentions and figures."""
+    extractor = TreeExtractor("tests/input/paleo.pdf", pages=[1])
+    extractor.parse()
+    elems = extractor.elems[1]
+    arrays = elems.arrays
+    boxes = elems.mentions + elems.figures
+    assert arrays.bbox.shape == (len(boxes), 4)
+    assert arrays.bbox.tolist() == [list(m.bbox) for m in boxes]
+    assert (arrays.kind[len(elems.mentions) :] == KIND_FIGURE).all()
+    font_name, font_size = arrays.fonts[arrays.font[0]]
+    assert (font_name, font_size) == (boxes[0].font_name, boxes[0].font_size)
+
+
+def test_mention_centroids():
+    """Test if mentions looked up by their centroids are those found by a scan."""
+    extractor = TreeExtractor("tests/input/paleo.pdf", pages=[1])
+    extractor.parse()
+    elems = extractor.elems[1]
+    for m in elems.mentions:
+        bbox = (m.y0 - 20, m.x0 - 20, m.y1 + 20, m.x1 + 20)
+        found = get_mentions_within_bbox(bbox, elems.mentions, elems.mention_centroids)
+        assert m in found
+        assert found == get_mentions_within_bbox(bbox, elems.mentions)
+
+
+def test_low_memory_should_give_same_output():
+    """Test if the low-memory mode releases chars but gives the same output."""
+    extractor = TreeExtractor("tests/input/md.pdf", low_memory=True)
+    extractor.parse()
+    assert all(len(elems.chars) == 0 for elems in extractor.elems.values())
+    output = pdftotree.parse("tests/input/md.pdf", low_memory=True)
+    assert output == pdftotree.parse("tests/input/md.pdf")
+
+
+def test_profile(tmp_path):
+    """Test if the time of each stage is reported per page."""
+    profile_path = os.path.join(tmp_path, "profile.json")
+    output = pdftotree.parse("tests/input/112823.pdf", profile_path=profile_path)
+    assert output == pdftotree.parse("tests/input/112823.pdf")
+    with open(profile_path) as f:
+        profile = json.load(f)
+    assert profile["pdf_file"] == "tests/input/112823.pdf"
+    stages = profile["pages"]["1"]
+    for stage in ["interpret", "table_detection", "tree_structure", "html"]:
+        assert stages[stage] >= 0
+    assert "tabula" in profile["total"]
+    assert TreeExtractor("tests/input/112823.pdf").profile is None
+
+
+def test_max_boxes(caplog):
+    """Test if the layout of pages with more text boxes than max_boxes is skipped."""
+    output = pdftotree.parse("tests/input/md.pdf", max_boxes=1)
+    soup = BeautifulSoup(output, "lxml")
+    assert len(soup.find_all(class_="ocr_page")) == 1
+    assert len(soup.find_all(class_="ocrx_word")) == 0
+    assert "max_boxes=1" in caplog.text
+
+
 def test_cli_should_output_at_given_path(tmp_path):
     """Test if CLI produces an HTML at a given path."""
     html_path = os.path.join(tmp_path, "paleo.html")
@@ -111,6 +271,42 @@ def test_looks_scanned():
     assert all([figure.contains(word) for word in words])
 
 
+def test_images_as_files(tmp_path):
+    """Test if images are written once each and referred to relative to the hOCR."""
+    html_path = os.path.join(tmp_path, "html", "paleo.html")
+    os.makedirs(os.path.dirname(html_path))
+    image_dir = os.path.join(tmp_path, "images")
+    pdftotree.parse("tests/input/paleo.pdf", html_path, image_dir=image_dir)
+    with open(html_path) as f:
+        soup = BeautifulSoup(f, "lxml")
+    srcs = [img["src"] for img in soup.find_all("img")]
+    assert len(srcs) > 0
+    for src in srcs:
+        assert src.startswith("../images/")
+        assert os.path.isfile(os.path.join(tmp_path, "html", src))
+    assert len(os.listdir(image_dir)) == len(set(srcs))
+
+
+def test_flate_image_should_be_exported(tmp_path):
+    """Test if a FlateDecode image is embedded, or written, as pdfminer exports it."""
+
+    def get_figure_srcs(soup: BeautifulSoup):
+        figure = soup.find("figure", title="bbox 137 590 148 601")
+        return [img.get("src") for img in figure.find_all("img")]
+
+    output = pdftotree.parse("tests/input/112823.pdf", pages=[6])
+    srcs = get_figure_srcs(BeautifulSoup(output, "lxml"))
+    assert len(srcs) == 1 and srcs[0].startswith("data:image/jpeg;base64,")
+
+    html_path = os.path.join(tmp_path, "112823.html")
+    image_dir = os.path.join(tmp_path, "images")
+    pdftotree.parse("tests/input/112823.pdf", html_path, pages=[6], image_dir=image_dir)
+    with open(html_path) as f:
+        srcs = get_figure_srcs(BeautifulSoup(f, "lxml"))
+    assert len(srcs) == 1 and srcs[0].endswith(".jpg")
+    assert os.path.isfile(os.path.join(tmp_path, srcs[0]))
+
+
 def test_LTChar_under_LTFigure(tmp_path):
     """Test on a PDF where LTChar(s) are children of LTFigure."""
     html_path = os.path.join(tmp_path, "paleo.html")
@@ -138,6 +334,19 @@ def test_LTChar_under_LTFigure(tmp_path):
         assert all([line.decode("utf-8").startswith("ok") for line in proc.stderr])
 
 
+def test_native_table_engine():
+    """Test if tables are recognized without tabula by the native engine."""
+    output = pdftotree.parse(
+        "tests/input/CentralSemiconductorCorp_2N4013.pdf", table_engine="native"
+    )
+    soup = BeautifulSoup(output, "lxml")
+    table = soup.find(class_="ocr_page").find(class_="ocr_table")
+    assert len(table.find("tr").find_all("td")) == 18
+    assert get_bbox(table) is not None
+    cell = table.find(class_="ocrx_word").parent.parent
+    assert get_bbox(cell) is not None
+
+
 def test_overflowerror_should_not_happen():
     """Test if OverflowError does not happen (#104)."""
     output = pdftotree.parse(
@@ -0,0 +1,383 @@
+"""Test clustering of boxes."""
+import sys
+from collections import defaultdict
+from copy import deepcopy
+
+import numpy as np
+
+from pdftotree.utils.bbox_utils import GridIndex
+from pdftotree.utils.cluster_utils import UnionFind
+from pdftotree.utils.pdf.pdf_parsers import (
+    _aligned_cluster_pairs,
+    _iter_vertical_pairs,
+    _merge_aligned_clusters,
+    _merge_table_columns,
+    _outside_tables,
+    cluster_rows,
+)
+from pdftotree.utils.pdf.vector_utils import intersect
+
+
+def test_union_find_should_keep_label_of_first_set():
+    """Test if merged sets are labeled as the set the others are merged into."""
+    clustering = UnionFind(5)
+    assert clustering.union(3, 4)
+    assert clustering.union(1, 4)
+    assert not clustering.union(3, 1)
+    assert clustering.union(2, 0)
+    cid2obj, obj2cid = clustering.to_clusters()
+    assert obj2cid == [2, 1, 2, 1, 1]
+    assert cid2obj == [set(), {1, 3, 4}, {0, 2}, set(), set()]
+
+
+def test_cluster_rows_should_chain_aligned_boxes():
+    """Test if boxes are grouped into rows by their y0, y1 or y center."""
+    bboxes = np.array(
+        [
+            [0, 100, 10, 110],
+            [20, 300, 30, 310],  # alone
+            [40, 100.5, 50, 112],  # y0 close to box 0
+            [60, 101.5, 70, 113.5],  # y0 close to box 2 but not to box 0
+            [80, 95, 90, 115],  # same y center as box 0
+        ],
+        dtype=float,
+    )
+    rid2obj, obj2rid = cluster_rows(bboxes, avg_font_pts=10)
+    assert [rid for rid in rid2obj if rid] == [{0, 2, 3, 4}, {1}]
+    assert obj2rid == [0, 1, 0, 0, 0]
+
+
+def test_grid_index_should_find_touching_boxes():
+    """Test if a grid index finds boxes sharing a border and follows their moves."""
+    index = GridIndex.for_bboxes(
+        [(0, 0, 10, 10), (10, 10, 20, 20), (50, 50, 60, 60), (0, 0, 100, 100)]
+    )
+    assert {0, 1, 3} <= index.query((0, 0, 10, 10))
+    assert 2 not in index.query((0, 0, 10, 10))
+    index.remove(3)
+    index.insert(1, (45, 45, 55, 55))
+    assert 3 not in index.query((50, 50, 60, 60))
+    assert 1 in index.query((50, 50, 60, 60))
+    assert 1 in index.query((15, 15, 16, 16))  # still covers its old position
+
+
+def _features():
+    # if_row_connected, num_row_connected, if_connected_by_span, ...
+    return [
+        defaultdict(int),
+        defaultdict(lambda: 1),
+        defaultdict(int),
+        defaultdict(lambda: 1),
+        defaultdict(int),
+        defaultdict(lambda: 1),
+    ]
+
+
+def _spans(bboxes, cid2obj):
+    cid2span = {}
+    for cid, objs in enumerate(cid2obj):
+        cid2span[cid] = {
+            "min_x": min((bboxes[obj][0] for obj in objs), default=sys.maxsize),
+            "min_y": min((bboxes[obj][1] for obj in objs), default=sys.maxsize),
+            "max_x": max((bboxes[obj][2] for obj in objs), default=-sys.maxsize - 1),
+            "max_y": max((bboxes[obj][3] for obj in objs), default=-sys.maxsize - 1),
+        }
+    return cid2span
+
+
+def _brute_force_aligned_pairs(bboxes, obj2cid, obj2rid, blacklist_obj, cid2span):
+    # Compares every pair of boxes, as cluster_vertically_aligned_boxes used to.
+    pairs = []
+    compared = set()
+    for i1 in range(len(bboxes)):
+        for i2 in range(len(bboxes)):
+            if i1 == i2 or i1 in blacklist_obj or i2 in blacklist_obj:
+                continue
+            cid1, cid2 = obj2cid[i1], obj2cid[i2]
+            pair = (min(cid1, cid2), max(cid1, cid2))
+            if pair in compared or cid1 == cid2 or obj2rid[i1] == obj2rid[i2]:
+                continue
+            span1, span2 = cid2span[cid1], cid2span[cid2]
+            if span1["min_y"] >= span2["min_y"]:
+                span1, span2 = span2, span1
+            box1 = [span1[k] for k in ["min_x", "min_y", "max_x", "max_y"]]
+            box2 = [span2[k] for k in ["min_x", "min_y", "max_x", "max_y"]]
+            if (box1[1] < box2[1] < box1[3]) or (box2[1] < box1[1] < box2[3]):
+                continue
+            compared.add(pair)
+            query_rect = (
+                min(box1[0], box2[0]),
+                min(box1[1], box2[1]),
+                max(box1[2], box2[2]),
+                max(box1[3], box2[3]),
+            )
+            connected = not any(
+                intersect(query_rect, bboxes[i3])
+                for i3 in range(len(bboxes))
+                if obj2cid[i3] != cid1 and obj2cid[i3] != cid2
+            )
+            aligned = (
+                round(box1[0]) == round(box2[0])
+                or round(box1[2]) == round(box2[2])
+                or round((box1[0] + box1[2]) / 2) == round((box2[0] + box2[2]) / 2)
+            )
+            if connected and aligned:
+                pairs.append(pair)
+    return pairs
+
+
+def test_merge_aligned_clusters_should_chain_pairs():
+    """Test if chains of aligned pairs (3-18 then 10-18) end in one cluster."""
+    clustering = UnionFind(20)
+    clustering.union(0, 1)
+    cid2obj, obj2cid = clustering.to_clusters()
+    features = _features()
+    cid2obj2, obj2cid2 = _merge_aligned_clusters(
+        cid2obj, obj2cid, [(3, 18), (10, 18)], *features
+    )
+    # The set of 10 absorbs that of 18, which already holds 3.
+    assert cid2obj2[10] == {3, 10, 18}
+    assert cid2obj2[3] == set() and cid2obj2[18] == set()
+    assert [obj2cid2[obj] for obj in [3, 10, 18]] == [10, 10, 10]
+    assert cid2obj2[0] == {0, 1}
+    if_connected_by_align, num_connected_by_align = features[4:]
+    assert if_connected_by_align[10] == 1
+    assert if_connected_by_align[3] == if_connected_by_align[18] == 0
+    assert num_connected_by_align[10] == 3
+
+
+def test_merge_aligned_clusters_should_reset_merged_row_connected():
+    """Test if the row-connected feature moves from a merged cluster to its target."""
+    cid2obj, obj2cid = UnionFind(4).to_clusters()
+    features = _features()
+    if_row_connected, num_row_connected = features[:2]
+    if_row_connected[1] = 1
+    num_row_connected[1] = 2
+    if_row_connected[3] = 1  # unrelated cluster
+    _merge_aligned_clusters(cid2obj, obj2cid, [(0, 1)], *features)
+    assert if_row_connected[0] == 1 and num_row_connected[0] == 3
+    assert if_row_connected[1] == 0 and num_row_connected[1] == 0
+    assert if_row_connected[3] == 1
+
+
+def test_aligned_cluster_pairs_should_match_brute_force():
+    """Test if aligned pairs of clusters are found as comparing every pair of boxes
+    would, in the same order."""
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        n = rng.randint(2, 40)
+        x0 = rng.choice([10, 60, 110, 160], n) + rng.randint(-2, 3, n)
+        y0 = rng.randint(0, 40, n) * 12.0
+        bboxes = np.stack(
+            [x0, y0, x0 + rng.choice([20, 30, 40], n), y0 + 10], axis=1
+        ).astype(float)
+        _, obj2rid = cluster_rows(bboxes, avg_font_pts=10)
+        # Clusters of boxes starting in the same column, split at random
+        clustering = UnionFind(n)
+        for i1 in range(n):
+            for i2 in range(i1 + 1, n):
+                if abs(x0[i1] - x0[i2]) < 5 and rng.rand() < 0.3:
+                    clustering.union(i1, i2)
+        cid2obj, obj2cid = clustering.to_clusters()
+        blacklist_obj = set(np.flatnonzero(rng.rand(n) < 0.1).tolist())
+        cid2span = _spans(bboxes, cid2obj)
+        expected = _brute_force_aligned_pairs(
+            bboxes, obj2cid, obj2rid, blacklist_obj, cid2span
+        )
+        pairs = _aligned_cluster_pairs(
+            bboxes, cid2obj, obj2cid, obj2rid, blacklist_obj, cid2span
+        )
+        assert pairs == expected
+
+
+def test_vertical_pairs_should_match_brute_force():
+    """Test if the window query finds the related pairs that comparing every pair of
+    boxes would, in the same order, including boxes right at the window edge and
+    boxes with the same coordinates."""
+    reach = 4.0
+
+    def related(box1, box2):
+        # Close up to the window edge included, and overlapping horizontally
+        return (box2[..., 1] <= box1[..., 3] + reach) & (
+            (box1[..., 0] <= box2[..., 2]) & (box2[..., 0] <= box1[..., 2])
+        )
+
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        n = rng.randint(1, 40)
+        # Few distinct coordinates so that ties and edge hits are frequent
+        x0 = rng.randint(0, 5, n) * 10.0
+        y0 = rng.randint(0, 10, n) * 2.0
+        bboxes = np.stack(
+            [x0, y0, x0 + rng.choice([5, 10, 20], n), y0 + rng.choice([2, 4], n)],
+            axis=1,
+        )
+        expected = []
+        for i1 in range(n):
+            for i2 in range(i1 + 1, n):
+                if bboxes[i1, 1] == bboxes[i2, 1]:
+                    continue
+                lower, upper = sorted([i1, i2], key=lambda i: bboxes[i, 1])
+                if related(bboxes[lower], bboxes[upper]):
+                    expected.append((i1, i2))
+        assert list(_iter_vertical_pairs(bboxes, reach, related)) == expected
+
+
+def _brute_force_merge_table_columns(
+    cid2obj2, obj2cid2, rid2obj, obj2rid, blacklist, blacklist_obj, *features
+):
+    # Compares every pair of boxes, then every box of the second one's row and of
+    # its cluster, as cluster_vertically_aligned_boxes used to.
+    (
+        if_row_connected,
+        num_row_connected,
+        if_connected_by_span,
+        num_connected_by_span,
+        if_connected_by_align,
+        num_connected_by_align,
+        if_vertical_columns_merged,
+        num_vertical_columns_merged,
+    ) = features
+    for obj1 in range(len(obj2cid2)):
+        cid1 = obj2cid2[obj1]
+        rid1 = obj2rid[obj1]
+        if cid1 in blacklist or obj1 in blacklist_obj:
+            continue
+        for obj2 in range(len(obj2cid2)):
+            if obj1 == obj2 or obj2cid2[obj2] != cid1:
+                continue
+            rid2 = obj2rid[obj2]
+            if rid1 == rid2:
+                continue
+            for obj3 in rid2obj[rid2]:
+                cid3 = obj2cid2[obj3]
+                if obj3 in blacklist_obj or cid1 == cid3:
+                    continue
+                for obj4 in cid2obj2[cid3]:
+                    if obj4 == obj3 or obj2rid[obj4] != rid1:
+                        continue
+                    min_cid = min(cid1, cid3)
+                    max_cid = max(cid1, cid3)
+                    for obj_iter in cid2obj2[max_cid]:
+                        cid2obj2[min_cid].add(obj_iter)
+                        obj2cid2[obj_iter] = min_cid
+                    cid2obj2[max_cid] = set()
+                    if_vertical_columns_merged[min_cid] = 1
+                    if_vertical_columns_merged[max_cid] = 0
+                    num_vertical_columns_merged[min_cid] += num_vertical_columns_merged[
+                        max_cid
+                    ]
+                    num_vertical_columns_merged[max_cid] = 0
+                    for if_feature, num_feature in [
+                        (if_row_connected, num_row_connected),
+                        (if_connected_by_span, num_connected_by_span),
+                        (if_connected_by_align, num_connected_by_align),
+                    ]:
+                        if if_feature[min_cid] == 1 or if_feature[max_cid] == 1:
+                            if_feature[min_cid] = 1
+                            num_feature[min_cid] += num_feature[max_cid]
+                            num_feature[max_cid] = 0
+                            if_feature[max_cid] = 0
+                    break
+
+
+def test_merge_table_columns_should_match_brute_force():
+    """Test if table columns are merged as comparing every pair of boxes would, with
+    the same clusters and features."""
+    rng = np.random.RandomState(0)
+    for _ in range(300):
+        n = rng.randint(1, 30)
+        # Few rows and columns so that clusters share one row, two rows or more
+        clustering = UnionFind(n)
+        cids = rng.randint(0, rng.randint(1, 8), n)
+        for i1 in range(n):
+            for i2 in range(i1 + 1, n):
+                if cids[i1] == cids[i2]:
+                    clustering.union(i1, i2)
+        cid2obj, obj2cid = clustering.to_clusters()
+        rows = UnionFind(n)
+        rids = rng.randint(0, rng.randint(1, 6), n)
+        for i1 in range(n):
+            for i2 in range(i1 + 1, n):
+                if rids[i1] == rids[i2]:
+                    rows.union(i1, i2)
+        rid2obj, obj2rid = rows.to_clusters()
+        blacklist = set(np.flatnonzero(rng.rand(n) < 0.1).tolist())
+        blacklist_obj = set(np.flatnonzero(rng.rand(n) < 0.1).tolist())
+        features = _features() + [defaultdict(int), defaultdict(lambda: 1)]
+        for feature in features[::2]:
+            for cid in range(n):
+                feature[cid] = int(rng.rand() < 0.3)
+        for feature in features[1::2]:
+            for cid in range(n):
+                feature[cid] = rng.randint(0, 4)
+        expected = deepcopy((cid2obj, obj2cid, features))
+        _brute_force_merge_table_columns(
+            expected[0],
+            expected[1],
+            rid2obj,
+            obj2rid,
+            blacklist,
+            blacklist_obj,
+            *expected[2]
+        )
+        _merge_table_columns(
+            cid2obj, obj2cid, rid2obj, obj2rid, blacklist, blacklist_obj, *features
+        )
+        assert cid2obj == expected[0]
+        assert obj2cid == expected[1]
+        for feature, expected_feature in zip(features, expected[2]):
+            assert [feature[cid] for cid in range(n)] == [
+                expected_feature[cid] for cid in range(n)
+            ]
+
+
+def _brute_force_outside_tables(bboxes, tables_page):
+    # Checks every box against every table, as parse_tree_structure used to.
+    box_indices = []
+    for idx, box in enumerate(bboxes.tolist()):
+        if not any(
+            top <= box[3] and box[1] <= bottom and left <= box[2] and box[0] <= right
+            for (_, _, _, top, left, bottom, right) in tables_page
+        ):
+            box_indices.append(idx)
+    return box_indices
+
+
+def test_outside_tables_should_match_brute_force():
+    """Test if boxes touching or overlapping a table are dropped as checking every
+    box against every table would."""
+    bboxes = np.array(
+        [
+            [10, 10, 20, 20],  # inside
+            [30, 5, 40, 15],  # on the top border
+            [50, 20, 60, 30],  # on the right border
+            [45, 25, 55, 35],  # partly overlapping
+            [80, 80, 90, 90],  # outside
+            [0, 31, 10, 41],  # just below
+        ],
+        dtype=float,
+    )
+    # (page_num, page_width, page_height, top, left, bottom, right)
+    tables_page = [(1, 100, 100, 15, 0, 30, 50)]
+    assert _outside_tables(bboxes, tables_page).tolist() == [4, 5]
+    assert _outside_tables(bboxes, []).tolist() == list(range(len(bboxes)))
+    assert _outside_tables(bboxes[:0], tables_page).tolist() == []
+
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        n = rng.randint(0, 30)
+        # Integer coordinates so that boxes often sit right on table borders
+        x0, y0 = rng.randint(0, 20, n) * 5.0, rng.randint(0, 20, n) * 5.0
+        bboxes = np.stack(
+            [x0, y0, x0 + rng.randint(1, 5, n) * 5, y0 + rng.randint(1, 3, n) * 5],
+            axis=1,
+        ).reshape(-1, 4)
+        tables_page = []
+        for _ in range(rng.randint(0, 4)):
+            top, left = rng.randint(0, 20, 2) * 5.0
+            bottom, right = top + rng.randint(1, 8) * 5, left + rng.randint(1, 8) * 5
+            tables_page.append((1, 100, 100, top, left, bottom, right))
+        assert _outside_tables(
+            bboxes, tables_page
+        ).tolist() == _brute_force_outside_tables(bboxes, tables_page)
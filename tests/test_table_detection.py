@@ -1,8 +1,15 @@
 """Test table area detection."""
+import importlib.util
+import os
+import signal
+
+import pytest
 from bs4 import BeautifulSoup
 
 import pdftotree
 from pdftotree.core import load_model
+from pdftotree.TreeExtract import TreeExtractor, _match_tables
+from pdftotree.utils.tabula_worker import TabulaWorker
 from pdftotree.visual.visual_utils import predict_heatmap
 
 
@@ -33,3 +40,40 @@ def test_cell_values_not_missing():
         "HOT",
         "$5",
     ]
+
+
+def test_tables_should_be_mapped_back_to_their_areas():
+    """Test if tables recognized by one call to tabula are mapped to their areas."""
+    areas = [(0, 0, 100, 100), (10, 10, 50, 50), (200, 0, 300, 100), (400, 0, 500, 9)]
+
+    def table(top, left, bottom, right):
+        return {"top": top, "left": left, "bottom": bottom, "right": right}
+
+    tables = [
+        table(0, 0, 90, 90),
+        table(12, 12, 48, 48),  # in both the first and second areas
+        table(20, 20, 40, 40),  # a second table in the second area
+        table(210, 10, 290, 90),
+    ]
+    assert _match_tables(areas, tables) == [tables[0], tables[1], tables[3], None]
+    assert _match_tables(areas[:1], []) == [None]
+
+
+def test_tabula_worker_should_restart():
+    """Test if a tabula worker gives the same tables and is restarted if killed."""
+    worker = TabulaWorker()
+    extractor = TreeExtractor("tests/input/md.pdf", tabula_worker=worker)
+    output = "".join(extractor.iter_hocr())
+    assert output == pdftotree.parse("tests/input/md.pdf")
+    assert worker.ping()
+    # The worker reports whether it can keep the JVM running.
+    assert worker.keeps_jvm == (importlib.util.find_spec("jpype") is not None)
+
+    os.kill(worker._proc.pid, signal.SIGKILL)
+    worker._proc.wait()
+    assert not worker.ping()
+    # An error of tabula is raised by the restarted worker.
+    with pytest.raises(RuntimeError, match="FileNotFoundError"):
+        worker.read_pdf("tests/input/missing.pdf", 1, [[0, 0, 100, 100]])
+    assert worker.ping()
+    worker.close()
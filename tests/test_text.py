@@ -1,9 +1,12 @@
 """Test extracted text."""
+import io
 import re
+from xml.dom.minidom import Document
 
 from bs4 import BeautifulSoup
 
 import pdftotree
+from pdftotree.utils.hocr_utils import HOCRWriter
 
 
 def test_text_is_escaped():
@@ -20,3 +23,27 @@ def test_text_is_escaped():
     words = soup.find_all(class_="ocrx_word")
     m = re.search(r">(.+?)<", str(words[152]))
     assert m[1] == "&amp;"
+
+
+def test_hocr_writer_should_lay_out_as_minidom():
+    """Test if the hOCR writer gives what minidom pretty-prints, escaping included."""
+    doc = Document()
+    block = doc.createElement("div")
+    block.setAttribute("class", "ocrx_block")
+    block.setAttribute("title", 'a "b" <c>')
+    line = doc.createElement("span")
+    block.appendChild(line)
+    word = doc.createElement("span")
+    line.appendChild(word)
+    word.appendChild(doc.createTextNode("x & y < z"))
+    block.appendChild(doc.createElement("td"))
+    expected = io.StringIO()
+    block.writexml(expected, indent="\t", addindent="\t", newl="\n")
+
+    out = io.StringIO()
+    hocr = HOCRWriter(out, depth=1)
+    with hocr.element("div", {"class": "ocrx_block", "title": 'a "b" <c>'}):
+        with hocr.element("span", {}):
+            hocr.text_element("span", {}, "x & y < z")
+        hocr.empty_element("td", {})
+    assert out.getvalue() == expected.getvalue()